@@ -3,9 +3,15 @@ import pathlib
 import click
 
 from brazilian_business_partner_api.cmds.config import (
+    api_workers_option,
+    backlog_option,
     config_path_option,
+    drain_timeout_option,
+    host_option,
+    keep_alive_option,
     log_level_option,
     log_path_option,
+    port_option,
     write_cli_log_messages,
 )
 from brazilian_business_partner_api.service.coordinator import APICoordinator
@@ -20,10 +26,22 @@ def api():
 @log_level_option
 @log_path_option
 @config_path_option
+@host_option
+@port_option
+@api_workers_option
+@keep_alive_option
+@backlog_option
+@drain_timeout_option
 def dataload_cli(
     log_level,
     log_path,
     config_path,
+    host,
+    port,
+    workers,
+    keep_alive,
+    backlog,
+    drain_timeout,
 ):
     write_cli_log_messages()
 
@@ -31,4 +49,10 @@ def dataload_cli(
         log_level=log_level,
         log_path=log_path,
         config_file_path=pathlib.Path(config_path),
+        host=host,
+        port=port,
+        workers=workers,
+        keep_alive=keep_alive,
+        backlog=backlog,
+        drain_timeout=drain_timeout,
     )
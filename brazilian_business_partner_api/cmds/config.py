@@ -3,6 +3,7 @@ import os
 import click
 
 from brazilian_business_partner_api import Logger
+from brazilian_business_partner_api.config import config
 
 log_messages = []
 
@@ -15,6 +16,12 @@ def write_cli_log_messages():
 
 def validate_forced_reload(ctx, param, value):
     exception_message = "User cancelled. The --forced-load option was chosen by the user but the user is not really 'bout that lyfe.\n"
+    if value and ctx.params.get("resume"):
+        # --resume is eager, so this is known before the user is asked anything
+        raise click.UsageError(
+            "--forced-load reloads everything from the start and --resume continues the previous load, they can't be used together.",
+            ctx,
+        )
     if value:
         if (
             input(
@@ -147,6 +154,134 @@ def csv_file_path_option(f):
     )(f)
 
 
+def load_engine_option(f):
+    def load_engine_callback(ctx, param, value):
+        log_messages.append(
+            f"-------------- LOAD ENGINE set to '{value}' --------------"
+        )
+        return value
+
+    return click.option(
+        "--load-engine",
+        "-le",
+        callback=load_engine_callback,
+        type=click.Choice(["copy", "insert"], case_sensitive=False),
+        default="copy",
+        help="""This option determines how the raw CSV is written to the stage table.
+                'copy' streams the file with COPY FROM STDIN,
+                'insert' reads it with pandas and inserts it in chunks.""",
+    )(f)
+
+
+def transform_engine_option(f):
+    def transform_engine_callback(ctx, param, value):
+        log_messages.append(
+            f"-------------- TRANSFORM ENGINE set to '{value}' --------------"
+        )
+        return value
+
+    return click.option(
+        "--transform-engine",
+        "-te",
+        callback=transform_engine_callback,
+        type=click.Choice(["single-scan", "per-table"], case_sensitive=False),
+        default="single-scan",
+        help="""This option determines how the transformed tables are built from the stage table.
+                'single-scan' scans the stage table once into a keyed intermediate table and builds every table from it,
+                'per-table' scans the stage table once for every table.""",
+    )(f)
+
+
+def transform_concurrency_option(f):
+    def transform_concurrency_callback(ctx, param, value):
+        log_messages.append(
+            f"-------------- Running up to {value} transformation steps at a time --------------"
+        )
+        return value
+
+    return click.option(
+        "--transform-concurrency",
+        "-tc",
+        callback=transform_concurrency_callback,
+        type=click.IntRange(min=1),
+        default=config.TRANSFORM_CONFIGS["concurrency"],
+        help="This option is the most transformation steps (table builds and index creations) that run at the same time, each on its own database connection.",
+    )(f)
+
+
+def workers_option(f):
+    def workers_callback(ctx, param, value):
+        if value > 1:
+            log_messages.append(
+                f"-------------- WORKERS set to '{value}' --------------"
+            )
+        return value
+
+    return click.option(
+        "--workers",
+        "-w",
+        callback=workers_callback,
+        type=click.IntRange(min=1),
+        default=1,
+        help="This option sets how many processes, each with its own database connection, load the CSV file in parallel.",
+    )(f)
+
+
+def resume_option(f):
+    def resume_callback(ctx, param, value):
+        if value:
+            log_messages.append(
+                f"-------------- Resuming the previous load --------------"
+            )
+        return value
+
+    return click.option(
+        "--resume",
+        "-r",
+        callback=resume_callback,
+        is_flag=True,
+        is_eager=True,
+        default=False,
+        help="This option continues an interrupted load of the same file from the last chunk it committed, and skips the transformation steps that already finished.",
+    )(f)
+
+
+def incremental_option(f):
+    def incremental_callback(ctx, param, value):
+        if value:
+            log_messages.append(
+                f"-------------- Loading only the changes of the file (incremental) --------------"
+            )
+        return value
+
+    return click.option(
+        "--incremental",
+        "-i",
+        callback=incremental_callback,
+        is_flag=True,
+        default=False,
+        help="This option diffs the file against the rows already loaded and applies only the inserted and deleted rows to the stage and transformed tables. Without loaded rows it is a full load.",
+    )(f)
+
+
+def blue_green_option(f):
+    def blue_green_callback(ctx, param, value):
+        if value:
+            log_messages.append(
+                f"-------------- Building the transformed data in a shadow schema (blue/green) --------------"
+            )
+        return value
+
+    return click.option(
+        "--blue-green",
+        "-bg",
+        callback=blue_green_callback,
+        is_flag=True,
+        default=False,
+        help="This option builds the transformed tables in the shadow schema `transformed_next` while the API keeps reading `transformed`, and swaps the two in one transaction when they are done. The replaced data is kept in `transformed_previous` for a rollback.",
+    )(f)
+
+
 def log_config_file_path_option(f):
     def log_config_file_path_callback(ctx, param, value):
         if value:
@@ -163,3 +298,111 @@ def log_config_file_path_option(f):
         required=False,
         help="This option is given to allow the user to set the log configuration with an .ini file",
     )(f)
+
+
+def host_option(f):
+    def host_callback(ctx, param, value):
+        if value:
+            log_messages.append(
+                f"-------------- HOST set to '{value}' --------------"
+            )
+        return value
+
+    return click.option(
+        "--host",
+        "-ho",
+        callback=host_callback,
+        type=click.STRING,
+        required=False,
+        help="This option is the address the API listens on, `host` of the [server] section of the config when it's not given.",
+    )(f)
+
+
+def port_option(f):
+    def port_callback(ctx, param, value):
+        if value:
+            log_messages.append(
+                f"-------------- PORT set to '{value}' --------------"
+            )
+        return value
+
+    return click.option(
+        "--port",
+        "-p",
+        callback=port_callback,
+        type=click.IntRange(min=0, max=65535),
+        required=False,
+        help="This option is the port the API listens on, `port` of the [server] section of the config when it's not given.",
+    )(f)
+
+
+def api_workers_option(f):
+    def api_workers_callback(ctx, param, value):
+        if value is not None:
+            log_messages.append(
+                f"-------------- API WORKERS set to '{value}' --------------"
+            )
+        return value
+
+    return click.option(
+        "--workers",
+        "-w",
+        callback=api_workers_callback,
+        type=click.IntRange(min=0),
+        required=False,
+        help="This option sets how many worker processes serve the API, 0 for one per core. With more than one the app is loaded once in a parent process, which forks the workers.",
+    )(f)
+
+
+def keep_alive_option(f):
+    def keep_alive_callback(ctx, param, value):
+        if value is not None:
+            log_messages.append(
+                f"-------------- KEEP ALIVE set to '{value}' seconds --------------"
+            )
+        return value
+
+    return click.option(
+        "--keep-alive",
+        "-ka",
+        callback=keep_alive_callback,
+        type=click.IntRange(min=0),
+        required=False,
+        help="This option is how many seconds an idle keep-alive connection is kept open.",
+    )(f)
+
+
+def backlog_option(f):
+    def backlog_callback(ctx, param, value):
+        if value is not None:
+            log_messages.append(
+                f"-------------- BACKLOG set to '{value}' --------------"
+            )
+        return value
+
+    return click.option(
+        "--backlog",
+        "-bl",
+        callback=backlog_callback,
+        type=click.IntRange(min=1),
+        required=False,
+        help="This option is the most connections that wait to be accepted.",
+    )(f)
+
+
+def drain_timeout_option(f):
+    def drain_timeout_callback(ctx, param, value):
+        if value is not None:
+            log_messages.append(
+                f"-------------- DRAIN TIMEOUT set to '{value}' seconds --------------"
+            )
+        return value
+
+    return click.option(
+        "--drain-timeout",
+        "-dt",
+        callback=drain_timeout_callback,
+        type=click.FloatRange(min=0),
+        required=False,
+        help="This option is how many seconds a worker gets to finish its requests when the API is stopped or restarted (SIGHUP), before it's killed.",
+    )(f)
@@ -5,10 +5,17 @@ import click
 from brazilian_business_partner_api.cmds.config import (
     config_path_option,
     csv_file_path_option,
+    load_engine_option,
+    transform_engine_option,
+    transform_concurrency_option,
     log_level_option,
     log_path_option,
     sample_size_option,
     forced_load_option,
+    workers_option,
+    resume_option,
+    incremental_option,
+    blue_green_option,
     write_cli_log_messages,
 )
 from brazilian_business_partner_api.dataloader.coordinator import ELTCoordinator
@@ -26,6 +33,13 @@ def dataload():
 @csv_file_path_option
 @forced_load_option
 @sample_size_option
+@load_engine_option
+@transform_engine_option
+@transform_concurrency_option
+@workers_option
+@resume_option
+@incremental_option
+@blue_green_option
 def dataload_cli(
     log_level,
     log_path,
@@ -33,6 +47,13 @@ def dataload_cli(
     csv_file_path,
     forced_load,
     sample_size,
+    load_engine,
+    transform_engine,
+    transform_concurrency,
+    workers,
+    resume,
+    incremental,
+    blue_green,
 ):
     write_cli_log_messages()
 
@@ -43,6 +64,10 @@ def dataload_cli(
         csv_file_path=csv_file_path,
         load_raw_data=forced_load,
         sample_size=sample_size,
+        load_engine=load_engine.lower(),
+        workers=workers,
+        resume=resume,
+        incremental=incremental,
     )
 
     ELTCoordinator.transform(
@@ -51,4 +76,23 @@ def dataload_cli(
         config_file_path=pathlib.Path(config_path),
         transform_data=forced_load,
         sample_size=sample_size,
+        resume=resume,
+        incremental=incremental,
+        transform_engine=transform_engine.lower(),
+        concurrency=transform_concurrency,
+        blue_green=blue_green,
+    )
+
+
+@dataload.command("rollback")
+@log_level_option
+@log_path_option
+@config_path_option
+def rollback_cli(log_level, log_path, config_path):
+    write_cli_log_messages()
+
+    ELTCoordinator.rollback(
+        log_level=log_level,
+        log_path=log_path,
+        config_file_path=pathlib.Path(config_path),
     )
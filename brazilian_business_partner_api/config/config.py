@@ -1,10 +1,31 @@
+import os
 import pathlib
 import tomllib as toml
 
-_TOML = toml.load(
-    open(str(pathlib.Path(__file__).parent.resolve() / "config.toml"), "rb")
+# The config file is the one in this package, unless this environment variable names another one
+CONFIG_PATH_ENV = "BRAZ_BPA_CONFIG_PATH"
+CONFIG_FILE_PATH = pathlib.Path(
+    os.environ.get(CONFIG_PATH_ENV) or pathlib.Path(__file__).parent.resolve() / "config.toml"
 )
 
+_TOML = toml.load(open(str(CONFIG_FILE_PATH), "rb"))
+
 DB_CONFIGS = _TOML["db"]
+DB_POOL_CONFIGS = _TOML["db_pool"]
+API_CONFIGS = _TOML["api"]
+SERVER_CONFIGS = _TOML["server"]
+TRANSFORM_CONFIGS = _TOML["transform"]
+CACHE_CONFIGS = _TOML["cache"]
+GRAPH_CONFIGS = _TOML["graph"]
+COST_CONFIGS = _TOML["cost"]
+DOCUMENTS_CONFIGS = _TOML["documents"]
+PERSISTED_QUERIES_PATH = (
+    pathlib.Path(DOCUMENTS_CONFIGS["persisted_queries_path"])
+    if DOCUMENTS_CONFIGS["persisted_queries_path"]
+    else None
+)
+GRAPH_SNAPSHOT_PATH = (
+    pathlib.Path(GRAPH_CONFIGS["snapshot_path"]) if GRAPH_CONFIGS["snapshot_path"] else None
+)
 APP_NAME = _TOML["app"]["name"]
 APP_VERSION = _TOML["app"]["version"]
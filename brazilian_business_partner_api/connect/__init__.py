@@ -7,5 +7,10 @@ class DB(Protocol):
     def connect(self):
         ...
 
-    def execute(self, logger: brazilian_business_partner_api.Logger, query: str):
+    def execute(
+        self,
+        logger: brazilian_business_partner_api.Logger,
+        query: str,
+        raise_errors: bool = False,
+    ):
         ...
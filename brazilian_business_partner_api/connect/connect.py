@@ -1,3 +1,11 @@
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import threading
+import time
+import weakref
+
 import psycopg2
 from psycopg2.extras import DictCursor
 
@@ -7,6 +15,93 @@ psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
 
 
+def _execute(
+    conn,
+    cur: DictCursor,
+    logger: brazilian_business_partner_api.Logger,
+    query: str,
+    raise_errors: bool = False,
+    params: None | tuple = None,
+) -> DictCursor:
+    logger.log.debug(f"Executing DB query: {query}")
+    try:
+        cur.execute(query, params)
+        conn.commit()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.log.debug("Error: %s" % error)
+        conn.rollback()
+        if raise_errors:
+            raise
+
+    return cur
+
+
+class PreparedStatement:
+    """
+    A named query that is prepared once per connection (PREPARE) and then only executed (EXECUTE), with its
+    parameters ($1, $2, ...) bound by the driver. Postgres plans it for the first executions, and switches to
+    one generic plan when that isn't worse, so the lookups that are executed over and over aren't planned
+    over and over. When a table or schema it reads is changed (like by the swap of a blue/green transform)
+    Postgres plans it again by itself.
+
+    Args:
+        name (str): The name of the statement, unique per connection.
+        query (str): The query, with $1, $2, ... for its parameters.
+    Attributes:
+        prepares (int): On how many connections it was prepared.
+        executions (int): How many times it was executed.
+    """
+
+    def __init__(self, name: str, query: str):
+        self.name = name
+        self.query = query
+        self.prepares = 0
+        self.executions = 0
+        self._prepared_on = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    @property
+    def reuses(self) -> int:
+        """The executions that used a statement that was already prepared"""
+        return self.executions - self.prepares
+
+    def prepare_query(self, conn) -> None | str:
+        """The PREPARE of the statement, when it isn't prepared on `conn` yet"""
+        if conn in self._prepared_on:
+            return None
+        return f"PREPARE {self.name} AS {self.query}"
+
+    def execute_query(self, params: tuple) -> str:
+        return f"EXECUTE {self.name}" + (f"({', '.join(['%s'] * len(params))})" if params else "")
+
+    def prepared(self, conn) -> None:
+        with self._lock:
+            self._prepared_on.add(conn)
+            self.prepares += 1
+
+    def executed(self) -> None:
+        with self._lock:
+            self.executions += 1
+
+
+class StatementRegistry(dict):
+    """The PreparedStatements of a set of named queries, like the ones of a queries.toml, by name."""
+
+    def __init__(self, queries: dict):
+        super().__init__({name: PreparedStatement(name, query) for name, query in queries.items()})
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "prepares": statement.prepares,
+                "executions": statement.executions,
+                "reuses": statement.reuses,
+            }
+            for name, statement in self.items()
+        }
+
+
 class PostgresSingletonDB:
     """Borg pattern singleton"""
 
@@ -26,17 +121,393 @@ class PostgresSingletonDB:
 
             self.logger.log.info(f"Connection established to: {self.cur.fetchone()[0]}")
 
-    def execute(self, logger: brazilian_business_partner_api.Logger, query: str) -> DictCursor:
+    def execute(
+        self,
+        logger: brazilian_business_partner_api.Logger,
+        query: str,
+        raise_errors: bool = False,
+    ) -> DictCursor:
         """Logged db query - returns the cursor object so caller can choose fetch method.
         Allowing caller to pass in their own logger.
+        Errors are logged and rolled back, and only raised to the caller if it asks for it.
         """
+        return _execute(self.conn, self.cur, logger, query, raise_errors)
+
+
+class PostgresPooledDB:
+    """One connection checked out of a PostgresConnectionPool, with the same `execute` as PostgresSingletonDB"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cur = conn.cursor(cursor_factory=DictCursor)
+
+    def connect(self):
+        pass
+
+    def execute(
+        self,
+        logger: brazilian_business_partner_api.Logger,
+        query: str,
+        raise_errors: bool = False,
+    ) -> DictCursor:
+        return _execute(self.conn, self.cur, logger, query, raise_errors)
+
+    def execute_prepared(
+        self,
+        logger: brazilian_business_partner_api.Logger,
+        statement: PreparedStatement,
+        params: tuple = (),
+        raise_errors: bool = False,
+    ) -> DictCursor:
+        """Executes the PreparedStatement with `params`, and prepares it first when it isn't prepared on this connection yet."""
+        prepare = statement.prepare_query(self.conn)
+        if prepare:
+            _execute(self.conn, self.cur, logger, prepare, raise_errors=True)
+            statement.prepared(self.conn)
+        statement.executed()
+        return _execute(
+            self.conn, self.cur, logger, statement.execute_query(params), raise_errors, params
+        )
+
+
+class PoolTimeout(Exception):
+    """No connection of the pool became free within the checkout timeout."""
+
+
+@dataclasses.dataclass
+class PoolStats:
+    """
+    What a PostgresConnectionPool did since it was created.
+
+    Attributes:
+        maxconn (int): The most connections that are open at the same time.
+        in_use (int): The connections that are checked out right now.
+        checkouts (int): The connections that were checked out.
+        waits (int): The checkouts that had to wait for a connection to become free.
+        wait_seconds (float): The total seconds the checkouts waited.
+        max_wait_seconds (float): The longest a checkout waited.
+        timeouts (int): The checkouts that gave up waiting, with a PoolTimeout.
+        broken_connections (int): The connections that were found broken, by the health check of a checkout
+            or at the checkin after a failed query, and replaced.
+    """
+
+    maxconn: int
+    in_use: int = 0
+    checkouts: int = 0
+    waits: int = 0
+    wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+    timeouts: int = 0
+    broken_connections: int = 0
+
+    @property
+    def mean_wait_seconds(self) -> float:
+        return self.wait_seconds / self.checkouts if self.checkouts else 0.0
+
+
+class PostgresConnectionPool:
+    """
+    Thread safe pool of connections, for work that runs on more than one connection at a time.
+    A checkout waits (up to `timeout` seconds) while all `maxconn` connections are checked out.
+    A connection that was idle for more than `health_check_interval` seconds is pinged before it is
+    handed out, and replaced when it's broken. A connection that is checked in in a transaction is
+    rolled back, so nothing of one checkout leaks into the next.
+
+    Args:
+        db_configs (dict): The keyword arguments of `psycopg2.connect()`.
+        maxconn (int): The most connections that are open at the same time.
+        minconn (int): The connections that are opened right away.
+        timeout (float): The most seconds a checkout waits for a free connection, None to wait forever.
+        health_check_interval (float): The seconds a connection can be idle before it's pinged on checkout.
+    """
+
+    def __init__(
+        self,
+        db_configs: dict,
+        maxconn: int,
+        minconn: int = 1,
+        timeout: None | float = None,
+        health_check_interval: float = 30.0,
+    ):
+        self.db_configs = db_configs
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.stats = PoolStats(maxconn=maxconn)
+        self._free = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._idle = collections.deque(
+            (psycopg2.connect(**db_configs), time.monotonic()) for _ in range(min(minconn, maxconn))
+        )
+
+    def _healthy(self, conn, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def checkout(self) -> PostgresPooledDB:
+        """Checks a connection out as a PostgresPooledDB, it has to be checked in with `checkin()`."""
+        before = time.monotonic()
+        if not self._free.acquire(blocking=True, timeout=self.timeout):
+            with self._lock:
+                self.stats.timeouts += 1
+            raise PoolTimeout(
+                f"No connection of the pool became free in {self.timeout} seconds, all {self.stats.maxconn} are in use."
+            )
+        waited = time.monotonic() - before
+
+        try:
+            conn = None
+            while conn is None:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, last_used = self._idle.pop()
+                if not self._healthy(conn, last_used):
+                    with self._lock:
+                        self.stats.broken_connections += 1
+                    conn.close()
+                    conn = None
+            if conn is None:
+                conn = psycopg2.connect(**self.db_configs)
+        except Exception:
+            self._free.release()
+            raise
+
+        with self._lock:
+            self.stats.in_use += 1
+            self.stats.checkouts += 1
+            self.stats.wait_seconds += waited
+            self.stats.max_wait_seconds = max(self.stats.max_wait_seconds, waited)
+            if waited > 0.001:
+                self.stats.waits += 1
+        return PostgresPooledDB(conn)
+
+    def checkin(self, db: PostgresPooledDB) -> None:
+        """Puts a connection of `checkout()` back, and rolls back what it left open."""
+        conn = db.conn
+        try:
+            if not conn.closed:
+                db.cur.close()
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+        except psycopg2.Error:
+            conn.close()
+        finally:
+            with self._lock:
+                if conn.closed:
+                    self.stats.broken_connections += 1
+                else:
+                    self._idle.append((conn, time.monotonic()))
+                self.stats.in_use -= 1
+            self._free.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Checks a connection out as a PostgresPooledDB, and puts it back when the block is done."""
+        db = self.checkout()
+        try:
+            yield db
+        finally:
+            self.checkin(db)
+
+    def close(self) -> None:
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+
+async def _wait(conn) -> None:
+    """Waits on the event loop until the asynchronous connection is done with what it's doing."""
+    loop = asyncio.get_running_loop()
+    fileno = conn.fileno()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+
+        ready = loop.create_future()
+        if state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(f"Unexpected state of the connection: {state}")
+
+        add(fileno, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fileno)
+
+
+class AsyncPostgresPooledDB:
+    """
+    One asynchronous connection checked out of an AsyncPostgresConnectionPool.
+    Its `execute` is a coroutine, the event loop runs other requests while the query is in flight.
+    Asynchronous connections are always in autocommit mode, so there's nothing to commit or roll back.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cur = conn.cursor(cursor_factory=DictCursor)
+
+    async def execute(
+        self,
+        logger: brazilian_business_partner_api.Logger,
+        query: str,
+        raise_errors: bool = False,
+        params: None | tuple = None,
+    ) -> DictCursor:
         logger.log.debug(f"Executing DB query: {query}")
         try:
-            self.cur.execute(query)
-            self.conn.commit()
+            self.cur.execute(query, params)
+            await _wait(self.conn)
 
         except (Exception, psycopg2.DatabaseError) as error:
             logger.log.debug("Error: %s" % error)
-            self.conn.rollback()
+            if raise_errors:
+                raise
 
         return self.cur
+
+    async def execute_prepared(
+        self,
+        logger: brazilian_business_partner_api.Logger,
+        statement: PreparedStatement,
+        params: tuple = (),
+        raise_errors: bool = False,
+    ) -> DictCursor:
+        """Executes the PreparedStatement with `params`, and prepares it first when it isn't prepared on this connection yet."""
+        prepare = statement.prepare_query(self.conn)
+        if prepare:
+            await self.execute(logger, prepare, raise_errors=True)
+            statement.prepared(self.conn)
+        statement.executed()
+        return await self.execute(logger, statement.execute_query(params), raise_errors, params)
+
+
+class AsyncPostgresConnectionPool:
+    """
+    Pool of asynchronous connections for the coroutines of one event loop, with the same sizing,
+    checkout timeout, health checks and PoolStats as PostgresConnectionPool.
+    A connection that is checked in while a query is still in flight (because the coroutine was
+    cancelled) is closed, the pool opens a new one when it needs it.
+
+    Args:
+        db_configs (dict): The keyword arguments of `psycopg2.connect()`.
+        maxconn (int): The most connections that are open at the same time.
+        minconn (int): The connections that are opened by `open()`.
+        timeout (float): The most seconds a checkout waits for a free connection, None to wait forever.
+        health_check_interval (float): The seconds a connection can be idle before it's pinged on checkout.
+    """
+
+    def __init__(
+        self,
+        db_configs: dict,
+        maxconn: int,
+        minconn: int = 1,
+        timeout: None | float = None,
+        health_check_interval: float = 30.0,
+    ):
+        self.db_configs = db_configs
+        self.minconn = min(minconn, maxconn)
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.stats = PoolStats(maxconn=maxconn)
+        self._free = asyncio.Semaphore(maxconn)
+        self._idle = collections.deque()
+
+    async def _connect(self):
+        conn = psycopg2.connect(**self.db_configs, async_=1)
+        await _wait(conn)
+        return conn
+
+    async def _healthy(self, conn, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                await _wait(conn)
+            return True
+        except psycopg2.Error:
+            return False
+
+    async def open(self) -> None:
+        """Opens `minconn` connections, so the first requests don't have to."""
+        while len(self._idle) < self.minconn:
+            self._idle.append((await self._connect(), time.monotonic()))
+
+    async def checkout(self) -> AsyncPostgresPooledDB:
+        """Checks a connection out as an AsyncPostgresPooledDB, it has to be checked in with `checkin()`."""
+        before = time.monotonic()
+        try:
+            if self._free.locked():
+                await asyncio.wait_for(self._free.acquire(), self.timeout)
+            else:
+                await self._free.acquire()
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            raise PoolTimeout(
+                f"No connection of the pool became free in {self.timeout} seconds, all {self.stats.maxconn} are in use."
+            )
+        waited = time.monotonic() - before
+
+        try:
+            conn = None
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if await self._healthy(conn, last_used):
+                    break
+                self.stats.broken_connections += 1
+                conn.close()
+                conn = None
+            if conn is None:
+                conn = await self._connect()
+        except BaseException:
+            self._free.release()
+            raise
+
+        self.stats.in_use += 1
+        self.stats.checkouts += 1
+        self.stats.wait_seconds += waited
+        self.stats.max_wait_seconds = max(self.stats.max_wait_seconds, waited)
+        if waited > 0.001:
+            self.stats.waits += 1
+        return AsyncPostgresPooledDB(conn)
+
+    def checkin(self, db: AsyncPostgresPooledDB) -> None:
+        """Puts a connection of `checkout()` back, or closes it when it's broken or still busy."""
+        conn = db.conn
+        if conn.closed:
+            self.stats.broken_connections += 1
+        elif conn.isexecuting():
+            conn.close()
+        else:
+            db.cur.close()
+            self._idle.append((conn, time.monotonic()))
+        self.stats.in_use -= 1
+        self._free.release()
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        """Checks a connection out as an AsyncPostgresPooledDB, and puts it back when the block is done."""
+        db = await self.checkout()
+        try:
+            yield db
+        finally:
+            self.checkin(db)
+
+    def close(self) -> None:
+        while self._idle:
+            self._idle.pop()[0].close()
@@ -0,0 +1,44 @@
+import numpy as np
+
+
+class UnionFind:
+    """
+    Union-find (disjoint sets) of the nodes 0..size-1, with every union and find done on whole arrays
+    of nodes at once, so the edges can be streamed through it chunk by chunk.
+    A root is always the smallest node of its set (the larger root is linked under the smaller one),
+    so the root is a stable id of the set, whatever order the edges came in.
+
+    Args:
+        size (int): The number of nodes.
+    """
+
+    def __init__(self, size: int):
+        self.parent = np.arange(size, dtype=np.int64)
+
+    def find(self, nodes: np.ndarray) -> np.ndarray:
+        """The roots of `nodes`, the paths of `nodes` are compressed to point at their roots"""
+        roots = self.parent[nodes]
+        while True:
+            up = self.parent[roots]
+            if np.array_equal(up, roots):
+                break
+            roots = up
+        self.parent[nodes] = roots
+        return roots
+
+    def union(self, a: np.ndarray, b: np.ndarray) -> None:
+        """Joins the set of every a[i] with the set of b[i]"""
+        while len(a) > 0:
+            roots_a, roots_b = self.find(a), self.find(b)
+            differ = roots_a != roots_b
+            a, b, roots_a, roots_b = a[differ], b[differ], roots_a[differ], roots_b[differ]
+            # a root that is joined with more than one set in this pass gets the smallest of them,
+            # the other pairs are joined in the next pass through it
+            np.minimum.at(self.parent, np.maximum(roots_a, roots_b), np.minimum(roots_a, roots_b))
+
+
+def components(union_find: UnionFind, nodes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """The root of every node of `nodes`, and the number of `nodes` that have the same root"""
+    roots = union_find.find(nodes)
+    _, inverse, counts = np.unique(roots, return_inverse=True, return_counts=True)
+    return roots, counts[inverse]
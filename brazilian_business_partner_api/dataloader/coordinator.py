@@ -29,6 +29,10 @@ class ELTCoordinator:
         csv_file_path: str,
         load_raw_data: bool,
         sample_size: int = 0,
+        load_engine: str = importer.COPY_ENGINE,
+        workers: int = 1,
+        resume: bool = False,
+        incremental: bool = False,
     ):
         """This function does all the logic for loading data
 
@@ -39,6 +43,10 @@ class ELTCoordinator:
             csv_file_path (str) : The full path of the csv file
             load_raw_data (bool): The flag coming from the user to force loading of raw data
             sample_size (int): When doing a sample ingestion, the user provides this as the amount of rows to use
+            load_engine (str): How the stage table is written, either 'copy' (COPY FROM STDIN) or 'insert' (pandas + execute_values)
+            workers (int): The amount of processes (and connections) the file is loaded with
+            resume (bool): Continue a load of the same file from the last chunk it committed, instead of starting over
+            incremental (bool): Apply only the rows that differ between the file and the stage table, instead of reloading it
 
         Returns:
             None
@@ -51,7 +59,7 @@ class ELTCoordinator:
         _importer = importer.Importer(
             csv_file_path, config_file_path, config.DB_CONFIGS
         )
-        _importer.load(load_raw_data, sample_size)
+        _importer.load(load_raw_data, sample_size, load_engine, workers, resume, incremental)
 
     @staticmethod
     def transform(
@@ -60,6 +68,11 @@ class ELTCoordinator:
         config_file_path: pathlib.Path,
         transform_data: bool,
         sample_size: int = 0,
+        resume: bool = False,
+        incremental: bool = False,
+        transform_engine: str = transformer.SINGLE_SCAN_ENGINE,
+        concurrency: int = transformer.DEFAULT_CONCURRENCY,
+        blue_green: bool = False,
     ):
         """This function does all the logic for loading data
 
@@ -69,6 +82,11 @@ class ELTCoordinator:
             config_file_path (Path) : The full path of the config file
             load_data (bool): The flag coming from the user to force transforming of the data
             sample_size (int): When doing a sample ingestion, the user provides this as the amount of rows to use
+            resume (bool): Skip the transformation steps that already finished since the last load
+            incremental (bool): Apply only the changes of the incremental loads to the transformed tables
+            transform_engine (str): How the transformed tables are built, either 'single-scan' (one scan of the stage table into a keyed intermediate) or 'per-table' (one scan per table)
+            concurrency (int): The most transformation steps that run at the same time, each on its own connection
+            blue_green (bool): Build into a shadow schema and swap it in for `transformed` when it's done
 
         Returns:
             None
@@ -78,5 +96,35 @@ class ELTCoordinator:
             f"Executing `braz-bpa-cli dataload` and the ELTCoordinator.transform() method from the python file '{current_path}'..."
         )
 
-        _transformer = transformer.Transformer(config_file_path, config.DB_CONFIGS)
-        _transformer.transform(transform_data, sample_size)
+        _transformer = transformer.Transformer(
+            config_file_path, config.DB_CONFIGS, config.GRAPH_SNAPSHOT_PATH
+        )
+        _transformer.transform(
+            transform_data, sample_size, resume, incremental, transform_engine, concurrency, blue_green
+        )
+
+    @staticmethod
+    def rollback(
+        log_level: str,
+        log_path: str,
+        config_file_path: pathlib.Path,
+    ):
+        """This function makes the previous generation of the transformed data active again
+
+        Args:
+            log_level (str) : log level
+            log_path (str) : log path
+            config_file_path (Path) : The full path of the config file
+
+        Returns:
+            None
+        """
+        current_path = pathlib.Path(__file__).parent.resolve()
+        ELTCoordinator.get_logger().log.info(
+            f"Executing `braz-bpa-cli rollback` and the ELTCoordinator.rollback() method from the python file '{current_path}'..."
+        )
+
+        _transformer = transformer.Transformer(
+            config_file_path, config.DB_CONFIGS, config.GRAPH_SNAPSHOT_PATH
+        )
+        _transformer.rollback()
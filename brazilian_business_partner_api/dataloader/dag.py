@@ -0,0 +1,157 @@
+import concurrent.futures
+import dataclasses
+import datetime
+import functools
+from typing import Callable, NamedTuple
+
+import brazilian_business_partner_api
+from brazilian_business_partner_api.connect import DB, connect
+
+
+class Node(NamedTuple):
+    """
+    One unit of work of a DAG, like building a table or creating an index.
+    `run` is called with a connection of its own, and returns the rows it wrote (or None).
+    """
+
+    name: str
+    run: Callable[[DB], None | int]
+    deps: tuple = ()
+
+
+@dataclasses.dataclass
+class NodeResult:
+    """
+    How one node of a DAG ran.
+
+    Attributes:
+        name (str): The name of the node.
+        deps (tuple): The names of the nodes it waited for.
+        started (float): Seconds since the start of the DAG when the node started.
+        seconds (float): How long the node took.
+        rows (int): The rows the node wrote, None when it doesn't write rows.
+    """
+
+    name: str
+    deps: tuple
+    started: float
+    seconds: float
+    rows: None | int = None
+
+
+class DAGScheduler:
+    """
+    Runs the nodes of a DAG as soon as the nodes they depend on are done, at most `concurrency`
+    at a time, each on its own connection of a pool. When a node fails, no new nodes are started,
+    the running ones are waited for and the error is raised.
+
+    Args:
+        nodes (list): The Nodes, in the order they are preferably started in.
+        pool (connect.PostgresConnectionPool): The pool the connections of the nodes are checked out of.
+        concurrency (int): The most nodes that run at the same time.
+        logger (brazilian_business_partner_api.Logger): Logger with a wrapper.
+    """
+
+    def __init__(
+        self,
+        nodes: list,
+        pool: connect.PostgresConnectionPool,
+        concurrency: int,
+        logger: brazilian_business_partner_api.Logger,
+    ):
+        names = {node.name for node in nodes}
+        for node in nodes:
+            missing = set(node.deps) - names
+            if missing:
+                raise ValueError(f"Node '{node.name}' depends on unknown nodes {sorted(missing)}")
+        self.nodes = nodes
+        self.pool = pool
+        self.concurrency = max(concurrency, 1)
+        self.logger = logger
+
+    def _run_node(self, node: Node, before: datetime.datetime) -> NodeResult:
+        started = datetime.datetime.now()
+        self.logger.log.debug(f"Node '{node.name}' is starting.")
+        with self.pool.connection() as db:
+            rows = node.run(db)
+        return NodeResult(
+            name=node.name,
+            deps=node.deps,
+            started=(started - before).total_seconds(),
+            seconds=(datetime.datetime.now() - started).total_seconds(),
+            rows=rows,
+        )
+
+    def run(
+        self,
+        completed: set = frozenset(),
+        on_done: None | Callable[[NodeResult], None] = None,
+    ) -> list:
+        """
+        Runs every node that isn't in `completed`, and returns their NodeResults in the order
+        they finished. `on_done` is called with every NodeResult, from the calling thread.
+        """
+        before = datetime.datetime.now()
+        done = set(completed)
+        pending = [node for node in self.nodes if node.name not in done]
+        running = {}
+        results = []
+        error = None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while pending or running:
+                if error is None:
+                    for node in [n for n in pending if done.issuperset(n.deps)]:
+                        if len(running) >= self.concurrency:
+                            break
+                        pending.remove(node)
+                        running[executor.submit(self._run_node, node, before)] = node
+
+                if not running:
+                    if error is None:
+                        raise ValueError(
+                            f"Nodes {[n.name for n in pending]} can never run, their dependencies form a cycle"
+                        )
+                    break
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    node = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as node_error:
+                        self.logger.log.error(f"Node '{node.name}' failed. Error: {node_error}")
+                        error = error or node_error
+                        continue
+
+                    done.add(node.name)
+                    results.append(result)
+                    if on_done:
+                        on_done(result)
+
+        if error is not None:
+            raise error
+        return results
+
+
+def critical_path(results: list) -> tuple[list, float]:
+    """
+    The chain of dependent nodes that took the longest in total, and its seconds.
+    Nodes that didn't run (because they were already done) count as 0 seconds.
+    """
+    by_name = {result.name: result for result in results}
+
+    @functools.cache
+    def longest(name: str) -> tuple[tuple, float]:
+        result = by_name.get(name)
+        if result is None:
+            return (), 0.0
+        path, seconds = max(
+            (longest(dep) for dep in result.deps), key=lambda p: p[1], default=((), 0.0)
+        )
+        return path + (name,), seconds + result.seconds
+
+    path, seconds = max((longest(name) for name in by_name), key=lambda p: p[1], default=((), 0.0))
+    return list(path), seconds
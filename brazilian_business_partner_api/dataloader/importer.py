@@ -1,8 +1,12 @@
+import concurrent.futures
 import datetime
+import io
 import logging
+import multiprocessing
 import pathlib
 import sys
 import tomllib as toml
+from typing import NamedTuple
 
 import pandas as pd
 import psycopg2
@@ -10,6 +14,7 @@ import psycopg2.extras as extras
 
 import brazilian_business_partner_api
 from brazilian_business_partner_api.connect import connect
+from brazilian_business_partner_api.dataloader import reconcile, stream
 
 _TOML = toml.load(
     open(str(pathlib.Path(__file__).parent.resolve() / "queries.toml"), "rb")
@@ -20,11 +25,176 @@ COUNT_QUERY = "SELECT COUNT(*) FROM {table}"
 TRUNCATE_QUERY = "TRUNCATE TABLE {table}"
 TABLE_EXISTS_QUERY = _TOML["table_exists"]
 CREATE_STG_TABLE_DDL = _TOML["create_stage_table"]
+COPY_TO_STG_QUERY = _TOML["copy_to_stage"]
+CREATE_LOAD_MANIFEST_DDL = _TOML["create_load_manifest"]
+INSERT_LOAD_MANIFEST_QUERY = _TOML["insert_load_manifest"]
+SELECT_LOAD_MANIFEST_QUERY = _TOML["select_load_manifest"]
+CREATE_TRANSFORM_MANIFEST_DDL = _TOML["create_transform_manifest"]
+CREATE_LOAD_STATUS_DDL = _TOML["create_load_status"]
+START_LOAD_STATUS_QUERY = _TOML["start_load_status"]
+COMPLETE_LOAD_STATUS_QUERY = _TOML["complete_load_status"]
+COUNT_INCOMPLETE_LOAD_STATUS_QUERY = _TOML["count_incomplete_load_status"]
+CREATE_STG_INCOMING_TABLE_DDL = _TOML["create_stage_incoming_table"]
+CREATE_STG_DELTA_TABLE_DDL = _TOML["create_stage_delta_table"]
+DIFF_STG_QUERY = _TOML["diff_stage"]
+COUNT_STG_DELTA_QUERY = _TOML["count_stage_delta"]
+DELETE_STG_DELTA_QUERY = _TOML["delete_stage_delta"]
+INSERT_STG_DELTA_QUERY = _TOML["insert_stage_delta"]
+CREATE_STG_DIFF_TABLE_DDL = _TOML["create_stage_diff_table"]
+APPEND_STG_DELTA_QUERY = _TOML["append_stage_delta"]
 DOT = "."
 DB = "brazilian_business_partner_db"
 STG_SCHEMA = "stage"
 STG_TABLE = "company"
 FQ_STG_TABLE = STG_SCHEMA + DOT + STG_TABLE
+FQ_LOAD_MANIFEST_TABLE = STG_SCHEMA + DOT + "load_manifest"
+FQ_TRANSFORM_MANIFEST_TABLE = STG_SCHEMA + DOT + "transform_manifest"
+FQ_LOAD_STATUS_TABLE = STG_SCHEMA + DOT + "load_status"
+FQ_STG_INCOMING_TABLE = STG_SCHEMA + DOT + "company_incoming"
+FQ_STG_DELTA_TABLE = STG_SCHEMA + DOT + "company_delta"
+STG_DIFF_TABLE = "company_diff"
+STG_COLUMNS = (
+    "nr_cnpj",
+    "nm_fantasia",
+    "sg_uf",
+    "in_cpf_cnpj",
+    "nr_cpf_cnpj_socio",
+    "cd_qualificacao_socio",
+    "ds_qualificacao_socio",
+    "nm_socio",
+)
+INSERT_ENGINE = "insert"
+COPY_ENGINE = "copy"
+LOAD_ENGINES = (INSERT_ENGINE, COPY_ENGINE)
+QUARANTINE_DIR = "{csv_file_path}.quarantine"
+
+
+class LoadSpec(NamedTuple):
+    """Everything needed to load any shard of the CSV, besides the shard itself."""
+
+    csv_file_path: str
+    table: str
+    header: tuple
+    load_engine: str
+    quarantine_dir: str
+    source_id: str
+
+
+_worker_conn = None
+
+
+def _init_load_worker(dbconfigs: dict) -> None:
+    """
+    Runs once in every worker process of a parallel load, so each worker has its own connection.
+    """
+    global _worker_conn
+    _worker_conn = psycopg2.connect(**dbconfigs)
+
+
+def _load_shard_in_worker(spec: LoadSpec, shard: stream.Shard) -> reconcile.ChunkResult:
+    try:
+        return load_shard(_worker_conn, spec, shard)
+    except (Exception, psycopg2.DatabaseError) as error:
+        # psycopg2 errors don't always survive the trip back to the parent process
+        raise RuntimeError(f"Shard {shard.number}: {error}") from None
+
+
+def quarantine_path(quarantine_dir: str, chunknum: int) -> str:
+    pathlib.Path(quarantine_dir).mkdir(parents=True, exist_ok=True)
+    return str(pathlib.Path(quarantine_dir) / f"chunk-{chunknum:05d}.tsv")
+
+
+def _copy_rows(cur, spec: LoadSpec, shard: stream.Shard) -> tuple[int, int]:
+    """
+    Streams the shard with `COPY ... FROM STDIN`. Postgres parses the rows, so there is no
+    DataFrame or list of tuples in between and memory stays at one read buffer.
+    Empty fields are loaded as NULLs, the same as the pandas path does.
+    """
+    columns = ",".join([f'"{c}"' for c in spec.header])
+    with stream.LineStream(spec.csv_file_path, shard.start, shard.end) as reader:
+        cur.copy_expert(
+            COPY_TO_STG_QUERY.format(schematable=spec.table, columns=columns),
+            reader,
+            size=stream.READ_SIZE,
+        )
+        return reader.rows_read, cur.rowcount
+
+
+def _insert_rows(cur, spec: LoadSpec, shard: stream.Shard) -> tuple[int, int]:
+    """
+    Reads the shard with pandas and inserts it in a single statement, so the row count the
+    statement reports is the row count of the whole shard.
+    """
+    chunked_df = pd.read_csv(
+        io.BytesIO(stream.read_shard(spec.csv_file_path, shard)),
+        header=None,
+        names=list(spec.header),
+        sep="\t",
+        dtype=str,
+    )
+
+    # have to reorder df columns just so when 'execute_values()' is called,
+    # force the same ordinal position for 'cols_str' and df columns
+    sorted_col_list = sorted(list(chunked_df.columns))
+
+    # replace default 'NaN' with NULLS to covnert to numpy array of tuples
+    tuples = [
+        tuple(x)
+        for x in chunked_df[sorted_col_list].fillna(psycopg2.extensions.AsIs("NULL")).to_numpy()
+    ]
+
+    # prep insert query
+    cols_str = ",".join([f'"{c}"' for c in sorted_col_list])
+    INSERT_QUERY = "INSERT INTO %s(%s) VALUES %%s" % (spec.table, cols_str)
+
+    extras.execute_values(cur, INSERT_QUERY, tuples, page_size=max(len(tuples), 1))
+    return len(tuples), cur.rowcount
+
+
+def load_shard(conn, spec: LoadSpec, shard: stream.Shard) -> reconcile.ChunkResult:
+    """
+    Loads one byte range of the CSV into the table and records it in the load manifest, in the
+    same transaction. It is only committed if postgres reports as many rows as were read for it.
+    Otherwise it is rolled back and tried again, and after MAX_CHUNK_ATTEMPTS the shard is
+    written to the quarantine directory instead.
+    """
+    result = reconcile.ChunkResult(number=shard.number, start=shard.start, end=shard.end)
+    write_rows = _copy_rows if spec.load_engine == COPY_ENGINE else _insert_rows
+
+    while result.attempts < reconcile.MAX_CHUNK_ATTEMPTS:
+        result.attempts += 1
+        with conn.cursor() as cur:
+            try:
+                rows_read, rows_written = write_rows(cur, spec, shard)
+                if rows_written != rows_read:
+                    raise reconcile.RowCountMismatch(
+                        f"{rows_read:,} rows read but postgres wrote {rows_written:,}"
+                    )
+                cur.execute(
+                    INSERT_LOAD_MANIFEST_QUERY.format(schematable=FQ_LOAD_MANIFEST_TABLE),
+                    (
+                        spec.source_id,
+                        spec.csv_file_path,
+                        shard.number,
+                        shard.start,
+                        shard.end,
+                        rows_written,
+                    ),
+                )
+                conn.commit()
+                result.rows_read = rows_read
+                result.rows_committed = rows_written
+                result.status = reconcile.COMMITTED if result.attempts == 1 else reconcile.RETRIED
+                return result
+
+            except (Exception, psycopg2.DatabaseError) as error:
+                conn.rollback()
+                result.error = str(error).strip()
+
+    result.status = reconcile.QUARANTINED
+    result.quarantine_path = quarantine_path(spec.quarantine_dir, shard.number)
+    result.rows_read = stream.extract_shard(spec.csv_file_path, shard, result.quarantine_path)
+    return result
 
 
 class Importer:
@@ -38,6 +208,8 @@ class Importer:
         config_file_path (Path): The path to the config file.
         csv_file_path(str): The full path of the csv file.
         logger (brazilian_business_partner_api.Logger): Logger with a wrapper.
+        dbconfigs (dict): The connection settings, so parallel workers can open their own connections.
+        quarantine_dir (str): Where chunks that could not be loaded are written to.
         destination_db(brazilian_business_partner_api.DB): An object to hold information about the connection to the destination DB
     """
 
@@ -45,6 +217,8 @@ class Importer:
         self.csv_file_path = csv_file_path
         self.config_path = config_path
         self.logger = brazilian_business_partner_api.Logger(log_name=__name__)
+        self.dbconfigs = dbconfigs
+        self.quarantine_dir = QUARANTINE_DIR.format(csv_file_path=csv_file_path)
         self.destination_db = connect.PostgresSingletonDB(dbconfigs)
 
     def _bootstrap_needed(self, schematable: str) -> bool:
@@ -103,92 +277,321 @@ class Importer:
         self.destination_db.execute(self.logger, TRUNCATE_QUERY.format(table=table))
         self.logger.log.debug(f"Stage table {table} truncated.")
 
-    def _chunked_insert_to_stage(self, table: str, chunksize=None) -> None:
+    def _reconcile(self, report: reconcile.LoadReport) -> bool:
         """
-        Inserts all the data into the stage table from the CSV.
+        The one count of the table for the whole load, checked against the running tally.
         """
-        self._truncate_stage_table(table)
-        self._add_console_log_handler()
-        self.logger.log.info(f"\n\n\n\tInserting rows into {table.upper()}..."
+        table_row_count = self.destination_db.execute(
+            self.logger, COUNT_QUERY.format(table=report.table)
+        ).fetchone()[0]
+        return report.reconcile(self.logger, table_row_count)
+
+    def _log_load_summary(self, table: str, row_count: int, before: datetime.datetime) -> None:
+        after = datetime.datetime.now()
+        time_elapsed = after - before
+        total_seconds = time_elapsed.total_seconds()
+        mins = round(total_seconds // 60)
+        seconds = round(total_seconds % 60, 1)
+        self.logger.log.info(
+            f"\nAll loaded! Total rows inserted into {table.upper()} - {row_count:,}. Elapsed time - {mins} mins and {seconds} seconds."
         )
 
-        if not chunksize:
-            chunksize = self.csv_file_row_count // CHUNKS
+    def _check_columns(self, header: list) -> None:
+        """
+        The columns are loaded in the order they appear in the file, so postgres maps each field to
+        the right column no matter how the file is laid out. They all have to be stage columns though.
+        """
+        unknown_columns = [c for c in header if c not in STG_COLUMNS]
+        if unknown_columns:
+            raise ValueError(
+                f"Columns {unknown_columns} in '{self.csv_file_path}' are not in the stage table {FQ_STG_TABLE.upper()}."
+            )
+
+    def _create_load_tables(self) -> None:
+        """
+        The bookkeeping tables of the load: the manifests, plus the table a new export is loaded
+        into and the table with its differences, for incremental loads.
+        """
+        self.destination_db.execute(
+            self.logger, CREATE_LOAD_MANIFEST_DDL.format(schematable=FQ_LOAD_MANIFEST_TABLE)
+        )
+        self.destination_db.execute(
+            self.logger,
+            CREATE_TRANSFORM_MANIFEST_DDL.format(schematable=FQ_TRANSFORM_MANIFEST_TABLE),
+        )
+        self.destination_db.execute(
+            self.logger, CREATE_LOAD_STATUS_DDL.format(schematable=FQ_LOAD_STATUS_TABLE)
+        )
+        self.destination_db.execute(
+            self.logger,
+            CREATE_STG_INCOMING_TABLE_DDL.format(
+                schematable=FQ_STG_INCOMING_TABLE, like_schematable=FQ_STG_TABLE
+            ),
+        )
+        self.destination_db.execute(
+            self.logger, CREATE_STG_DELTA_TABLE_DDL.format(schematable=FQ_STG_DELTA_TABLE)
+        )
 
-        before = datetime.datetime.now()
-        chunknum = 1
-        prev_destination_db_row_count = 0
-        with pd.read_csv(
-            self.csv_file_path, header=0, sep="\t", dtype=str, chunksize=chunksize
-        ) as reader:
-            for chunked_df in reader:
-
-                # compare row counts for validation when debugging
-                df_num_rows = len(chunked_df.index)
-                inserted_db_rows = 0
-
-                # have to reorder df columns just so when 'execute_values()' is called,
-                # force the same ordinal position for 'cols_str' and df columns
-                sorted_col_list = sorted(list(chunked_df.columns))
-
-                # replace default 'NaN' with NULLS to covnert to numpy array of tuples
-                chunked_df = chunked_df[sorted_col_list].fillna(
-                    psycopg2.extensions.AsIs("NULL")
-                )
-                tuples = [tuple(x) for x in chunked_df.to_numpy()]
+    def _load_incomplete(self, table: str) -> bool:
+        """
+        Whether the last load of `table` started but didn't finish, so what is in the table (the
+        chunks that were committed before it failed) is only part of the file.
+        """
+        return (
+            self.destination_db.execute(
+                self.logger,
+                COUNT_INCOMPLETE_LOAD_STATUS_QUERY.format(
+                    schematable=FQ_LOAD_STATUS_TABLE, table=table
+                ),
+            ).fetchone()[0]
+            > 0
+        )
 
-                # prep insert query
-                cols_str = ",".join([f'"{c}"' for c in sorted_col_list])
-                INSERT_QUERY = "INSERT INTO %s(%s) VALUES %%s" % (table, cols_str)
+    def _set_load_status(self, table: str, completed: bool) -> None:
+        query = COMPLETE_LOAD_STATUS_QUERY if completed else START_LOAD_STATUS_QUERY
+        self.destination_db.execute(
+            self.logger,
+            query.format(schematable=FQ_LOAD_STATUS_TABLE, table=table),
+            raise_errors=True,
+        )
 
-                try:
-                    extras.execute_values(self.destination_db.cur, INSERT_QUERY, tuples)
-                    self.destination_db.conn.commit()
+    def _reset_manifests(self) -> None:
+        """
+        A fresh load of the stage table, so nothing recorded about earlier loads or the
+        transformations of them applies anymore.
+        """
+        self.destination_db.execute(
+            self.logger, TRUNCATE_QUERY.format(table=FQ_LOAD_MANIFEST_TABLE)
+        )
+        self.destination_db.execute(
+            self.logger, TRUNCATE_QUERY.format(table=FQ_TRANSFORM_MANIFEST_TABLE)
+        )
 
-                    full_db_num_rows = self.destination_db.execute(
-                        self.logger, COUNT_QUERY.format(table=table)
-                    ).fetchone()[0]
+    def _committed_chunks(self, source_id: str, shards: list) -> list:
+        """
+        The ChunkResults of the chunks of this same file that a previous run already committed.
+        If the manifest doesn't line up with how the file is split now, nothing is reused.
+        """
+        rows = self.destination_db.execute(
+            self.logger,
+            SELECT_LOAD_MANIFEST_QUERY.format(
+                schematable=FQ_LOAD_MANIFEST_TABLE, source_id=source_id
+            ),
+        ).fetchall()
+        planned = {(s.number, s.start, s.end) for s in shards}
+        if any((r[0], r[1], r[2]) not in planned for r in rows):
+            self.logger.log.warning(
+                f"The load manifest of '{self.csv_file_path}' doesn't match the current chunks, it can't be resumed."
+            )
+            return []
+
+        return [
+            reconcile.ChunkResult(
+                number=r[0],
+                start=r[1],
+                end=r[2],
+                rows_read=r[3],
+                rows_committed=r[3],
+                status=reconcile.RESUMED,
+            )
+            for r in rows
+        ]
 
-                    inserted_db_rows = full_db_num_rows - prev_destination_db_row_count
-                    assert df_num_rows == inserted_db_rows
+    def _load_shards(self, spec: LoadSpec, shards: list, workers: int):
+        """
+        Yields the ChunkResult of every shard as the shards finish. With more than one worker every shard is
+        loaded in a separate process over that process' own connection, otherwise they are loaded
+        one after another over the importer's connection.
+        """
+        if workers <= 1:
+            for shard in shards:
+                yield load_shard(self.destination_db.conn, spec, shard)
+            return
 
-                    prev_destination_db_row_count = full_db_num_rows
-                    pct_done = round(
-                        ((chunknum * chunksize) / self.csv_file_row_count) * 100, 1
-                    )
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_load_worker,
+            initargs=(self.dbconfigs,),
+        ) as executor:
+            futures = {
+                executor.submit(_load_shard_in_worker, spec, shard): shard for shard in shards
+            }
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    yield future.result()
+            except BaseException:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+
+    def _load_to_stage(
+        self, table: str, load_engine: str, workers: int = 1, resume: bool = False
+    ) -> None:
+        """
+        Loads the CSV into the stage table. The file is split into CHUNKS byte-range shards on
+        line boundaries, and every shard is loaded and checkpointed in its own transaction,
+        by `workers` processes at the same time.
 
-                    # Print out every 5%
-                    if CHUNKS >= 100:
-                        if chunknum % ((CHUNKS // 100) * 2) == 0:
-                            self.logger.log.info(
-                                f"Table {table.upper()} --- {pct_done}% loaded..."
-                            )
-                    chunknum += 1
-
-                except AssertionError as error:
-                    self.logger.log.error(
-                        f"""The dataframe is not inserted successfully. DF had {df_num_rows} rows. DBTable inserted {inserted_db_rows} rows.
-                        Exception Thrown: {error}"""
-                    )
-                    self.destination_db.conn.rollback()
+        With `resume`, the shards this file already has in the load manifest are kept and only
+        the rest is loaded. Otherwise (or if there is nothing to resume) the stage table is
+        truncated and the whole file is loaded.
+        """
+        header, data_start = stream.read_header(self.csv_file_path)
+        self._check_columns(header)
+        shards = stream.plan_shards(self.csv_file_path, CHUNKS)
+        total_bytes = (shards[-1].end - data_start) if shards else 0
+        spec = LoadSpec(
+            csv_file_path=self.csv_file_path,
+            table=table,
+            header=tuple(header),
+            load_engine=load_engine,
+            quarantine_dir=self.quarantine_dir,
+            source_id=stream.source_fingerprint(self.csv_file_path),
+        )
+        self.logger.log.debug(
+            f"'{self.csv_file_path}' ({spec.source_id}) split into {len(shards)} shards of ~{total_bytes // max(len(shards), 1):,} bytes."
+        )
 
-                except (Exception, psycopg2.DatabaseError) as error:
-                    self.logger.log.debug("Error: %s" % error)
-                    self.destination_db.conn.rollback()
+        report = reconcile.LoadReport(table)
+        for result in self._committed_chunks(spec.source_id, shards) if resume else []:
+            report.add(result)
+
+        if report.chunks:
+            self.logger.log.info(
+                f"\n\n\n\tResuming the load of {table.upper()}, {len(report.chunks)} of {len(shards)} chunks ({report.rows_committed:,} rows) are already loaded..."
+            )
+        else:
+            if resume:
+                self.logger.log.info(
+                    f"Nothing to resume for '{self.csv_file_path}', loading it from the start."
+                )
+            self._truncate_stage_table(table)
+            self._reset_manifests()
+            if table == FQ_STG_TABLE:
+                # the stage table is loaded from scratch, there is nothing to apply incrementally
+                self._truncate_stage_table(FQ_STG_DELTA_TABLE)
 
-        after = datetime.datetime.now()
-        time_elapsed = after - before
-        total_seconds = time_elapsed.total_seconds()
-        mins = round(total_seconds / 60)
-        seconds = round(total_seconds % 60, 1)
         self.logger.log.info(
-            f"\nAll loaded! Total rows inserted into {table.upper()} - {prev_destination_db_row_count:,}. Elapsed time - {mins} mins and {seconds} seconds."
+            f"\n\n\n\tLoading rows into {table.upper()} with the '{load_engine}' engine and {workers} worker(s)..."
+        )
+        done = {c.number for c in report.chunks}
+        pending = [s for s in shards if s.number not in done]
+        # until the load reconciles, the next run doesn't take the table for loaded
+        self._set_load_status(table, completed=False)
+
+        before = datetime.datetime.now()
+        loaded_bytes = sum(c.end - c.start for c in report.chunks)
+        next_pct_to_log = 5
+        try:
+            for result in self._load_shards(spec, pending, workers):
+                report.add(result)
+                loaded_bytes += result.end - result.start
+                self.logger.log.debug(
+                    f"Shard {result.number} {result.status}, {result.rows_committed:,} rows loaded."
+                )
+
+                pct_done = round((loaded_bytes / total_bytes) * 100, 1)
+                # Print out every 5%
+                if pct_done >= next_pct_to_log:
+                    self.logger.log.info(f"Table {table.upper()} --- {pct_done}% loaded...")
+                    next_pct_to_log = (pct_done // 5 + 1) * 5
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.logger.log.error(
+                f"Loading {table.upper()} failed after {report.rows_committed:,} rows. Error: {error}"
+            )
+            raise
+
+        if not self._reconcile(report):
+            # the table is only part of the file, so it isn't transformed
+            raise reconcile.ReconciliationError(
+                f"The load of {table.upper()} didn't reconcile ({len(report.quarantined)} chunks quarantined, "
+                f"{report.rows_committed:,} of {report.rows_read:,} rows committed). "
+                f"Fix the quarantined chunks and run again with --resume."
+            )
+        self._set_load_status(table, completed=True)
+        self._log_load_summary(table, report.rows_committed, before)
+
+    def _apply_delta_to_stage(self, table: str) -> None:
+        """
+        Diffs the new export in the incoming table against the stage table by the md5 hash of
+        every row (+1 for a new row, -1 for a removed one, duplicate rows count one by one) and
+        applies only those differences to the stage table. They are also appended to the delta table,
+        where they wait for the next incremental transform, so loading twice before transforming is fine.
+        All of it is one transaction, so the stage table and the delta table always agree.
+        The new rows get the current time in `created_datetime`, which makes it the watermark of
+        the load that added them.
+        """
+        cur = self.destination_db.cur
+        tables = dict(
+            stage_table=table,
+            incoming_table=FQ_STG_INCOMING_TABLE,
+            delta_table=STG_DIFF_TABLE,
         )
+        before = datetime.datetime.now()
+        try:
+            cur.execute(
+                CREATE_STG_DIFF_TABLE_DDL.format(
+                    schematable=STG_DIFF_TABLE, like_schematable=FQ_STG_DELTA_TABLE
+                )
+            )
+            cur.execute(DIFF_STG_QUERY.format(**tables))
+            cur.execute(COUNT_STG_DELTA_QUERY.format(**tables))
+            changes = {row[0]: row[1] for row in cur.fetchall()}
+
+            cur.execute(DELETE_STG_DELTA_QUERY.format(**tables))
+            if cur.rowcount != changes.get(-1, 0):
+                raise reconcile.RowCountMismatch(
+                    f"{changes.get(-1, 0):,} rows were removed from the export but {cur.rowcount:,} were deleted"
+                )
+            cur.execute(INSERT_STG_DELTA_QUERY.format(**tables))
+            if cur.rowcount != changes.get(1, 0):
+                raise reconcile.RowCountMismatch(
+                    f"{changes.get(1, 0):,} rows were added to the export but {cur.rowcount:,} were inserted"
+                )
+            cur.execute(
+                APPEND_STG_DELTA_QUERY.format(
+                    delta_table=FQ_STG_DELTA_TABLE, diff_table=STG_DIFF_TABLE
+                )
+            )
+            cur.execute(TRUNCATE_QUERY.format(table=FQ_STG_INCOMING_TABLE))
+            self.destination_db.conn.commit()
 
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.logger.log.error(f"Applying the delta to {table.upper()} failed. Error: {error}")
+            self.destination_db.conn.rollback()
+            raise
+
+        total_seconds = round((datetime.datetime.now() - before).total_seconds(), 1)
         self.logger.log.info(
-            f"\n\n\tTransformations are starting now. Check logs for progress..."
+            f"\nDelta applied to {table.upper()} - {changes.get(1, 0):,} rows inserted, {changes.get(-1, 0):,} rows deleted. Elapsed time - {total_seconds} seconds."
+        )
+
+    def _incremental_load_to_stage(
+        self, table: str, load_engine: str, workers: int = 1, resume: bool = False
+    ) -> None:
+        """
+        Loads the new export next to the stage table instead of over it, then applies only the
+        rows that changed. The transformer picks the same changes up from the delta table.
+        """
+        if resume and self._delta_applied():
+            self.logger.log.info(f"The delta of '{self.csv_file_path}' is already applied.")
+            return
+        self._load_to_stage(FQ_STG_INCOMING_TABLE, load_engine, workers, resume)
+        self._apply_delta_to_stage(table)
+
+    def _delta_applied(self) -> bool:
+        """
+        Whether the run that is resumed loaded every chunk of this file and applied its delta: the
+        delta step empties the incoming table, so the load manifest can't be reconciled with it anymore.
+        """
+        shards = stream.plan_shards(self.csv_file_path, CHUNKS)
+        committed = self._committed_chunks(stream.source_fingerprint(self.csv_file_path), shards)
+        return (
+            len(committed) == len(shards)
+            and not self._load_incomplete(FQ_STG_INCOMING_TABLE)
+            and self._bootstrap_needed(FQ_STG_INCOMING_TABLE)
         )
-        self._turn_off_console_handler()
 
     def _load_api_table(self, table: str) -> None:
         self.logger.log.debug(f"Table {table} populated.")
@@ -199,25 +602,44 @@ class Importer:
         """
         self.source_df = pd.read_csv(csv_file_path, header=0, sep="\t", dtype=str)
 
-    def _count_rows_of_source_file(self) -> None:
-        """
-        Keep the row count in a instance variable
-        """
-        self.logger.log.debug(f"Counting source file rows...")
-        count = 0
-        with open(self.csv_file_path, "r") as fp:
-            count = 0
-            for line in fp:
-                if line != "\n":
-                    count += 1
-        self.csv_file_row_count = count
-        self.logger.log.debug(f"Source file '{self.csv_file_path}' has {count} rows.")
+    def load(
+        self,
+        load_raw_data: bool,
+        sample_size: int = 0,
+        load_engine: str = COPY_ENGINE,
+        workers: int = 1,
+        resume: bool = False,
+        incremental: bool = False,
+    ) -> None:
+        if resume and load_raw_data:
+            raise ValueError("A forced load starts over, it can't resume the previous load.")
+        self._create_load_tables()
+        self._add_console_log_handler()
+        try:
+            stage_incomplete = self._load_incomplete(FQ_STG_TABLE)
+            stage_loaded = not self._bootstrap_needed(FQ_STG_TABLE) and not stage_incomplete
+            if incremental and stage_loaded:
+                self._incremental_load_to_stage(FQ_STG_TABLE, load_engine, workers, resume)
+
+            elif resume:
+                self._load_to_stage(FQ_STG_TABLE, load_engine, workers, resume=True)
+
+            elif not load_raw_data and stage_loaded:
+                self.logger.log.debug(f"Data already loaded. No bootstrap loading needed.")
+                return
+
+            elif stage_incomplete and not load_raw_data:
+                self.logger.log.warning(
+                    f"The last load of the stage table {STG_TABLE} didn't finish, loading it again from the start (or run with --resume to continue it)."
+                )
+                self._load_to_stage(FQ_STG_TABLE, load_engine, workers)
 
-    def load(self, load_raw_data: bool, sample_size: int = 0) -> None:
-        if not load_raw_data and not self._bootstrap_needed(FQ_STG_TABLE):
-            self.logger.log.debug(f"Data already loaded. No bootstrap loading needed.")
-            return
+            else:
+                self.logger.log.debug(f"No data in the stage table {STG_TABLE}.")
+                self._load_to_stage(FQ_STG_TABLE, load_engine, workers)
 
-        self.logger.log.debug(f"No data in the stage table {STG_TABLE}.")
-        self._count_rows_of_source_file()
-        self._chunked_insert_to_stage(FQ_STG_TABLE)
+            self.logger.log.info(
+                f"\n\n\tTransformations are starting now. Check logs for progress..."
+            )
+        finally:
+            self._turn_off_console_handler()
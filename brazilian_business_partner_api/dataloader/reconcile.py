@@ -0,0 +1,116 @@
+import dataclasses
+
+import brazilian_business_partner_api
+
+COMMITTED = "committed"
+RETRIED = "retried"
+QUARANTINED = "quarantined"
+RESUMED = "resumed"
+MAX_CHUNK_ATTEMPTS = 3
+
+
+class RowCountMismatch(Exception):
+    """The row count postgres reported for a chunk is not the amount of rows read for it."""
+
+
+class ReconciliationError(Exception):
+    """A load didn't reconcile: chunks were quarantined, or the rows read, committed and in the table differ."""
+
+
+@dataclasses.dataclass
+class ChunkResult:
+    """
+    What happened to one chunk (a byte-range shard of the CSV) of the load.
+
+    Attributes:
+        number (int): The chunk number, starting at 1.
+        rows_read (int): The rows read from the CSV for this chunk.
+        rows_committed (int): The rows postgres reported for the committed statement.
+        attempts (int): How many times the chunk was tried.
+        status (str): COMMITTED, RETRIED (committed after more than one attempt), QUARANTINED
+            or RESUMED (committed by an earlier run, according to the load manifest).
+        start (int): First byte of the chunk in the CSV, when known.
+        end (int): Byte after the last byte of the chunk in the CSV, when known.
+        error (str): The last error seen for the chunk.
+        quarantine_path (str): Where the rows of a quarantined chunk were written to.
+    """
+
+    number: int
+    rows_read: int = 0
+    rows_committed: int = 0
+    attempts: int = 0
+    status: str = COMMITTED
+    start: None | int = None
+    end: None | int = None
+    error: None | str = None
+    quarantine_path: None | str = None
+
+
+class LoadReport:
+    """
+    Running tally of the chunks of one load, and the reconciliation of it at the end.
+    Adding a chunk is O(1), so nothing has to count the table while the load is going on.
+
+    Args:
+        table (str): The schema qualified table that is loaded.
+    Attributes:
+        table (str): The schema qualified table that is loaded.
+        chunks (list): The ChunkResult of every chunk, in the order they finished.
+        rows_read (int): Running total of rows read from the CSV.
+        rows_committed (int): Running total of rows committed to the table.
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+        self.chunks = []
+        self.rows_read = 0
+        self.rows_committed = 0
+
+    def add(self, result: ChunkResult) -> None:
+        self.chunks.append(result)
+        self.rows_read += result.rows_read
+        self.rows_committed += result.rows_committed
+
+    @property
+    def quarantined(self) -> list:
+        return [c for c in self.chunks if c.status == QUARANTINED]
+
+    @property
+    def resumed(self) -> list:
+        return [c for c in self.chunks if c.status == RESUMED]
+
+    @property
+    def retried(self) -> list:
+        return [c for c in self.chunks if c.status == RETRIED]
+
+    def reconcile(
+        self, logger: brazilian_business_partner_api.Logger, table_row_count: int
+    ) -> bool:
+        """
+        Compares the rows read with the rows committed and with the single count of the table,
+        logs the per-chunk report and returns whether everything read ended up in the table.
+        """
+        for c in sorted(self.chunks, key=lambda c: c.number):
+            logger.log.debug(
+                f"Chunk {c.number}: {c.status}, read {c.rows_read:,}, committed {c.rows_committed:,}, "
+                f"attempts {c.attempts}, bytes [{c.start}, {c.end}), error: {c.error}"
+            )
+
+        for c in self.retried:
+            logger.log.warning(
+                f"Chunk {c.number} of {self.table.upper()} was committed after {c.attempts} attempts. Last error: {c.error}"
+            )
+        for c in self.quarantined:
+            logger.log.error(
+                f"Chunk {c.number} of {self.table.upper()} ({c.rows_read:,} rows) was quarantined to '{c.quarantine_path}'. Error: {c.error}"
+            )
+
+        quarantined_rows = sum(c.rows_read for c in self.quarantined)
+        reconciled = self.rows_read - quarantined_rows == self.rows_committed == table_row_count
+        log = logger.log.info if reconciled and not self.quarantined else logger.log.error
+        log(
+            f"Reconciliation of {self.table.upper()}: {len(self.chunks)} chunks, {self.rows_read:,} rows read, "
+            f"{self.rows_committed:,} rows committed, {table_row_count:,} rows in the table, "
+            f"{len(self.resumed)} chunks resumed, {len(self.retried)} chunks retried, {len(self.quarantined)} chunks ({quarantined_rows:,} rows) quarantined."
+        )
+        return reconciled and not self.quarantined
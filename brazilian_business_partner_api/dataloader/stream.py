@@ -0,0 +1,172 @@
+import hashlib
+import os
+from typing import Callable, NamedTuple
+
+READ_SIZE = 1024 * 1024
+FINGERPRINT_SAMPLE_SIZE = 1024 * 1024
+
+
+class Shard(NamedTuple):
+    """A byte range [start, end) of the raw CSV. Both ends are on line boundaries."""
+
+    number: int
+    start: int
+    end: int
+
+
+def read_header(file_path: str) -> tuple[list, int]:
+    """
+    Column names from the first line of the file, and the byte offset where the data starts.
+    """
+    with open(file_path, "rb") as fp:
+        header_line = fp.readline()
+    header = [c.strip().lower() for c in header_line.decode("utf-8").rstrip("\r\n").split("\t")]
+    return header, len(header_line)
+
+
+def source_fingerprint(file_path: str) -> str:
+    """
+    Identity of the file contents that is cheap to compute on a multi-GB file:
+    a hash of the size, the first MB and the last MB. A different export of the data
+    gets a different fingerprint, a renamed or copied file keeps it.
+    """
+    size = os.path.getsize(file_path)
+    digest = hashlib.sha1(str(size).encode("utf-8"))
+    with open(file_path, "rb") as fp:
+        digest.update(fp.read(FINGERPRINT_SAMPLE_SIZE))
+        fp.seek(max(size - FINGERPRINT_SAMPLE_SIZE, 0))
+        digest.update(fp.read(FINGERPRINT_SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+def read_shard(file_path: str, shard: Shard) -> bytes:
+    """
+    The raw bytes of one shard. Shards are CHUNKS-th of the file, so this is a chunk's worth of memory.
+    """
+    with open(file_path, "rb") as fp:
+        fp.seek(shard.start)
+        return fp.read(shard.end - shard.start)
+
+
+def plan_shards(file_path: str, count: int) -> list[Shard]:
+    """
+    Splits the data part of the file into (at most) `count` byte ranges of about the same size.
+    Every cut is moved forward to the start of the next line, so no row is split between two shards.
+    Rows can't have embedded newlines for this to work, which is true for the Receita Federal file.
+    """
+    _, data_start = read_header(file_path)
+    size = os.path.getsize(file_path)
+    count = max(count, 1)
+
+    boundaries = [data_start]
+    with open(file_path, "rb") as fp:
+        for i in range(1, count):
+            target = data_start + (size - data_start) * i // count
+            # step back one byte, so a cut that is already on a line start stays there
+            fp.seek(max(target - 1, boundaries[-1]))
+            fp.readline()
+            boundary = fp.tell()
+            if boundaries[-1] < boundary < size:
+                boundaries.append(boundary)
+    boundaries.append(size)
+
+    return [
+        Shard(number=i + 1, start=start, end=end)
+        for i, (start, end) in enumerate(zip(boundaries, boundaries[1:]))
+        if end > start
+    ]
+
+
+class LineStream:
+    """
+    Read-only, file-like view over a byte range of the raw CSV that hands out whole lines only.
+    It is what gets passed to `cursor.copy_expert()`, so postgres does the parsing and we never
+    hold more than one read buffer in memory.
+
+    Args:
+        file_path (str): The full path of the csv file.
+        start (int): Byte offset to start reading at. Defaults to the first line after the header.
+        end (int): Byte offset to stop reading at. Defaults to the end of the file.
+        on_progress (Callable): Optional callback, called with the number of bytes consumed so far.
+    Attributes:
+        header (list): The column names from the first line of the file.
+        rows_read (int): The amount of non-blank data lines handed out so far.
+        bytes_read (int): The amount of bytes consumed from the byte range so far.
+        size (int): The size of the byte range.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        start: None | int = None,
+        end: None | int = None,
+        on_progress: None | Callable[[int], None] = None,
+    ):
+        self.file_path = file_path
+        self.on_progress = on_progress
+        self.header, data_start = read_header(file_path)
+        self.start = data_start if start is None else start
+        self.end = os.path.getsize(file_path) if end is None else end
+        self.size = self.end - self.start
+        self.rows_read = 0
+        self.bytes_read = 0
+        self._fp = open(file_path, "rb")
+        self._fp.seek(self.start)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self._fp.close()
+
+    def readline(self, size: int = -1) -> bytes:
+        """
+        Next non-blank line of the byte range, b'' at the end of the range.
+        """
+        while self.bytes_read < self.size:
+            line = self._fp.readline()
+            if not line:
+                return b""
+            self.bytes_read += len(line)
+            if line.strip(b"\r\n"):
+                self.rows_read += 1
+                return line
+        return b""
+
+    def read(self, size: int = READ_SIZE) -> bytes:
+        """
+        Roughly `size` bytes of whole lines, so a row is never split across two reads.
+        """
+        if size is None or size < 0:
+            size = READ_SIZE
+
+        lines = []
+        buffered = 0
+        while buffered < size:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            buffered += len(line)
+
+        if self.on_progress:
+            self.on_progress(self.bytes_read)
+        return b"".join(lines)
+
+
+def extract_shard(file_path: str, shard: Shard, out_path: str) -> int:
+    """
+    Writes the header and the lines of one shard to a file of their own, in the same format as
+    the source, so they can be looked at and loaded again later. Returns the amount of rows written.
+    """
+    with LineStream(file_path, shard.start, shard.end) as reader, open(out_path, "wb") as out:
+        out.write(("\t".join(reader.header) + "\n").encode("utf-8"))
+        while True:
+            lines = reader.read()
+            if not lines:
+                break
+            out.write(lines)
+        return reader.rows_read
@@ -1,8 +1,18 @@
+import datetime
+import functools
+import io
 import pathlib
 import tomllib as toml
+from typing import NamedTuple
+
+import numpy as np
+import psycopg2
 
 import brazilian_business_partner_api
-from brazilian_business_partner_api.connect import connect
+from brazilian_business_partner_api.config import config
+from brazilian_business_partner_api.connect import DB, connect
+from brazilian_business_partner_api.dataloader import components, dag
+from brazilian_business_partner_api.service import graph
 
 _TOML = toml.load(
     open(str(pathlib.Path(__file__).parent.resolve() / "queries.toml"), "rb")
@@ -12,9 +22,12 @@ COUNT_QUERY = "SELECT COUNT(*) FROM {table}"
 TRUNCATE_QUERY = "TRUNCATE TABLE {table}"
 TABLE_EXISTS_QUERY = _TOML["table_exists"]
 DOT = "."
-DB = "brazilian_business_partner_db"
+DB_NAME = "brazilian_business_partner_db"
 STG_SCHEMA = "stage"
 TRANS_SCHEMA = "transformed"
+NEXT_TRANS_SCHEMA = "transformed_next"
+PREVIOUS_TRANS_SCHEMA = "transformed_previous"
+SWAP_TRANS_SCHEMA = "transformed_swap"
 STG_TABLE = "company"
 COMPANY_TABLE = "dim_company"
 XREF_TABLE = "xref_operator_company"
@@ -25,6 +38,24 @@ FQ_COMPANY_TABLE = TRANS_SCHEMA + DOT + COMPANY_TABLE
 FQ_XREF_TABLE = TRANS_SCHEMA + DOT + XREF_TABLE
 FQ_OPERATOR_TABLE = TRANS_SCHEMA + DOT + OPERATOR_TABLE
 FQ_QUAL_TABLE = TRANS_SCHEMA + DOT + QUAL_TABLE
+COMPANY_DICT_TABLE = "dict_company"
+OPERATOR_DICT_TABLE = "dict_operator"
+XREF_ID_TABLE = "xref_operator_company_id"
+OPERATOR_ENTITY_TABLE = "operator_entity"
+FQ_OPERATOR_ENTITY_TABLE = TRANS_SCHEMA + DOT + OPERATOR_ENTITY_TABLE
+COMPANY_COMPONENT_TABLE = "company_component"
+COMPANY_DEGREE_TABLE = "company_degree"
+OPERATOR_DEGREE_TABLE = "operator_degree"
+DEGREE_STATISTICS_TABLE = "degree_statistics"
+DATA_GENERATION_TABLE = "data_generation"
+FQ_DATA_GENERATION_TABLE = TRANS_SCHEMA + DOT + DATA_GENERATION_TABLE
+FQ_DATA_GENERATION_SEQUENCE = STG_SCHEMA + DOT + "data_generation_seq"
+FQ_COMPANY_DICT_TABLE = TRANS_SCHEMA + DOT + COMPANY_DICT_TABLE
+FQ_OPERATOR_DICT_TABLE = TRANS_SCHEMA + DOT + OPERATOR_DICT_TABLE
+FQ_XREF_ID_TABLE = TRANS_SCHEMA + DOT + XREF_ID_TABLE
+FQ_TRANSFORM_MANIFEST_TABLE = STG_SCHEMA + DOT + "transform_manifest"
+FQ_COMPONENT_DELTA_TABLE = STG_SCHEMA + DOT + "component_delta"
+FQ_XREF_ID_DELTA_TABLE = STG_SCHEMA + DOT + "xref_id_delta"
 CREATE_COMPANY_TABLE_DDL = _TOML["create_dim_company"]
 CREATE_COMPANY_INDEX_DDL = _TOML["create_dim_company_index"]
 CREATE_OPERATOR_TABLE_DDL = _TOML["create_dim_operator"]
@@ -34,11 +65,146 @@ CREATE_QUAL_INDEX_DDL = _TOML["create_dim_qualificacao_index"]
 CREATE_XREF_TABLE_DDL = _TOML["create_dim_xref"]
 CREATE_XREF_INDEX1_DDL = _TOML["create_dim_xref1_index"]
 CREATE_XREF_INDEX2_DDL = _TOML["create_dim_xref2_index"]
+CREATE_COMPANY_DICT_TABLE_DDL = _TOML["create_dict_company"]
+CREATE_COMPANY_DICT_INDEX1_DDL = _TOML["create_dict_company1_index"]
+CREATE_COMPANY_DICT_INDEX2_DDL = _TOML["create_dict_company2_index"]
+CREATE_OPERATOR_DICT_TABLE_DDL = _TOML["create_dict_operator"]
+CREATE_OPERATOR_DICT_INDEX1_DDL = _TOML["create_dict_operator1_index"]
+CREATE_OPERATOR_DICT_INDEX2_DDL = _TOML["create_dict_operator2_index"]
+CREATE_XREF_ID_TABLE_DDL = _TOML["create_xref_id"]
+CREATE_XREF_ID_INDEX1_DDL = _TOML["create_xref_id1_index"]
+CREATE_XREF_ID_INDEX2_DDL = _TOML["create_xref_id2_index"]
+CREATE_OPERATOR_ENTITY_TABLE_DDL = _TOML["create_operator_entity"]
+CREATE_OPERATOR_ENTITY_INDEX1_DDL = _TOML["create_operator_entity1_index"]
+CREATE_OPERATOR_ENTITY_INDEX2_DDL = _TOML["create_operator_entity2_index"]
 INSERT_COMPANY_TABLE_QUERY = _TOML["insert_dim_company"]
 INSERT_OPERATOR_TABLE_QUERY = _TOML["insert_dim_operator"]
 INSERT_QUAL_TABLE_QUERY = _TOML["insert_dim_qualificacao"]
 INSERT_XREF_TABLE_QUERY = _TOML["insert_dim_xref"]
+INSERT_COMPANY_DICT_QUERY = _TOML["insert_dict_company"]
+INSERT_OPERATOR_DICT_QUERY = _TOML["insert_dict_operator"]
+REBUILD_XREF_ID_QUERY = _TOML["rebuild_xref_id"]
+CREATE_XREF_ID_DELTA_DDL = _TOML["create_xref_id_delta"]
+APPLY_XREF_ID_DELTA_QUERY = _TOML["apply_xref_id_delta"]
+REBUILD_OPERATOR_ENTITY_QUERY = _TOML["rebuild_operator_entity"]
+VACUUM_ANALYZE_QUERY = _TOML["vacuum_analyze"]
+ANALYZE_QUERY = _TOML["analyze"]
+CREATE_COMPANY_COMPONENT_TABLE_DDL = _TOML["create_company_component"]
+CREATE_COMPANY_COMPONENT_INDEX1_DDL = _TOML["create_company_component1_index"]
+CREATE_COMPANY_COMPONENT_INDEX2_DDL = _TOML["create_company_component2_index"]
+CREATE_COMPONENT_DELTA_DDL = _TOML["create_component_delta"]
+RECORD_COMPONENT_DELTA_QUERY = _TOML["record_component_delta"]
+MAX_IDS_QUERY = _TOML["max_ids"]
+ALL_COMPONENT_COMPANIES_QUERY = _TOML["all_component_companies"]
+AFFECTED_COMPONENT_COMPANIES_QUERY = _TOML["affected_component_companies"]
+COMPONENT_EDGES_QUERY = _TOML["component_edges"]
+COMPONENT_COMPANIES_QUERY = _TOML["component_companies"]
+DELETE_COMPANY_COMPONENTS_QUERY = _TOML["delete_company_components"]
+COPY_COMPANY_COMPONENTS_QUERY = _TOML["copy_company_components"]
+CREATE_COMPANY_DEGREE_TABLE_DDL = _TOML["create_company_degree"]
+CREATE_COMPANY_DEGREE_INDEX_DDL = _TOML["create_company_degree_index"]
+CREATE_OPERATOR_DEGREE_TABLE_DDL = _TOML["create_operator_degree"]
+CREATE_OPERATOR_DEGREE_INDEX_DDL = _TOML["create_operator_degree_index"]
+REBUILD_DEGREE_QUERY = _TOML["rebuild_degree"]
+APPLY_DEGREE_DELTA_QUERY = _TOML["apply_degree_delta"]
+CREATE_DEGREE_STATISTICS_TABLE_DDL = _TOML["create_degree_statistics"]
+REBUILD_DEGREE_STATISTICS_QUERY = _TOML["rebuild_degree_statistics"]
+COMPONENT_EDGES_CHUNK = 1_000_000
+CREATE_DATA_GENERATION_TABLE_DDL = _TOML["create_data_generation"]
+CREATE_DATA_GENERATION_SEQUENCE_DDL = _TOML["create_data_generation_sequence"]
+STAMP_DATA_GENERATION_QUERY = _TOML["stamp_data_generation"]
+ACTIVATE_DATA_GENERATION_QUERY = _TOML["activate_data_generation"]
+GRAPH_EDGES_QUERY = _TOML["graph_edges"]
+GRAPH_COMPANY_KEYS_QUERY = _TOML["graph_company_keys"]
+GRAPH_OPERATOR_KEYS_QUERY = _TOML["graph_operator_keys"]
+GRAPH_GENERATION_QUERY = _TOML["graph_generation"]
+SCHEMA_EXISTS_QUERY = _TOML["schema_exists"]
+CREATE_SCHEMA_DDL = _TOML["create_schema"]
+DROP_SCHEMA_DDL = _TOML["drop_schema"]
+RENAME_SCHEMA_DDL = _TOML["rename_schema"]
 REINDEX_SCHEMA_DDL = _TOML["reindex_schema"]
+CREATE_TRANSFORM_MANIFEST_DDL = _TOML["create_transform_manifest"]
+INSERT_TRANSFORM_MANIFEST_QUERY = _TOML["insert_transform_manifest"]
+SELECT_TRANSFORM_MANIFEST_QUERY = _TOML["select_transform_manifest"]
+DELTA_COMPANY_QUERY = _TOML["delta_dim_company"]
+DELTA_OPERATOR_QUERY = _TOML["delta_dim_operator"]
+DELTA_QUAL_QUERY = _TOML["delta_dim_qualificacao"]
+DELTA_XREF_QUERY = _TOML["delta_dim_xref"]
+APPLY_DIM_DELTA_QUERY = _TOML["apply_dim_delta"]
+FQ_STG_DELTA_TABLE = STG_SCHEMA + DOT + "company_delta"
+FQ_STG_KEYED_TABLE = STG_SCHEMA + DOT + "company_keyed"
+CREATE_STG_KEYED_QUERY = _TOML["create_stage_keyed"]
+DROP_STG_KEYED_QUERY = _TOML["drop_stage_keyed"]
+INSERT_COMPANY_FROM_KEYED_QUERY = _TOML["insert_dim_company_from_keyed"]
+INSERT_OPERATOR_FROM_KEYED_QUERY = _TOML["insert_dim_operator_from_keyed"]
+INSERT_QUAL_FROM_KEYED_QUERY = _TOML["insert_dim_qualificacao_from_keyed"]
+INSERT_XREF_FROM_KEYED_QUERY = _TOML["insert_dim_xref_from_keyed"]
+CREATE_TABLES_STEP = "create tables"
+KEYED_STEP = "build stage keyed"
+SINGLE_SCAN_ENGINE = "single-scan"
+PER_TABLE_ENGINE = "per-table"
+TRANSFORM_ENGINES = (SINGLE_SCAN_ENGINE, PER_TABLE_ENGINE)
+DEFAULT_CONCURRENCY = config.TRANSFORM_CONFIGS["concurrency"]
+COMPANY_KEYS = ("nr_cnpj", "nm_fantasia", "sg_uf")
+OPERATOR_KEYS = ("operator_key", "in_cpf_cnpj", "cd_qualificacao_socio", "nm_socio")
+QUAL_KEYS = ("cd_qualificacao_socio", "ds_qualificacao_socio")
+XREF_KEYS = ("nr_cnpj", "operator_key")
+
+
+def _key_match(keys: tuple) -> str:
+    """
+    The join of a transformed table `t` and its delta `d` on `keys`, which are nullable. The first key
+    is compared with `=` (or both NULL), so the lookup of every delta row is a scan of the unique index
+    the table leads with, and the others with IS NOT DISTINCT FROM.
+    """
+    first, *rest = keys
+    return " AND ".join(
+        [f"(t.{first} = d.{first} OR (t.{first} IS NULL AND d.{first} IS NULL))"]
+        + [f"t.{k} IS NOT DISTINCT FROM d.{k}" for k in rest]
+    )
+
+
+class TransformedTables(NamedTuple):
+    """The schema qualified names of the transformed tables, in `transformed` or in a shadow schema."""
+
+    schema: str
+    company: str
+    operator: str
+    qual: str
+    xref: str
+    company_dict: str
+    operator_dict: str
+    xref_id: str
+    operator_entity: str
+    company_component: str
+    company_degree: str
+    operator_degree: str
+    degree_statistics: str
+    data_generation: str
+
+    @classmethod
+    def in_schema(cls, schema: str) -> "TransformedTables":
+        return cls(
+            schema,
+            *(
+                schema + DOT + table
+                for table in (
+                    COMPANY_TABLE,
+                    OPERATOR_TABLE,
+                    QUAL_TABLE,
+                    XREF_TABLE,
+                    COMPANY_DICT_TABLE,
+                    OPERATOR_DICT_TABLE,
+                    XREF_ID_TABLE,
+                    OPERATOR_ENTITY_TABLE,
+                    COMPANY_COMPONENT_TABLE,
+                    COMPANY_DEGREE_TABLE,
+                    OPERATOR_DEGREE_TABLE,
+                    DEGREE_STATISTICS_TABLE,
+                    DATA_GENERATION_TABLE,
+                )
+            ),
+        )
 
 
 class Transformer:
@@ -47,19 +213,27 @@ class Transformer:
 
     Args:
         config_file_path (Path): The path to the config file.
+        graph_snapshot_path (Path): Where the snapshot of the company graph is written, None to not write one.
     Attributes:
         config_file_path (Path): The path to the config file.
+        dbconfigs (dict): The connection parameters, for the connections of the transformation steps.
+        graph_snapshot_path (Path): Where the snapshot of the company graph is written.
+        tables (TransformedTables): The tables that are written, in `transformed` or in the shadow schema.
         logger (brazilian_business_partner_api.Logger): Logger with a wrapper.
         destination_db(brazilian_business_partner_api.DB): An object to hold information about the connection to the destination DB
     """
 
-    def __init__(self, config_path: pathlib.Path, dbconfigs: dict):
+    def __init__(self, config_path: pathlib.Path, dbconfigs: dict, graph_snapshot_path: None | pathlib.Path = None):
         self.config_path = config_path
+        self.dbconfigs = dbconfigs
+        self.graph_snapshot_path = graph_snapshot_path
+        self.tables = TransformedTables.in_schema(TRANS_SCHEMA)
         self.logger = brazilian_business_partner_api.Logger(log_name=__name__)
         self.destination_db = connect.PostgresSingletonDB(dbconfigs)
 
     def _create_if_table_not_exists(
         self,
+        db: DB,
         schematable: str,
         tableddl: str,
     ):
@@ -70,7 +244,7 @@ class Transformer:
         """
 
         if (
-            self.destination_db.execute(
+            db.execute(
                 self.logger,
                 TABLE_EXISTS_QUERY.format(
                     table=schematable.split(".")[1],
@@ -80,81 +254,763 @@ class Transformer:
             == 0
         ):
 
-            self.destination_db.execute(
+            db.execute(
                 self.logger,
                 tableddl.format(schematable=schematable),
+                raise_errors=True,
             )
 
 
-    def _create_tables(self):
+    def _create_tables(self, db: DB):
         self._create_if_table_not_exists(
-            FQ_COMPANY_TABLE, CREATE_COMPANY_TABLE_DDL
+            db, self.tables.company, CREATE_COMPANY_TABLE_DDL
         )
         self._create_if_table_not_exists(
-            FQ_OPERATOR_TABLE, CREATE_OPERATOR_TABLE_DDL
+            db, self.tables.operator, CREATE_OPERATOR_TABLE_DDL
         )
         self._create_if_table_not_exists(
-            FQ_QUAL_TABLE, CREATE_QUAL_TABLE_DDL
+            db, self.tables.qual, CREATE_QUAL_TABLE_DDL
         )
         self._create_if_table_not_exists(
-            FQ_XREF_TABLE,
+            db,
+            self.tables.xref,
             CREATE_XREF_TABLE_DDL
         )
-
-    def _create_indexes(self):
-        self._create_indexes_on_each_table(
-            FQ_COMPANY_TABLE, CREATE_COMPANY_INDEX_DDL
+        self._create_if_table_not_exists(
+            db, self.tables.company_dict, CREATE_COMPANY_DICT_TABLE_DDL
+        )
+        self._create_if_table_not_exists(
+            db, self.tables.operator_dict, CREATE_OPERATOR_DICT_TABLE_DDL
+        )
+        self._create_if_table_not_exists(
+            db, self.tables.xref_id, CREATE_XREF_ID_TABLE_DDL
+        )
+        self._create_if_table_not_exists(
+            db, self.tables.operator_entity, CREATE_OPERATOR_ENTITY_TABLE_DDL
+        )
+        self._create_if_table_not_exists(
+            db, self.tables.company_component, CREATE_COMPANY_COMPONENT_TABLE_DDL
+        )
+        self._create_if_table_not_exists(
+            db, self.tables.company_degree, CREATE_COMPANY_DEGREE_TABLE_DDL
         )
-        self._create_indexes_on_each_table(
-            FQ_OPERATOR_TABLE, CREATE_OPERATOR_INDEX_DDL
+        self._create_if_table_not_exists(
+            db, self.tables.operator_degree, CREATE_OPERATOR_DEGREE_TABLE_DDL
         )
-        self._create_indexes_on_each_table(
-            FQ_QUAL_TABLE, CREATE_QUAL_INDEX_DDL
+        self._create_if_table_not_exists(
+            db, self.tables.degree_statistics, CREATE_DEGREE_STATISTICS_TABLE_DDL
         )
-        self._create_indexes_on_each_table(
-            FQ_XREF_TABLE,
-            CREATE_XREF_INDEX1_DDL,
-            CREATE_XREF_INDEX2_DDL,
+        self._create_if_table_not_exists(
+            db, self.tables.data_generation, CREATE_DATA_GENERATION_TABLE_DDL
         )
 
-    def _insert_into_table_if_empty(self, schematable: str, insertquery: str):
+    def _index_nodes(self, deps: dict) -> list:
+        """
+        One node per index. `deps` maps a table to the node that writes it, the index waits for it.
+        """
+        return [
+            dag.Node(
+                f"index {schematable}" + (f" ({n})" if len(indexddls) > 1 else ""),
+                functools.partial(self._create_index, schematable=schematable, indexddl=indexddl),
+                (deps[schematable],),
+            )
+            for schematable, *indexddls in (
+                (self.tables.company, CREATE_COMPANY_INDEX_DDL),
+                (self.tables.operator, CREATE_OPERATOR_INDEX_DDL),
+                (self.tables.qual, CREATE_QUAL_INDEX_DDL),
+                (self.tables.xref, CREATE_XREF_INDEX1_DDL, CREATE_XREF_INDEX2_DDL),
+                (self.tables.company_dict, CREATE_COMPANY_DICT_INDEX1_DDL, CREATE_COMPANY_DICT_INDEX2_DDL),
+                (self.tables.operator_dict, CREATE_OPERATOR_DICT_INDEX1_DDL, CREATE_OPERATOR_DICT_INDEX2_DDL),
+                (self.tables.xref_id, CREATE_XREF_ID_INDEX1_DDL, CREATE_XREF_ID_INDEX2_DDL),
+                (self.tables.operator_entity, CREATE_OPERATOR_ENTITY_INDEX1_DDL, CREATE_OPERATOR_ENTITY_INDEX2_DDL),
+                (
+                    self.tables.company_component,
+                    CREATE_COMPANY_COMPONENT_INDEX1_DDL,
+                    CREATE_COMPANY_COMPONENT_INDEX2_DDL,
+                ),
+                (self.tables.company_degree, CREATE_COMPANY_DEGREE_INDEX_DDL),
+                (self.tables.operator_degree, CREATE_OPERATOR_DEGREE_INDEX_DDL),
+            )
+            for n, indexddl in enumerate(indexddls, 1)
+        ]
 
-        if bool(
-            self.destination_db.execute(
+    def _is_empty(self, db: DB, schematable: str) -> bool:
+        return (
+            db.execute(
                 self.logger, COUNT_QUERY.format(table=schematable)
             ).fetchone()[0]
             == 0
-        ):
-            self.logger.log.debug(f"{schematable.upper()} is empty, inserting rows now...")
+        )
 
-            self.destination_db.execute(
+    def _insert_into_table_if_empty(self, db: DB, schematable: str, insertquery: str) -> int:
+        """
+        Returns the amount of rows inserted, 0 when the table already had rows.
+        """
+        if not self._is_empty(db, schematable):
+            return 0
+
+        self.logger.log.debug(f"{schematable.upper()} is empty, inserting rows now...")
+
+        row_count = db.execute(
+            self.logger,
+            insertquery.format(schematable=schematable, keyed_table=FQ_STG_KEYED_TABLE),
+            raise_errors=True,
+        ).rowcount
+
+        self.logger.log.debug(f"Done inserting into {schematable.upper()}. If no errors, it was successful.")
+        return row_count
+
+    def _create_index(self, db: DB, schematable: str, indexddl: str):
+
+        self.logger.log.debug(f"Creating an index on {schematable.upper()}.")
+        db.execute(
+            self.logger,
+            indexddl.format(schematable=schematable),
+            raise_errors=True,
+        )
+
+    def _build_stage_keyed(self, db: DB) -> int:
+        """
+        The one scan of the stage table: its rows grouped by everything the transformed tables need,
+        with the operator key derived once. Every transformed table is then an aggregate of this
+        (smaller) table instead of another scan of stage. It's unlogged, because it's rebuilt from
+        stage when it's lost.
+        """
+        db.execute(
+            self.logger, DROP_STG_KEYED_QUERY.format(schematable=FQ_STG_KEYED_TABLE), raise_errors=True
+        )
+        return db.execute(
+            self.logger,
+            CREATE_STG_KEYED_QUERY.format(schematable=FQ_STG_KEYED_TABLE),
+            raise_errors=True,
+        ).rowcount
+
+    def _drop_stage_keyed(self, db: DB) -> None:
+        db.execute(
+            self.logger, DROP_STG_KEYED_QUERY.format(schematable=FQ_STG_KEYED_TABLE), raise_errors=True
+        )
+
+    def _insert_nodes(self, transform_engine: str) -> list:
+        """
+        The nodes that fill the transformed tables. They only need their own table and their source,
+        so the four of them run at the same time.
+        """
+        if transform_engine == SINGLE_SCAN_ENGINE:
+            source = (KEYED_STEP,)
+            queries = (
+                (self.tables.company, INSERT_COMPANY_FROM_KEYED_QUERY),
+                (self.tables.operator, INSERT_OPERATOR_FROM_KEYED_QUERY),
+                (self.tables.qual, INSERT_QUAL_FROM_KEYED_QUERY),
+                (self.tables.xref, INSERT_XREF_FROM_KEYED_QUERY),
+            )
+        else:
+            source = ()
+            queries = (
+                (self.tables.company, INSERT_COMPANY_TABLE_QUERY),
+                (self.tables.operator, INSERT_OPERATOR_TABLE_QUERY),
+                (self.tables.qual, INSERT_QUAL_TABLE_QUERY),
+                (self.tables.xref, INSERT_XREF_TABLE_QUERY),
+            )
+
+        inserts = [
+            dag.Node(
+                f"insert {schematable}",
+                functools.partial(
+                    self._insert_into_table_if_empty, schematable=schematable, insertquery=insertquery
+                ),
+                (CREATE_TABLES_STEP,) + source,
+            )
+            for schematable, insertquery in queries
+        ]
+        if transform_engine != SINGLE_SCAN_ENGINE:
+            return inserts
+
+        return (
+            [dag.Node(KEYED_STEP, self._build_stage_keyed)]
+            + inserts
+            + [dag.Node("drop stage keyed", self._drop_stage_keyed, tuple(n.name for n in inserts))]
+        )
+
+    def _append_to_dict(self, db: DB, schematable: str, insertquery: str) -> int:
+        """
+        Gives the keys that aren't in the dictionary yet the next integer ids. Ids are never reused
+        or changed, so a dictionary can be appended to by every (incremental) transformation.
+        """
+        return db.execute(
+            self.logger,
+            insertquery.format(
+                schematable=schematable,
+                company_table=self.tables.company,
+                operator_table=self.tables.operator,
+            ),
+            raise_errors=True,
+        ).rowcount
+
+    def _rebuild_xref_id(self, db: DB, incremental: bool = False) -> int:
+        """
+        The company-operator pairs of the xref table, as pairs of integer ids. It's rebuilt in one
+        transaction, so it's never seen half full.
+        `incremental` only replaces the pairs of the companies of the last delta, so the API keeps reading
+        the table while it's updated. Their pairs from before and after are kept in the xref id delta,
+        for the degree steps.
+        """
+        incremental = incremental and not self._is_empty(db, self.tables.xref_id)
+        if incremental:
+            return db.execute(
                 self.logger,
-                insertquery.format(schematable=schematable),
+                ";\n".join(
+                    (
+                        CREATE_XREF_ID_DELTA_DDL.format(schematable=FQ_XREF_ID_DELTA_TABLE),
+                        APPLY_XREF_ID_DELTA_QUERY.format(
+                            schematable=self.tables.xref_id,
+                            xref_id_delta=FQ_XREF_ID_DELTA_TABLE,
+                            company_delta=FQ_COMPONENT_DELTA_TABLE,
+                            xref_table=self.tables.xref,
+                            company_dict=self.tables.company_dict,
+                            operator_dict=self.tables.operator_dict,
+                        ),
+                    )
+                ),
+                raise_errors=True,
+            ).rowcount
+        return db.execute(
+            self.logger,
+            REBUILD_XREF_ID_QUERY.format(
+                schematable=self.tables.xref_id,
+                xref_table=self.tables.xref,
+                company_dict=self.tables.company_dict,
+                operator_dict=self.tables.operator_dict,
+            ),
+            raise_errors=True,
+        ).rowcount
+
+    def _rebuild_operator_entity(self, db: DB) -> int:
+        """
+        One row per operator_key, so the API reads an operator with one index lookup instead of
+        deduplicating the whole operator dimension. When a key has more than one in_cpf_cnpj/nm_socio
+        in the operator dimension, the one with the most stage rows is kept.
+        """
+        return db.execute(
+            self.logger,
+            REBUILD_OPERATOR_ENTITY_QUERY.format(
+                schematable=self.tables.operator_entity,
+                operator_table=self.tables.operator,
+                operator_dict=self.tables.operator_dict,
+            ),
+            raise_errors=True,
+        ).rowcount
+
+    def _rebuild_degree(self, db: DB, schematable: str, node_id: str, incremental: bool = False) -> int:
+        """
+        The degree of every company (its operators) or operator (its companies), from the xref id table.
+        The API reads them to cap the fan-out of the hubs, the operators of tens of thousands of companies,
+        and to tell the client how many there are. It's rebuilt in one transaction, like the xref id table.
+        `incremental` only counts the nodes of the pairs in the xref id delta again.
+        The statistics of the degrees (the mean, 99th percentile and highest) are kept in the degree
+        statistics table, the API estimates the cost of a query with them.
+        """
+        incremental = incremental and not self._is_empty(db, schematable)
+        row_count = db.execute(
+            self.logger,
+            (APPLY_DEGREE_DELTA_QUERY if incremental else REBUILD_DEGREE_QUERY).format(
+                schematable=schematable,
+                node_id=node_id,
+                xref_id=self.tables.xref_id,
+                xref_id_delta=FQ_XREF_ID_DELTA_TABLE,
+            ),
+            raise_errors=True,
+        ).rowcount
+        count, mean_degree, p99_degree, max_degree = db.execute(
+            self.logger,
+            REBUILD_DEGREE_STATISTICS_QUERY.format(
+                schematable=self.tables.degree_statistics,
+                kind=node_id.removesuffix("_id"),
+                degree_table=schematable,
+            ),
+            raise_errors=True,
+        ).fetchone()
+        self.logger.log.info(
+            f"{schematable.upper()}: {count:,} nodes, the mean degree is {mean_degree:,.2f},"
+            f" the 99th percentile {p99_degree:,} and the highest {max_degree:,}."
+        )
+        return row_count
+
+    def _degree_nodes(self, incremental: bool = False) -> list:
+        return [
+            dag.Node(
+                f"insert {schematable}",
+                functools.partial(
+                    self._rebuild_degree, schematable=schematable, node_id=node_id, incremental=incremental
+                ),
+                (f"insert {self.tables.xref_id}",),
+            )
+            for schematable, node_id in (
+                (self.tables.company_degree, "company_id"),
+                (self.tables.operator_degree, "operator_id"),
+            )
+        ]
+
+    def _build_company_components(self, db: DB, incremental: bool = False) -> int:
+        """
+        The connected component of every company in the company-operator graph: the smallest company_id
+        in it (its component_id) and how many companies are in it. The edges of the xref id table are
+        streamed through a union-find of the company and operator ids, a chunk at a time.
+        `incremental` only computes the companies of the components the companies of the last delta were
+        in, or are connected to now, again: a change can only merge or split those components.
+        The old components are replaced in one transaction.
+        """
+        incremental = incremental and not self._is_empty(db, self.tables.company_component)
+        max_company_id, max_operator_id = db.execute(
+            self.logger,
+            MAX_IDS_QUERY.format(company_dict=self.tables.company_dict, operator_dict=self.tables.operator_dict),
+            raise_errors=True,
+        ).fetchone()
+        # the operators are the nodes after the companies
+        union_find = components.UnionFind(max_company_id + max_operator_id + 2)
+        operator_offset = max_company_id + 1
+
+        with db.conn.cursor() as cur:
+            cur.execute(CREATE_COMPONENT_DELTA_DDL.format(schematable=FQ_COMPONENT_DELTA_TABLE))
+            cur.execute(
+                (AFFECTED_COMPONENT_COMPANIES_QUERY if incremental else ALL_COMPONENT_COMPANIES_QUERY).format(
+                    schematable=self.tables.company_component,
+                    component_delta=FQ_COMPONENT_DELTA_TABLE,
+                    company_dict=self.tables.company_dict,
+                    xref_id=self.tables.xref_id,
+                )
             )
+            with db.conn.cursor(name="component_edges") as edges:
+                edges.itersize = COMPONENT_EDGES_CHUNK
+                edges.execute(COMPONENT_EDGES_QUERY.format(xref_id=self.tables.xref_id))
+                while rows := edges.fetchmany(COMPONENT_EDGES_CHUNK):
+                    pairs = np.array(rows, dtype=np.int64)
+                    union_find.union(pairs[:, 0], pairs[:, 1] + operator_offset)
 
-            self.logger.log.debug(f"Done inserting into {schematable.upper()}. If no errors, it was successful.")
+            cur.execute(COMPONENT_COMPANIES_QUERY)
+            company_ids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+            roots, sizes = components.components(union_find, company_ids)
+            buffer = io.StringIO()
+            np.savetxt(buffer, np.column_stack((company_ids, roots, sizes)), fmt="%d", delimiter="\t")
+            buffer.seek(0)
 
-    def _create_indexes_on_each_table(self, schematable: str, indexddl: str, index2ddl: None | str = None):
+            if incremental:
+                cur.execute(DELETE_COMPANY_COMPONENTS_QUERY.format(schematable=self.tables.company_component))
+            else:
+                cur.execute(TRUNCATE_QUERY.format(table=self.tables.company_component))
+            cur.copy_expert(COPY_COMPANY_COMPONENTS_QUERY.format(schematable=self.tables.company_component), buffer)
+            cur.execute(TRUNCATE_QUERY.format(table=FQ_COMPONENT_DELTA_TABLE))
+        db.conn.commit()
 
-        self.logger.log.debug(f"Creating indexes on {schematable.upper()}.")
+        self.logger.log.debug(
+            f"Computed the components of {len(company_ids):,} companies"
+            + (" (incrementally)." if incremental else ".")
+        )
+        return len(company_ids)
+
+    def _component_node(self, incremental: bool) -> dag.Node:
+        return dag.Node(
+            f"insert {self.tables.company_component}",
+            functools.partial(self._build_company_components, incremental=incremental),
+            (f"insert {self.tables.xref_id}",),
+        )
+
+    def _vacuum_analyze(self, db: DB) -> None:
+        """
+        Sets the visibility map of the tables the API looks up by index, so lookups on their covering
+        indexes are index-only scans, and gives the planner the statistics of every table.
+        VACUUM can't run in a transaction, and can only mark rows visible to every open snapshot,
+        so it's the last node of the DAG.
+        """
+        db.conn.autocommit = True
+        try:
+            for schematable in (
+                self.tables.company_dict,
+                self.tables.xref_id,
+                self.tables.operator_entity,
+                self.tables.company_component,
+                self.tables.company_degree,
+                self.tables.operator_degree,
+            ):
+                db.execute(
+                    self.logger, VACUUM_ANALYZE_QUERY.format(schematable=schematable), raise_errors=True
+                )
+            for schematable in (self.tables.company, self.tables.operator, self.tables.qual, self.tables.xref):
+                db.execute(
+                    self.logger, ANALYZE_QUERY.format(schematable=schematable), raise_errors=True
+                )
+        finally:
+            db.conn.autocommit = False
+
+    def _stamp_generation(self, db: DB, activate: bool = True) -> None:
+        """
+        Gives the data that was just built the next data generation number. The API hands it out,
+        so caches and clients know when the data changed. With blue/green it's activated at the swap.
+        """
+        db.execute(
+            self.logger,
+            CREATE_DATA_GENERATION_SEQUENCE_DDL.format(sequence=FQ_DATA_GENERATION_SEQUENCE),
+            raise_errors=True,
+        )
+        db.execute(
+            self.logger,
+            STAMP_DATA_GENERATION_QUERY.format(
+                schematable=self.tables.data_generation,
+                sequence=FQ_DATA_GENERATION_SEQUENCE,
+                activated_at="now()" if activate else "NULL",
+            ),
+            raise_errors=True,
+        )
+
+    def _write_graph_snapshot(self, db: DB) -> int:
+        """
+        Writes the company graph of the tables (the adjacency of the integer ids and their keys) with the
+        data generation they are stamped with, for the API to map instead of reading it from the database.
+        """
+        company_graph = graph.CompanyGraph.from_database(
+            db.conn,
+            graph.GraphQueries(
+                edges=GRAPH_EDGES_QUERY.format(schematable=self.tables.xref_id),
+                company_keys=GRAPH_COMPANY_KEYS_QUERY.format(schematable=self.tables.company_dict),
+                operator_keys=GRAPH_OPERATOR_KEYS_QUERY.format(schematable=self.tables.operator_dict),
+                generation=GRAPH_GENERATION_QUERY.format(schematable=self.tables.data_generation),
+            ),
+        )
+        db.conn.rollback()
+        company_graph.save(self.graph_snapshot_path)
+        return company_graph.edges
+
+    def _surrogate_key_nodes(
+        self, company_dep: str, operator_dep: str, xref_dep: str, incremental: bool = False
+    ) -> list:
+        """
+        The integer keyed model the API joins on: a company_id per nr_cnpj, an operator_id per
+        operator_key, the xref as (company_id, operator_id) and the operator entity table.
+        The deps are the nodes that write the company, operator and xref tables, `incremental` only
+        updates the xref id pairs of the companies of the last delta.
+        """
+        company_dict = dag.Node(
+            f"insert {self.tables.company_dict}",
+            functools.partial(
+                self._append_to_dict,
+                schematable=self.tables.company_dict,
+                insertquery=INSERT_COMPANY_DICT_QUERY,
+            ),
+            (company_dep,),
+        )
+        operator_dict = dag.Node(
+            f"insert {self.tables.operator_dict}",
+            functools.partial(
+                self._append_to_dict,
+                schematable=self.tables.operator_dict,
+                insertquery=INSERT_OPERATOR_DICT_QUERY,
+            ),
+            (operator_dep,),
+        )
+        xref_id = dag.Node(
+            f"insert {self.tables.xref_id}",
+            functools.partial(self._rebuild_xref_id, incremental=incremental),
+            tuple(dict.fromkeys((company_dict.name, operator_dict.name, xref_dep))),
+        )
+        operator_entity = dag.Node(
+            f"insert {self.tables.operator_entity}",
+            self._rebuild_operator_entity,
+            tuple(dict.fromkeys((operator_dict.name, operator_dep))),
+        )
+        return [company_dict, operator_dict, xref_id, operator_entity]
+
+    def _apply_stage_delta(self, db: DB) -> None:
+        """
+        Adds the row counts of the stage delta (+1 per inserted stage row, -1 per deleted one) to the
+        transformed tables, inserts the keys that are new and deletes the keys no row is left for.
+        All four tables and the emptying of the delta are one transaction, so a delta is applied once.
+        The companies of the delta are kept in the component delta, for the xref id and components steps.
+        """
+        queries = [
+            APPLY_DIM_DELTA_QUERY.format(
+                schematable=schematable,
+                delta_table=f"{schematable.split(DOT)[1]}_delta",
+                keys=", ".join(keys),
+                key_match=_key_match(keys),
+                delta_query=deltaquery,
+            )
+            for schematable, deltaquery, keys in (
+                (self.tables.company, DELTA_COMPANY_QUERY, COMPANY_KEYS),
+                (self.tables.operator, DELTA_OPERATOR_QUERY, OPERATOR_KEYS),
+                (self.tables.qual, DELTA_QUAL_QUERY, QUAL_KEYS),
+                (self.tables.xref, DELTA_XREF_QUERY, XREF_KEYS),
+            )
+        ]
+        # the companies whose components have to be computed again
+        queries.append(CREATE_COMPONENT_DELTA_DDL.format(schematable=FQ_COMPONENT_DELTA_TABLE))
+        queries.append(RECORD_COMPONENT_DELTA_QUERY.format(schematable=FQ_COMPONENT_DELTA_TABLE))
+        queries.append(TRUNCATE_QUERY.format(table=FQ_STG_DELTA_TABLE))
+
+        self.logger.log.debug(f"Applying {FQ_STG_DELTA_TABLE.upper()} to the transformed tables.")
+        db.execute(self.logger, ";\n".join(queries), raise_errors=True)
+
+    def _clear_stage_delta(self, db: DB) -> None:
+        """
+        The transformed tables are rebuilt from the whole stage table, so the delta is already in them.
+        """
+        db.execute(
+            self.logger, TRUNCATE_QUERY.format(table=FQ_STG_DELTA_TABLE), raise_errors=True
+        )
+
+    def _transformed_tables_populated(self) -> bool:
+        for schematable in (self.tables.company, self.tables.operator, self.tables.qual, self.tables.xref):
+            schema, table = schematable.split(".")
+            if (
+                self.destination_db.execute(
+                    self.logger, TABLE_EXISTS_QUERY.format(table=table, schema=schema)
+                ).fetchone()[0]
+                == 0
+                or self._is_empty(self.destination_db, schematable)
+            ):
+                return False
+        return True
+
+    def _nodes(
+        self,
+        incremental: bool = False,
+        transform_engine: str = SINGLE_SCAN_ENGINE,
+        blue_green: bool = False,
+    ) -> list:
+        """
+        The whole transformation as a DAG: a list of dag.Node, each with the nodes it has to wait for.
+        A node is what gets checkpointed in the transform manifest once it finishes.
+
+        With `incremental`, and transformed tables to apply it to, only the stage delta of the last
+        incremental load is applied. Without transformed tables, they are built from the whole stage table,
+        in one scan of it with the 'single-scan' engine or in one scan per table with 'per-table'.
+        A `blue_green` build always builds from the whole stage table.
+        """
+        create_tables = dag.Node(CREATE_TABLES_STEP, self._create_tables)
+
+        if incremental and not blue_green and self._transformed_tables_populated():
+            apply_delta = dag.Node("apply stage delta", self._apply_stage_delta, (CREATE_TABLES_STEP,))
+            writers = {
+                schematable: apply_delta.name
+                for schematable in (self.tables.company, self.tables.operator, self.tables.qual, self.tables.xref)
+            }
+            key_nodes = self._surrogate_key_nodes(
+                apply_delta.name, apply_delta.name, apply_delta.name, incremental=True
+            )
+            key_nodes.append(self._component_node(incremental=True))
+            key_nodes.extend(self._degree_nodes(incremental=True))
+            writers.update({node.name.removeprefix("insert "): node.name for node in key_nodes})
+            nodes = [create_tables, apply_delta] + key_nodes + self._index_nodes(writers)
+            return self._with_final_nodes(nodes, blue_green)
+
+        insert_nodes = self._insert_nodes(transform_engine)
+        key_nodes = self._surrogate_key_nodes(
+            f"insert {self.tables.company}", f"insert {self.tables.operator}", f"insert {self.tables.xref}"
+        )
+        key_nodes.append(self._component_node(incremental=False))
+        key_nodes.extend(self._degree_nodes())
+        writers = {
+            node.name.removeprefix("insert "): node.name
+            for node in insert_nodes + key_nodes
+            if node.name.startswith("insert ")
+        }
+        nodes = [create_tables] + insert_nodes + key_nodes + self._index_nodes(writers)
+        if incremental:
+            nodes.append(
+                dag.Node(
+                    "clear stage delta",
+                    self._clear_stage_delta,
+                    tuple(n.name for n in insert_nodes if n.name.startswith("insert ")),
+                )
+            )
+        return self._with_final_nodes(nodes, blue_green)
+
+    def _with_final_nodes(self, nodes: list, blue_green: bool) -> list:
+        vacuum = dag.Node("vacuum", self._vacuum_analyze, tuple(n.name for n in nodes))
+        stamp = dag.Node(
+            "stamp data generation",
+            functools.partial(self._stamp_generation, activate=not blue_green),
+            (vacuum.name,),
+        )
+        nodes = nodes + [vacuum, stamp]
+        if self.graph_snapshot_path is not None:
+            nodes.append(dag.Node("write graph snapshot", self._write_graph_snapshot, (stamp.name,)))
+        return nodes
+
+    def _completed_steps(self) -> set:
+        return {
+            row[0]
+            for row in self.destination_db.execute(
+                self.logger,
+                SELECT_TRANSFORM_MANIFEST_QUERY.format(schematable=FQ_TRANSFORM_MANIFEST_TABLE),
+            ).fetchall()
+        }
+
+    def _checkpoint(self, step: str) -> None:
         self.destination_db.execute(
             self.logger,
-            indexddl.format(schematable=schematable),
+            INSERT_TRANSFORM_MANIFEST_QUERY.format(
+                schematable=FQ_TRANSFORM_MANIFEST_TABLE, step=step
+            ),
+            raise_errors=True,
+        )
+
+    def _on_node_done(self, result: dag.NodeResult) -> None:
+        self._checkpoint(result.name)
+        self.logger.log.debug(
+            f"Transform step '{result.name}' done in {round(result.seconds, 1)} seconds"
+            + ("." if result.rows is None else f", {result.rows:,} rows.")
+        )
+
+    def _log_step_summary(self, results: list, before: datetime.datetime) -> None:
+        total_seconds = round((datetime.datetime.now() - before).total_seconds(), 1)
+        summary = "\n".join(
+            f"\t{r.name:<50} start {r.started:>8.1f}s  took {r.seconds:>8.1f}s  {'' if r.rows is None else f'{r.rows:,} rows'}"
+            for r in sorted(results, key=lambda r: r.started)
+        )
+        path, path_seconds = dag.critical_path(results)
+        self.logger.log.info(
+            f"Transformation done in {total_seconds} seconds:\n{summary}\n"
+            f"Critical path ({round(path_seconds, 1)} seconds): {' -> '.join(path)}"
         )
 
-        if index2ddl:
+    def _schema_exists(self, schema: str) -> bool:
+        return (
             self.destination_db.execute(
-                self.logger,
-                index2ddl.format(schematable=schematable),
+                self.logger, SCHEMA_EXISTS_QUERY.format(schema=schema)
+            ).fetchone()[0]
+            > 0
+        )
+
+    def _swap_schemas(self, renames: list, schema: str, drop: None | str = None) -> None:
+        """
+        Drops the schema `drop`, renames the schemas in `renames` (pairs of old and new names) and
+        activates the data generation that ends up in `schema`, all in one transaction. The API resolves
+        `transformed.*` on every query, so it sees either all of the old tables or all of the new ones.
+        """
+        self.destination_db.execute(
+            self.logger,
+            ";\n".join(
+                ([DROP_SCHEMA_DDL.format(schema=drop)] if drop else [])
+                + [RENAME_SCHEMA_DDL.format(schema=old, new_schema=new) for old, new in renames]
+                + [
+                    ACTIVATE_DATA_GENERATION_QUERY.format(
+                        schematable=TransformedTables.in_schema(schema).data_generation
+                    )
+                ]
+            ),
+            raise_errors=True,
+        )
+
+    def _swap_in_next(self) -> None:
+        """
+        Makes the shadow schema `transformed`, and keeps the generation it replaces as
+        `transformed_previous` for a rollback. The generation before that is dropped.
+        """
+        renames = [(NEXT_TRANS_SCHEMA, TRANS_SCHEMA)]
+        if self._schema_exists(TRANS_SCHEMA):
+            renames.insert(0, (TRANS_SCHEMA, PREVIOUS_TRANS_SCHEMA))
+        self._swap_schemas(renames, TRANS_SCHEMA, drop=PREVIOUS_TRANS_SCHEMA)
+        self.logger.log.info(
+            f"Swapped {NEXT_TRANS_SCHEMA.upper()} in as {TRANS_SCHEMA.upper()}, the data it replaced is kept in {PREVIOUS_TRANS_SCHEMA.upper()}."
+        )
+
+    def rollback(self) -> None:
+        """
+        Swaps `transformed` and `transformed_previous`, so the previous generation of the data is active
+        again. Rolling back twice rolls forward again.
+        """
+        if not self._schema_exists(PREVIOUS_TRANS_SCHEMA):
+            raise Exception(f"There is no previous generation in {PREVIOUS_TRANS_SCHEMA.upper()} to roll back to.")
+
+        self._swap_schemas(
+            [
+                (TRANS_SCHEMA, SWAP_TRANS_SCHEMA),
+                (PREVIOUS_TRANS_SCHEMA, TRANS_SCHEMA),
+                (SWAP_TRANS_SCHEMA, PREVIOUS_TRANS_SCHEMA),
+            ],
+            TRANS_SCHEMA,
+        )
+        self.logger.log.info(
+            f"Rolled back, {TRANS_SCHEMA.upper()} is the previous generation now and {PREVIOUS_TRANS_SCHEMA.upper()} the one it replaced."
+        )
+        if self.graph_snapshot_path is not None:
+            self._write_graph_snapshot(self.destination_db)
+
+    def transform(
+        self,
+        transform_data: bool,
+        sample_size: int = 0,
+        resume: bool = False,
+        incremental: bool = False,
+        transform_engine: str = SINGLE_SCAN_ENGINE,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        blue_green: bool = False,
+    ) -> None:
+        """
+        Runs the transformation steps as a DAG, up to `concurrency` at a time, each on its own
+        connection. With `resume`, the steps the transform manifest says are already done
+        (since the stage table was last loaded) are skipped.
+        With `incremental`, only the changes of the last incremental load are applied.
+        With `blue_green`, everything is built (and indexed and analyzed) in the shadow schema
+        `transformed_next` while the API keeps reading `transformed`, and the two are swapped at the end.
+        A step that fails stops the transformation, and isn't checkpointed.
+        How long every step took, the rows it wrote and the critical path are logged at the end.
+        """
+        self.destination_db.execute(
+            self.logger,
+            CREATE_TRANSFORM_MANIFEST_DDL.format(schematable=FQ_TRANSFORM_MANIFEST_TABLE),
+        )
+        if resume:
+            completed = self._completed_steps()
+        else:
+            completed = set()
+            self.destination_db.execute(
+                self.logger, TRUNCATE_QUERY.format(table=FQ_TRANSFORM_MANIFEST_TABLE)
+            )
+
+        if blue_green:
+            self.tables = TransformedTables.in_schema(NEXT_TRANS_SCHEMA)
+            if resume and not self._schema_exists(NEXT_TRANS_SCHEMA):
+                # the steps in the manifest were done in a shadow schema that was swapped in already
+                completed = set()
+            if not resume:
+                self.destination_db.execute(
+                    self.logger, DROP_SCHEMA_DDL.format(schema=NEXT_TRANS_SCHEMA), raise_errors=True
+                )
+            self.destination_db.execute(
+                self.logger, CREATE_SCHEMA_DDL.format(schema=NEXT_TRANS_SCHEMA), raise_errors=True
             )
 
-    def _insert_into_tables(self):
-        self._insert_into_table_if_empty(FQ_COMPANY_TABLE, INSERT_COMPANY_TABLE_QUERY)
-        self._insert_into_table_if_empty(FQ_OPERATOR_TABLE, INSERT_OPERATOR_TABLE_QUERY)
-        self._insert_into_table_if_empty(FQ_QUAL_TABLE, INSERT_QUAL_TABLE_QUERY)
-        self._insert_into_table_if_empty(FQ_XREF_TABLE, INSERT_XREF_TABLE_QUERY)
+        nodes = self._nodes(incremental, transform_engine, blue_green)
+        pending = {node.name for node in nodes} - completed
+        if KEYED_STEP in completed and pending & {
+            f"insert {schematable}"
+            for schematable in (self.tables.company, self.tables.operator, self.tables.qual, self.tables.xref)
+        }:
+            # the keyed table is unlogged, so it can be gone (or empty) since it was built
+            completed.discard(KEYED_STEP)
+        for node in nodes:
+            if node.name in completed:
+                self.logger.log.info(f"Transform step '{node.name}' is already done, skipping it.")
 
-    def transform(self, transform_data: bool, sample_size: int = 0) -> None:
-        self._create_tables()
-        self._insert_into_tables()
-        self._create_indexes()
+        pool = connect.PostgresConnectionPool(self.dbconfigs, maxconn=concurrency)
+        before = datetime.datetime.now()
+        try:
+            results = dag.DAGScheduler(nodes, pool, concurrency, self.logger).run(
+                completed, on_done=self._on_node_done
+            )
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.logger.log.error(
+                f"The transformation failed, rerun with --resume to continue from the failed steps. Error: {error}"
+            )
+            raise
+        finally:
+            pool.close()
+
+        self._log_step_summary(results, before)
+
+        if blue_green:
+            self._swap_in_next()
+            self.destination_db.execute(
+                self.logger, TRUNCATE_QUERY.format(table=FQ_TRANSFORM_MANIFEST_TABLE)
+            )
+            self.tables = TransformedTables.in_schema(TRANS_SCHEMA)
@@ -1,6 +1,69 @@
+import dataclasses
+
 import fastapi
 
+import brazilian_business_partner_api
+from brazilian_business_partner_api.config import config
+from brazilian_business_partner_api.connect import connect
+from brazilian_business_partner_api.service import context, documents
 from brazilian_business_partner_api.service.controller import company
+from brazilian_business_partner_api.service.model import company as model
+
+logger = brazilian_business_partner_api.Logger(__name__)
+HEALTH_CHECK_QUERY = connect.PreparedStatement("health_check", "SELECT 1")
 
 app = fastapi.FastAPI()
 app.include_router(company.company_router)
+
+
+@app.get("/health")
+async def health(request: fastapi.Request, response: fastapi.Response) -> dict:
+    """Checks a connection out of the pool and pings the database, and reports the statistics of the pool, the prepared statements, the cache, the document cache and the company graph"""
+    request_context = context.request_context(request)
+    try:
+        await request_context.fetchone(HEALTH_CHECK_QUERY)
+        database = "ok"
+    except Exception as e:
+        logger.log.error(f"The health check failed: {e}")
+        response.status_code = 503
+        database = str(e)
+    finally:
+        request_context.release()
+
+    return {
+        "database": database,
+        "pool": dataclasses.asdict(context.POOL.stats)
+        | {"mean_wait_seconds": context.POOL.stats.mean_wait_seconds},
+        "statements": model.STATEMENTS.stats(),
+        "cache": dataclasses.asdict(model.CACHE.stats) | {"generation": model.CACHE.generation},
+        "documents": dataclasses.asdict(documents.DOCUMENTS.stats)
+        | {"persisted_queries": len(documents.PERSISTED_QUERIES)},
+        "graph": None
+        if model.GRAPH.graph is None
+        else {
+            "generation": model.GRAPH.graph.generation,
+            "source": model.GRAPH.graph.source,
+            "companies": model.GRAPH.graph.companies,
+            "operators": model.GRAPH.graph.operators,
+            "edges": model.GRAPH.graph.edges,
+            "bytes": model.GRAPH.graph.nbytes,
+        },
+    }
+
+
+@app.on_event("startup")
+async def open_pool() -> None:
+    if isinstance(context.POOL, connect.AsyncPostgresConnectionPool):
+        await context.POOL.open()
+
+
+@app.on_event("startup")
+def load_graph() -> None:
+    # a worker forked by AppRunner has the graph its parent preloaded
+    if config.GRAPH_CONFIGS["enabled"] and model.GRAPH.graph is None:
+        model.GRAPH.reload()
+
+
+@app.on_event("shutdown")
+def close_pool() -> None:
+    context.POOL.close()
@@ -1,36 +1,304 @@
+import os
 import pathlib
+import signal
+import socket
+import sys
+import time
+
 import uvicorn
 
 import brazilian_business_partner_api
-from brazilian_business_partner_api.service import app
-from brazilian_business_partner_api.connect import connect
+from brazilian_business_partner_api.config import config
+
+# Module constants
+APP = "brazilian_business_partner_api.service.app:app"
+LOG_CONFIG = str(pathlib.Path(__file__).parent.parent / "config/log.ini")
+SUPERVISE_INTERVAL = 0.5
+# a worker that exits sooner than FAST_EXIT_SECONDS after it started failed at startup: the next one is started
+# after a delay that doubles with every such exit in a row, up to MAX_RESPAWN_DELAY, and the API stops after
+# MAX_FAST_EXITS of them (the workers that were started together and exit together count once)
+FAST_EXIT_SECONDS = 5.0
+MAX_RESPAWN_DELAY = 30.0
+MAX_FAST_EXITS = 8
+
+
+class _WorkerServer(uvicorn.Server):
+    """The uvicorn server of a worker process, it stops (gracefully) when its parent process is gone"""
+
+    def __init__(self, config: uvicorn.Config, parent_pid: int):
+        super().__init__(config)
+        self.parent_pid = parent_pid
+
+    async def on_tick(self, counter: int) -> bool:
+        if os.getppid() != self.parent_pid:
+            self.should_exit = True
+        return await super().on_tick(counter)
 
 
 class AppRunner:
-    def __init__(self, config_file_path: str, log_path: str = None):
-        if log_path:
-            self.log_path = log_path
-        self.url = "127.0.0.1"
-        self.port = 8000
+    """
+    Serves the API with uvicorn. With one worker the server runs in this process. With more, this process is the
+    parent of the workers: it binds the socket, loads the app once (the config, the prepared statements, the
+    persisted queries and the company graph) and forks the workers, which share the socket and, copy-on-write,
+    what was loaded. A worker that dies is replaced, after a growing delay when workers keep exiting right after
+    they start, and the API stops when MAX_FAST_EXITS of them in a row do. On SIGTERM/SIGINT the workers stop
+    accepting connections and finish their requests, for at most `drain_timeout` seconds, before they exit. On
+    SIGHUP the graph is loaded again and new workers are forked before the old ones are drained, so a restart
+    doesn't drop connections.
+
+    Args:
+        config_file_path (str): The config file, the process is started again with it when it isn't the one
+            that was loaded.
+        log_path (str): The log file.
+        host (str): The address the API listens on, `host` of the [server] config when it's None.
+        port (int): The port the API listens on, `port` of the [server] config when it's None.
+        workers (int): The worker processes, 0 for one per core, `workers` of the [server] config when it's None.
+        keep_alive (int): The seconds an idle keep-alive connection is kept open.
+        backlog (int): The most connections that wait to be accepted.
+        drain_timeout (float): The seconds a worker gets to finish its requests when it's stopped.
+    """
+
+    def __init__(
+        self,
+        config_file_path: str,
+        log_path: str = None,
+        host: str = None,
+        port: int = None,
+        workers: int = None,
+        keep_alive: int = None,
+        backlog: int = None,
+        drain_timeout: float = None,
+    ):
+        self.config_file_path = config_file_path
+        self.log_path = log_path
+        server_configs = config.SERVER_CONFIGS
+        self.url = host if host is not None else server_configs["host"]
+        self.port = port if port is not None else server_configs["port"]
+        workers = workers if workers is not None else server_configs["workers"]
+        self.workers = workers or os.cpu_count() or 1
+        self.keep_alive = keep_alive if keep_alive is not None else server_configs["keep_alive"]
+        self.backlog = backlog if backlog is not None else server_configs["backlog"]
+        self.drain_timeout = (
+            drain_timeout if drain_timeout is not None else server_configs["drain_timeout"]
+        )
         self.logger = (
             brazilian_business_partner_api.Logger(log_name=__name__, log_path=self.log_path)
             if log_path
             else brazilian_business_partner_api.Logger(log_name=__name__)
         )
-        self.subprocess_cmd = [
-            "uvicorn",
-            "app:app",
-            "--host",
-            self.url,
-            "--port",
-            self.port,
-        ]
+        self._workers = {}
+        self._stopping = False
+        self._restarting = False
+        self._fast_exits = 0
+        self._last_fast_exit = float("-inf")
+        self._respawn_at = 0.0
 
     def run(self):
-        self.logger.log.debug("Starting the uvicorn server...")
-        uvicorn.run(
-            "brazilian_business_partner_api.service.app:app",
-            host=self.url,
-            port=self.port,
-            log_config=str(pathlib.Path(__file__).parent.parent / "config/log.ini"),
+        self._use_config_file()
+        if self.workers == 1:
+            self.logger.log.debug("Starting the uvicorn server...")
+            uvicorn.run(
+                APP,
+                host=self.url,
+                port=self.port,
+                timeout_keep_alive=self.keep_alive,
+                backlog=self.backlog,
+                log_config=LOG_CONFIG,
+            )
+        else:
+            self._serve_workers()
+
+    def _use_config_file(self) -> None:
+        """Starts this process again with the config file of the command, when it isn't the one that was loaded"""
+        if self.config_file_path is None:
+            return
+        config_file_path = pathlib.Path(self.config_file_path).resolve()
+        if config_file_path == config.CONFIG_FILE_PATH.resolve():
+            return
+        self.logger.log.info(f"Starting again with the config file {config_file_path}...")
+        os.environ[config.CONFIG_PATH_ENV] = str(config_file_path)
+        os.execv(sys.executable, [sys.executable, *sys.orig_argv[1:]])
+
+    def _bind(self) -> socket.socket:
+        family = socket.AF_INET6 if ":" in self.url else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.url, self.port))
+        sock.listen(self.backlog)
+        sock.set_inheritable(True)
+        return sock
+
+    def _preload(self):
+        """Loads the app in this process, the workers that are forked share it"""
+        from brazilian_business_partner_api.service import app, context
+
+        self._preload_graph()
+        # a connection can't be shared by processes, every worker opens its own
+        context.POOL.close()
+        return app.app
+
+    def _preload_graph(self) -> None:
+        from brazilian_business_partner_api.service.model import company as model
+
+        if config.GRAPH_CONFIGS["enabled"]:
+            before = time.monotonic()
+            model.GRAPH.reload()
+            model.GRAPH.wait()
+            if model.GRAPH.graph is not None:
+                self.logger.log.info(
+                    f"Preloaded the company graph of generation {model.GRAPH.graph.generation} "
+                    f"in {time.monotonic() - before:.2f} seconds."
+                )
+
+    def _serve_workers(self) -> None:
+        sock = self._bind()
+        app = self._preload()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._restart)
+        self.logger.log.info(
+            f"Serving the API on {self.url}:{self.port} with {self.workers} workers (parent process {os.getpid()})..."
         )
+        try:
+            while not self._stopping:
+                if self._restarting:
+                    self._restarting = False
+                    self._restart_workers(sock, app)
+                self._reap()
+                while (
+                    len(self._workers) < self.workers
+                    and not self._stopping
+                    and time.monotonic() >= self._respawn_at
+                ):
+                    self._spawn(sock, app)
+                time.sleep(SUPERVISE_INTERVAL)
+        finally:
+            self.logger.log.info(f"Stopping the {len(self._workers)} workers...")
+            self._drain(list(self._workers))
+            sock.close()
+        if self._fast_exits >= MAX_FAST_EXITS:
+            raise Exception(
+                f"The workers exited right after they started {self._fast_exits} times in a row"
+            )
+
+    def _stop(self, signum, frame) -> None:
+        self._stopping = True
+
+    def _restart(self, signum, frame) -> None:
+        self._restarting = True
+
+    def _spawn(self, sock: socket.socket, app) -> int:
+        parent_pid = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                # the terminal's Ctrl-C goes to the parent, which drains the workers
+                os.setpgid(0, 0)
+                for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                    signal.signal(signum, signal.SIG_DFL)
+                server = _WorkerServer(
+                    uvicorn.Config(
+                        app,
+                        timeout_keep_alive=self.keep_alive,
+                        backlog=self.backlog,
+                        log_config=LOG_CONFIG,
+                    ),
+                    parent_pid,
+                )
+                server.run(sockets=[sock])
+            except BaseException as e:
+                self.logger.log.error(f"The worker {os.getpid()} failed: {e}")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        self._workers[pid] = time.monotonic()
+        self.logger.log.debug(f"Started the worker {pid}.")
+        return pid
+
+    def _reap(self) -> None:
+        """Forgets the workers that exited, and delays the next ones (or stops) when they exit at startup"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self._workers.pop(pid, None)
+            if started is None or self._stopping:
+                continue
+            now = time.monotonic()
+            exit_code = os.waitstatus_to_exitcode(status)
+            if now - started >= FAST_EXIT_SECONDS:
+                self._fast_exits = 0
+                self.logger.log.warning(
+                    f"The worker {pid} exited with {exit_code}, starting another one."
+                )
+                continue
+
+            if started < self._last_fast_exit:
+                # started before the last fast exit, it failed like the workers that were started with it
+                self.logger.log.warning(
+                    f"The worker {pid} exited with {exit_code} {now - started:.1f} seconds after it started."
+                )
+                continue
+            self._fast_exits += 1
+            self._last_fast_exit = now
+            if self._fast_exits >= MAX_FAST_EXITS:
+                self.logger.log.error(
+                    f"The worker {pid} exited with {exit_code} {now - started:.1f} seconds after it started, "
+                    f"workers did {self._fast_exits} times in a row, stopping."
+                )
+                self._stopping = True
+                return
+            delay = min(SUPERVISE_INTERVAL * 2**self._fast_exits, MAX_RESPAWN_DELAY)
+            self._respawn_at = now + delay
+            self.logger.log.warning(
+                f"The worker {pid} exited with {exit_code} {now - started:.1f} seconds after it started, "
+                f"starting another one in {delay:.1f} seconds."
+            )
+
+    def _restart_workers(self, sock: socket.socket, app) -> None:
+        """Forks new workers (with the graph of the current generation), then drains the old ones"""
+        self.logger.log.info("Restarting the workers...")
+        self._preload_graph()
+        old_workers = list(self._workers)
+        self._workers = {}
+        for _ in range(self.workers):
+            self._spawn(sock, app)
+        self._drain(old_workers)
+
+    def _drain(self, pids: list) -> None:
+        """Stops the workers `pids`: they finish their requests, and are killed after drain_timeout seconds"""
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        pending = set(pids)
+        deadline = time.monotonic() + self.drain_timeout
+        while pending and time.monotonic() < deadline:
+            for pid in list(pending):
+                try:
+                    exited, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    exited = pid
+                if exited:
+                    pending.discard(pid)
+                    self._workers.pop(pid, None)
+            if pending:
+                time.sleep(0.1)
+
+        for pid in pending:
+            self.logger.log.warning(
+                f"The worker {pid} didn't finish in {self.drain_timeout} seconds, killing it."
+            )
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            self._workers.pop(pid, None)
@@ -0,0 +1,124 @@
+import collections
+import dataclasses
+import sys
+import threading
+import time
+from typing import Any, Hashable
+
+
+@dataclasses.dataclass
+class CacheStats:
+    """
+    What a ResultCache did since it was created.
+
+    Attributes:
+        max_bytes (int): The most bytes the cached results can take.
+        bytes (int): The bytes the cached results take right now (estimated).
+        entries (int): The results that are cached right now.
+        hits (int): The lookups that were answered from the cache.
+        misses (int): The lookups that had to go to the database.
+        evictions (int): The results that were dropped, least recently used first, to stay under max_bytes.
+        expirations (int): The results that were dropped because they were older than the TTL.
+        invalidations (int): The results that were dropped because the data generation changed.
+    """
+
+    max_bytes: int
+    bytes: int = 0
+    entries: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+
+def _sizeof(value: Any) -> int:
+    """The estimated bytes of a result, which is made of tuples and lists of str, int, datetime and None"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(_sizeof(item) for item in value)
+    return size
+
+
+class ResultCache:
+    """
+    Thread safe LRU cache of query results, bounded by the bytes of the results and with a TTL.
+    The results are cached per data generation: when `set_generation()` sees a new generation
+    (after a transform) every cached result is dropped at once, and results that were loaded
+    for an older generation aren't cached anymore.
+
+    Args:
+        max_bytes (int): The most bytes the cached results can take.
+        ttl_seconds (float): How long a result is cached.
+        generation_check_interval (float): How often (in seconds) the data generation has to be checked.
+    Attributes:
+        generation (int): The data generation the cached results are of.
+        stats (CacheStats): The counters of the cache.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float, generation_check_interval: float = 1.0):
+        self.ttl_seconds = ttl_seconds
+        self.generation_check_interval = generation_check_interval
+        self.generation = None
+        self.stats = CacheStats(max_bytes=max_bytes)
+        self._generation_checked_at = None
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def generation_expired(self) -> bool:
+        """Whether the data generation has to be checked again"""
+        return (
+            self._generation_checked_at is None
+            or time.monotonic() - self._generation_checked_at >= self.generation_check_interval
+        )
+
+    def set_generation(self, generation: None | int) -> None:
+        with self._lock:
+            self._generation_checked_at = time.monotonic()
+            if generation != self.generation:
+                self.stats.invalidations += len(self._entries)
+                self._entries.clear()
+                self.stats.entries = self.stats.bytes = 0
+                self.generation = generation
+
+    def get(self, field: str, generation: None | int, key: Hashable) -> tuple[bool, Any]:
+        """Whether the result of `key` for `field` is cached, and the result"""
+        with self._lock:
+            entry = self._entries.get((generation, field, key))
+            if entry is not None and entry[2] <= time.monotonic():
+                self._drop((generation, field, key))
+                self.stats.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.stats.misses += 1
+                return False, None
+
+            self._entries.move_to_end((generation, field, key))
+            self.stats.hits += 1
+            return True, entry[0]
+
+    def put(self, field: str, generation: None | int, key: Hashable, value: Any) -> None:
+        """Caches the result of `key` for `field`, unless it was loaded for an older generation or is too big"""
+        size = _sizeof(value)
+        with self._lock:
+            if generation != self.generation or size > self.stats.max_bytes:
+                return
+
+            self._drop((generation, field, key))
+            self._entries[(generation, field, key)] = (
+                value,
+                size,
+                time.monotonic() + self.ttl_seconds,
+            )
+            self.stats.entries += 1
+            self.stats.bytes += size
+            while self.stats.bytes > self.stats.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.stats.evictions += 1
+
+    def _drop(self, key: tuple) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.stats.entries -= 1
+            self.stats.bytes -= entry[1]
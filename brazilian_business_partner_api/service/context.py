@@ -0,0 +1,158 @@
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.websockets import WebSocket
+from strawberry.dataloader import DataLoader
+from strawberry.extensions import Extension
+
+import brazilian_business_partner_api
+from brazilian_business_partner_api.config import config
+from brazilian_business_partner_api.connect import connect
+
+POOL = (
+    connect.AsyncPostgresConnectionPool(config.DB_CONFIGS, **config.DB_POOL_CONFIGS)
+    if config.API_CONFIGS["async_db"]
+    else connect.PostgresConnectionPool(config.DB_CONFIGS, **config.DB_POOL_CONFIGS)
+)
+logger = brazilian_business_partner_api.Logger(__name__)
+
+
+class RequestContext:
+    """
+    The context of one GraphQL request, with the blocking (sync) database path. The first resolver that
+    needs the database checks a connection out of the pool, every other resolver of the request uses the
+    same one, one query at a time, and it goes back to the pool when the request ends (see ReleaseConnection).
+    Nothing is shared with other requests. The queries run in the threadpool, so a request that waits
+    for a connection or a query doesn't block the event loop.
+    It also counts the companies and operators the traversal fields of the request returned, and
+    collects the lists that were cut short, for the client (see ReportTruncations).
+
+    Args:
+        request (Request): The HTTP request or websocket.
+        response (Response): The response the GraphQL result is written to.
+        pool (connect.PostgresConnectionPool): The pool the connection is checked out of.
+        max_visited (int): The most companies and operators the traversal fields of the request return together.
+    Attributes:
+        visited (int): The companies and operators the traversal fields returned so far.
+        truncations (list): The lists that were cut short: their path, why, and how long they are and were returned.
+    """
+
+    def __init__(
+        self,
+        request: Request | WebSocket,
+        response: Optional[Response] = None,
+        pool: connect.PostgresConnectionPool = POOL,
+        max_visited: int = config.GRAPH_CONFIGS["max_visited"],
+    ):
+        self.request = request
+        self.response = response
+        self.pool = pool
+        self.max_visited = max_visited
+        self.visited = 0
+        self.truncations = []
+        self._db = None
+        self._lock = asyncio.Lock()
+        self._loaders = {}
+
+    @property
+    def db(self) -> connect.PostgresPooledDB:
+        if self._db is None:
+            self._db = self.pool.checkout()
+        return self._db
+
+    def loader(self, load_fn: Callable[["RequestContext", list], Awaitable[list]]) -> DataLoader:
+        """
+        The DataLoader of `load_fn` for this request. The keys that are loaded in the same tick of the
+        event loop (like the ones of all the parents of a nested field) are loaded with one call of
+        `load_fn`, and a key is only loaded once per request.
+        """
+        if load_fn not in self._loaders:
+            self._loaders[load_fn] = DataLoader(load_fn=functools.partial(load_fn, self))
+        return self._loaders[load_fn]
+
+    def visit(self, count: int) -> int:
+        """How many of `count` more companies or operators the request may still return, they are counted as visited"""
+        count = max(0, min(count, self.max_visited - self.visited))
+        self.visited += count
+        return count
+
+    def truncated(self, path: list, reason: str, total: Optional[int], returned: int) -> None:
+        """Records that the list at `path` was cut short for `reason`, `total` is how long it is (None when it's unknown)"""
+        self.truncations.append(
+            {"path": path, "reason": reason, "total": total, "returned": returned}
+        )
+
+    def _fetch(self, statement: connect.PreparedStatement, params: tuple, fetch: str):
+        return getattr(
+            self.db.execute_prepared(logger, statement, params, raise_errors=True), fetch
+        )()
+
+    async def fetchone(self, statement: connect.PreparedStatement, *params) -> Optional[tuple]:
+        async with self._lock:
+            return await run_in_threadpool(self._fetch, statement, params, "fetchone")
+
+    async def fetchall(self, statement: connect.PreparedStatement, *params) -> list:
+        async with self._lock:
+            return await run_in_threadpool(self._fetch, statement, params, "fetchall")
+
+    def release(self) -> None:
+        if self._db is not None:
+            self.pool.checkin(self._db)
+            self._db = None
+
+
+class AsyncRequestContext(RequestContext):
+    """
+    The context of one GraphQL request, with the asynchronous database path. Every query checks an
+    asynchronous connection out for just that query, so the resolvers of a request that run at the
+    same time (and the other requests of the worker) all have their queries in flight together.
+
+    Args:
+        request (Request): The HTTP request or websocket.
+        response (Response): The response the GraphQL result is written to.
+        pool (connect.AsyncPostgresConnectionPool): The pool the connections are checked out of.
+    """
+
+    async def fetchone(self, statement: connect.PreparedStatement, *params) -> Optional[tuple]:
+        async with self.pool.connection() as db:
+            return (
+                await db.execute_prepared(logger, statement, params, raise_errors=True)
+            ).fetchone()
+
+    async def fetchall(self, statement: connect.PreparedStatement, *params) -> list:
+        async with self.pool.connection() as db:
+            return (
+                await db.execute_prepared(logger, statement, params, raise_errors=True)
+            ).fetchall()
+
+
+def request_context(
+    request: Request | WebSocket, response: Optional[Response] = None
+) -> RequestContext:
+    """The context of a request, for the database path `async_db` in the [api] section of the config selects."""
+    if config.API_CONFIGS["async_db"]:
+        return AsyncRequestContext(request, response)
+    return RequestContext(request, response)
+
+
+class ReleaseConnection(Extension):
+    """Puts the connection of a RequestContext back in the pool when the GraphQL request ends, also when it failed."""
+
+    def on_request_end(self) -> None:
+        context: Any = self.execution_context.context
+        if isinstance(context, RequestContext):
+            context.release()
+
+
+class ReportTruncations(Extension):
+    """Adds the lists that were cut short (by a limit, a hub or the visited budget) to the extensions of the response, as `truncated`."""
+
+    def get_results(self) -> dict:
+        context: Any = self.execution_context.context
+        if isinstance(context, RequestContext) and context.truncations:
+            return {"truncated": context.truncations}
+        return {}
@@ -1,10 +1,115 @@
+import json
+import urllib.parse
+from typing import Any, Optional, Union
+
 import strawberry
 from fastapi import APIRouter
+from starlette import status
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.websockets import WebSocket
 from strawberry.asgi import GraphQL
+from strawberry.asgi.handlers import HTTPHandler
 
+import brazilian_business_partner_api
+from brazilian_business_partner_api.service import context, cost, documents
 from brazilian_business_partner_api.service.model import company
 
+logger = brazilian_business_partner_api.Logger(__name__)
+
+
+class PersistedQueryHTTPHandler(HTTPHandler):
+    """
+    Runs persisted queries: a request with the sha256 of a document in `extensions.persistedQuery.sha256Hash`
+    (and no `query`) runs the document of the registry, and with `persisted_queries_only` a document that isn't
+    in the registry doesn't run at all.
+    """
+
+    async def get_http_response(self, request: Request, *args, **kwargs) -> Response:
+        try:
+            request = await self._with_persisted_query(request)
+        except documents.PersistedQueryError as e:
+            logger.log.warning(f"Refused a persisted query: {e} ({e.code})")
+            return JSONResponse(
+                {"errors": [{"message": str(e), "extensions": {"code": e.code}}]},
+                status_code=status.HTTP_200_OK
+                if e.code == documents.PERSISTED_QUERY_NOT_FOUND
+                else status.HTTP_400_BAD_REQUEST,
+            )
+        return await super().get_http_response(request, *args, **kwargs)
+
+    @staticmethod
+    def _persisted_query_hash(extensions: Any) -> Optional[str]:
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except json.JSONDecodeError:
+                return None
+        if not isinstance(extensions, dict) or not isinstance(
+            extensions.get("persistedQuery"), dict
+        ):
+            return None
+        return extensions["persistedQuery"].get("sha256Hash")
+
+    async def _with_persisted_query(self, request: Request) -> Request:
+        """The request with the document of its persisted query, the same request when it sent the document"""
+        if request.method == "GET" and request.query_params:
+            params = dict(request.query_params)
+            query = documents.PERSISTED_QUERIES.resolve(
+                params.get("query"), self._persisted_query_hash(params.get("extensions"))
+            )
+            if query is None or query == params.get("query"):
+                return request
+            scope = dict(
+                request.scope,
+                query_string=urllib.parse.urlencode(params | {"query": query}).encode(),
+            )
+            return Request(scope, request.receive)
+
+        if request.method == "POST" and "application/json" in request.headers.get(
+            "Content-Type", ""
+        ):
+            try:
+                data = await request.json()
+            except json.JSONDecodeError:
+                # the handler answers it
+                return request
+            if not isinstance(data, dict):
+                return request
+            query = documents.PERSISTED_QUERIES.resolve(
+                data.get("query"), self._persisted_query_hash(data.get("extensions"))
+            )
+            if query is None or query == data.get("query"):
+                return request
+            body = json.dumps(data | {"query": query}).encode()
+
+            async def receive() -> dict:
+                return {"type": "http.request", "body": body, "more_body": False}
+
+            return Request(request.scope, receive)
+        return request
+
+
+class CompanyGraphQL(GraphQL):
+    http_handler_class = PersistedQueryHTTPHandler
+
+    async def get_context(
+        self,
+        request: Union[Request, WebSocket],
+        response: Optional[Response] = None,
+    ) -> context.RequestContext:
+        return context.request_context(request, response)
+
+
 company_router = APIRouter()
-schema = strawberry.Schema(company.Query)
-graphql_app = GraphQL(schema)
+schema = strawberry.Schema(
+    company.Query,
+    extensions=[
+        documents.CachedDocuments,
+        context.ReleaseConnection,
+        context.ReportTruncations,
+        cost.QueryCost,
+    ],
+)
+graphql_app = CompanyGraphQL(schema)
 company_router.add_route("/graphql", graphql_app)
@@ -25,6 +25,12 @@ class APICoordinator:
         log_level: str,
         log_path: str,
         config_file_path: pathlib.Path,
+        host: str = None,
+        port: int = None,
+        workers: int = None,
+        keep_alive: int = None,
+        backlog: int = None,
+        drain_timeout: float = None,
     ):
         """This function starts the service
 
@@ -32,6 +38,12 @@ class APICoordinator:
             log_level (str) : log level
             log_path (str) : log path
             config_file_path (Path) : The full path of the config file
+            host (str) : The address the API listens on, the [server] config when it's None
+            port (int) : The port the API listens on, the [server] config when it's None
+            workers (int) : The worker processes, 0 for one per core, the [server] config when it's None
+            keep_alive (int) : The seconds an idle keep-alive connection is kept open
+            backlog (int) : The most connections that wait to be accepted
+            drain_timeout (float) : The seconds a worker gets to finish its requests when it's stopped
 
         Returns:
             None
@@ -42,5 +54,14 @@ class APICoordinator:
             f"Executing `braz-bpa-cli api` and the APICoordinator.run() method from the python file '{current_path}'..."
         )
 
-        runner = apprunner.AppRunner(config_file_path)
+        runner = apprunner.AppRunner(
+            config_file_path,
+            log_path,
+            host=host,
+            port=port,
+            workers=workers,
+            keep_alive=keep_alive,
+            backlog=backlog,
+            drain_timeout=drain_timeout,
+        )
         runner.run()
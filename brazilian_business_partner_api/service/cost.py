@@ -0,0 +1,309 @@
+import functools
+from inspect import isawaitable
+from typing import Any, Optional
+
+from graphql import (
+    DocumentNode,
+    FieldNode,
+    FragmentDefinitionNode,
+    FragmentSpreadNode,
+    GraphQLError,
+    GraphQLNonNull,
+    GraphQLObjectType,
+    GraphQLSchema,
+    InlineFragmentNode,
+    SelectionSetNode,
+    get_named_type,
+    is_leaf_type,
+)
+from graphql.execution import ExecutionResult as GraphQLExecutionResult
+from graphql.execution.values import get_argument_values
+from graphql.utilities import get_operation_ast
+from strawberry.extensions import Extension
+
+import brazilian_business_partner_api
+from brazilian_business_partner_api.config import config
+from brazilian_business_partner_api.service import context, graph
+from brazilian_business_partner_api.service.model import company as model
+
+logger = brazilian_business_partner_api.Logger(__name__)
+
+# Module constants
+BUDGET = config.COST_CONFIGS["budget"]
+OVER_BUDGET = config.COST_CONFIGS["over_budget"]
+WEIGHTS = config.COST_CONFIGS.get("weights", {})
+REJECT = "reject"
+DOWNGRADE = "downgrade"
+TRUNCATED_COST = "cost"
+MAX_ESTIMATE = 1e15
+
+
+@functools.lru_cache(maxsize=None)
+def _weight(type_name: str, field_name: str, leaf: bool) -> int:
+    """The cost of every object the field returns: its weight in the config, 1 for objects and 0 for scalars"""
+    if type_name.startswith("__") or field_name.startswith("__"):
+        return 0
+    return WEIGHTS.get(f"{type_name}.{field_name}", 0 if leaf else 1)
+
+
+class CostEstimator:
+    """
+    Estimates what a GraphQL operation will cost, from its document alone: every field that returns objects costs its
+    weight for every object it is estimated to return, and the fields under it cost as much for every one of them.
+    The lengths of the lists are their limit/first arguments (and the ceilings of the config), at most the 99th
+    percentile degree of the companies or operators, and nothing below the maxDepth of a nested field.
+
+    Args:
+        schema (GraphQLSchema): The schema of the API.
+        document (DocumentNode): The parsed (and validated) document.
+        variables (dict): The variables of the request.
+        degree_statistics (dict): The (nodes, mean, 99th percentile, highest) degree of the companies and operators.
+    """
+
+    def __init__(
+        self,
+        schema: GraphQLSchema,
+        document: DocumentNode,
+        variables: dict,
+        degree_statistics: dict,
+    ):
+        self.schema = schema
+        self.document = document
+        self.variables = variables
+        self.degree_statistics = degree_statistics
+        self.fragments = {
+            definition.name.value: definition
+            for definition in document.definitions
+            if isinstance(definition, FragmentDefinitionNode)
+        }
+
+    def estimate(self, operation_name: Optional[str] = None) -> float:
+        operation = get_operation_ast(self.document, operation_name)
+        if operation is None:
+            return 0
+        return self._selections(
+            self.schema.get_root_type(operation.operation), operation.selection_set, 0, None
+        )
+
+    def _degree(self, kind: str, max_degree: Optional[int] = None) -> int:
+        """The 99th percentile degree of `kind`, the fan-out ceiling when it isn't known"""
+        degree = (
+            self.degree_statistics[kind][2] if kind in self.degree_statistics else model.MAX_FAN_OUT
+        )
+        return degree if max_degree is None else min(degree, max_degree)
+
+    def _reach(self, max_depth: Optional[int], max_degree: Optional[int]) -> float:
+        """The companies connectedCompanies finds within `max_depth`"""
+        growth = self._degree(graph.COMPANY, max_degree) * max(
+            self._degree(graph.OPERATOR, max_degree) - 1, 1
+        )
+        reach = layer = 1
+        for _ in range(model.connected_max_depth(max_depth)):
+            layer = min(layer * growth, MAX_ESTIMATE)
+            reach = min(reach + layer, MAX_ESTIMATE)
+        return reach - 1
+
+    def _size(
+        self, parent_type: GraphQLObjectType, field_name: str, args: dict, depth: int, page: Any
+    ) -> tuple:
+        """
+        How many objects the field returns, and what the fields under it need to know of it (the length of the page
+        of a connection, or the depth of a path)
+        """
+        if (
+            parent_type.name in ("Company", "Operator")
+            and field_name in model.NESTED_FIELDS
+            and depth >= model.nested_max_depth(args.get("maxDepth"))
+        ):
+            return 0, None
+
+        fan_out = min(args.get("limit") or model.MAX_FAN_OUT, model.MAX_FAN_OUT)
+        match parent_type.name, field_name:
+            case "Company", "operators":
+                return min(fan_out, self._degree(graph.COMPANY, args.get("maxDegree"))), None
+            case "Operator", "companies":
+                return min(fan_out, self._degree(graph.OPERATOR, args.get("maxDegree"))), None
+            case "Company", "operatorsConnection":
+                return 1, min(model.page_size(args.get("first")), self._degree(graph.COMPANY))
+            case "Operator", "companiesConnection":
+                return 1, min(model.page_size(args.get("first")), self._degree(graph.OPERATOR))
+            case "Query", "companies":
+                return len(args.get("ids") or ()), None
+            case "Query", "operators":
+                return len(args.get("keys") or ()), None
+            case "Query", "connectedCompanies":
+                limit = min(
+                    args.get("limit") or config.GRAPH_CONFIGS["max_results"],
+                    config.GRAPH_CONFIGS["max_results"],
+                )
+                return min(limit, self._reach(args.get("maxDepth"), args.get("maxDegree"))), None
+            case "Query", "connectedCompaniesConnection":
+                return 1, min(
+                    model.page_size(args.get("first")),
+                    self._reach(args.get("maxDepth"), args.get("maxDegree")),
+                )
+            case "Query", "connectionPath" | "connectionPaths":
+                paths = (
+                    1
+                    if field_name == "connectionPath"
+                    else min(args.get("limit") or 1, config.GRAPH_CONFIGS["max_paths"])
+                )
+                return paths, min(
+                    args.get("maxDepth") or model.DEFAULT_PATH_MAX_DEPTH,
+                    config.GRAPH_CONFIGS["max_path_depth"],
+                )
+            case "ConnectionPath", "companies":
+                return (page or 0) + 1, None
+            case "ConnectionPath", "operators":
+                return page or 0, None
+            case _, "edges" if parent_type.name.endswith("Connection"):
+                return page or 0, None
+        return 1, None
+
+    def _field(
+        self, parent_type: GraphQLObjectType, node: FieldNode, depth: int, page: Any
+    ) -> float:
+        field = parent_type.fields.get(node.name.value)
+        if field is None or node.name.value.startswith("__"):
+            return 0
+        named_type = get_named_type(field.type)
+        weight = _weight(parent_type.name, node.name.value, is_leaf_type(named_type))
+        if weight == 0 and node.selection_set is None:
+            return 0
+
+        size, child_page = self._size(
+            parent_type,
+            node.name.value,
+            get_argument_values(field, node, self.variables),
+            depth,
+            page,
+        )
+        children = 0
+        if node.selection_set is not None and size > 0:
+            children = self._selections(
+                named_type,
+                node.selection_set,
+                depth + model.nesting(parent_type.name),
+                child_page,
+            )
+        return min(size * (weight + children), MAX_ESTIMATE)
+
+    def _selections(
+        self, parent_type: GraphQLObjectType, selection_set: SelectionSetNode, depth: int, page: Any
+    ) -> float:
+        cost = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                cost += self._field(parent_type, selection, depth, page)
+            elif isinstance(selection, InlineFragmentNode):
+                fragment_type = (
+                    self.schema.get_type(selection.type_condition.name.value)
+                    if selection.type_condition
+                    else parent_type
+                )
+                cost += self._selections(fragment_type, selection.selection_set, depth, page)
+            elif (
+                isinstance(selection, FragmentSpreadNode) and selection.name.value in self.fragments
+            ):
+                fragment = self.fragments[selection.name.value]
+                cost += self._selections(
+                    self.schema.get_type(fragment.type_condition.name.value),
+                    fragment.selection_set,
+                    depth,
+                    page,
+                )
+        return min(cost, MAX_ESTIMATE)
+
+
+class QueryCost(Extension):
+    """
+    Estimates the cost of a query before any resolver runs (see CostEstimator) and, when it's over the budget of the
+    [cost] config, rejects it or downgrades it: a downgraded query runs, but the nullable fields that return objects
+    are null (and reported in `truncated`) once the cost of what was resolved reaches the budget. The cost of what was
+    actually resolved is counted as it runs, both are in the `cost` extension of the response.
+    """
+
+    def __init__(self, *, execution_context):
+        super().__init__(execution_context=execution_context)
+        self.estimated = None
+        self.actual = 0
+        self.downgraded = False
+
+    async def on_executing_start(self) -> None:
+        execution_context = self.execution_context
+        degree_statistics = {}
+        if isinstance(execution_context.context, context.RequestContext):
+            try:
+                degree_statistics = await model.degree_statistics(execution_context.context)
+            except Exception as e:
+                logger.log.error(
+                    f"Error fetching the degree statistics, the cost is estimated without them: {e}"
+                )
+
+        try:
+            self.estimated = CostEstimator(
+                execution_context.schema._schema,
+                execution_context.graphql_document,
+                execution_context.variables or {},
+                degree_statistics,
+            ).estimate(execution_context.operation_name)
+        except GraphQLError:
+            # the variables don't fit the arguments, the execution reports it
+            return
+
+        if self.estimated <= BUDGET:
+            return
+        if OVER_BUDGET == REJECT:
+            execution_context.result = GraphQLExecutionResult(
+                data=None,
+                errors=[
+                    GraphQLError(
+                        f"The estimated cost of the query ({self.estimated:,.0f}) is over the budget ({BUDGET:,})"
+                    )
+                ],
+            )
+        else:
+            self.downgraded = True
+
+    def _count(self, result: Any, weight: int) -> Any:
+        if isinstance(result, list):
+            self.actual += weight * len(result)
+        elif result is not None:
+            self.actual += weight
+        return result
+
+    async def _count_awaitable(self, result, weight: int) -> Any:
+        return self._count(await result, weight)
+
+    def resolve(self, _next, root, info, *args, **kwargs) -> Any:
+        weight = _weight(
+            info.parent_type.name, info.field_name, is_leaf_type(get_named_type(info.return_type))
+        )
+        if weight == 0:
+            return _next(root, info, *args, **kwargs)
+
+        if (
+            self.downgraded
+            and self.actual >= BUDGET
+            and not isinstance(info.return_type, GraphQLNonNull)
+        ):
+            if isinstance(info.context, context.RequestContext):
+                info.context.truncated(info.path.as_list(), TRUNCATED_COST, None, 0)
+            return None
+
+        result = _next(root, info, *args, **kwargs)
+        if isawaitable(result):
+            return self._count_awaitable(result, weight)
+        return self._count(result, weight)
+
+    def get_results(self) -> dict:
+        if self.estimated is None:
+            return {}
+        return {
+            "cost": {
+                "estimated": round(self.estimated),
+                "actual": self.actual,
+                "budget": BUDGET,
+                "downgraded": self.downgraded,
+            }
+        }
@@ -0,0 +1,201 @@
+import collections
+import dataclasses
+import hashlib
+import json
+import pathlib
+from typing import Optional
+
+from graphql import DocumentNode, GraphQLError
+from strawberry.extensions import Extension
+from strawberry.schema.execute import parse_document, validate_document
+
+import brazilian_business_partner_api
+from brazilian_business_partner_api.config import config
+
+logger = brazilian_business_partner_api.Logger(__name__)
+
+# Module constants
+PERSISTED_QUERY_NOT_FOUND = "PERSISTED_QUERY_NOT_FOUND"
+PERSISTED_QUERY_NOT_ALLOWED = "PERSISTED_QUERY_NOT_ALLOWED"
+PERSISTED_QUERY_HASH_MISMATCH = "PERSISTED_QUERY_HASH_MISMATCH"
+
+
+def document_hash(query: str) -> str:
+    """The sha256 (hex) of a GraphQL document, how documents are cached and persisted queries are asked for"""
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+class PersistedQueryError(Exception):
+    """
+    A persisted query that can't be run: its hash isn't in the registry, the document isn't allowed,
+    or the hash isn't the one of the document that was sent.
+
+    Args:
+        message (str): What went wrong.
+        code (str): The code of the error for the client, like PERSISTED_QUERY_NOT_FOUND.
+    """
+
+    def __init__(self, message: str, code: str):
+        super().__init__(message)
+        self.code = code
+
+
+@dataclasses.dataclass
+class DocumentCacheStats:
+    """
+    What a DocumentCache did since it was created.
+
+    Attributes:
+        maxsize (int): The most documents that are cached.
+        entries (int): The documents that are cached right now.
+        hits (int): The documents that didn't have to be parsed and validated.
+        misses (int): The documents that were parsed and validated.
+        evictions (int): The documents that were dropped, least recently used first, to stay under maxsize.
+    """
+
+    maxsize: int
+    entries: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class DocumentCache:
+    """
+    LRU cache of parsed and validated GraphQL documents, by the sha256 of the document. A document whose
+    validation failed is cached with its errors, so it isn't validated again either.
+
+    Args:
+        maxsize (int): The most documents that are cached.
+    Attributes:
+        stats (DocumentCacheStats): The counters of the cache.
+    """
+
+    def __init__(self, maxsize: int):
+        self.stats = DocumentCacheStats(maxsize=maxsize)
+        self._entries = collections.OrderedDict()
+
+    def get(self, key: str) -> Optional[tuple[DocumentNode, Optional[list]]]:
+        """The (document, validation errors) of `key`, the errors are None until the document was validated"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return entry
+
+    def put(self, key: str, document: DocumentNode, errors: Optional[list] = None) -> None:
+        self._entries[key] = (document, errors)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.stats.maxsize:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+        self.stats.entries = len(self._entries)
+
+
+class PersistedQueryRegistry:
+    """
+    The GraphQL documents clients may ask for by hash (persisted queries), by their sha256. It's read from a
+    JSON object of hash -> document, and a hash that isn't the one of its document is refused.
+
+    Args:
+        documents (dict): The documents, by their sha256.
+        only (bool): Whether only the documents of the registry may run (an allowlist).
+    """
+
+    def __init__(self, documents: dict, only: bool = False):
+        self.documents = documents
+        self.only = only
+
+    @classmethod
+    def load(cls, path: pathlib.Path, only: bool = False) -> "PersistedQueryRegistry":
+        with open(path, encoding="utf-8") as f:
+            documents = json.load(f)
+        for key, query in documents.items():
+            if document_hash(query) != key.lower():
+                raise ValueError(f"The hash {key} in {path} isn't the sha256 of its document")
+        logger.log.info(f"Loaded {len(documents):,} persisted queries from {path}.")
+        return cls({key.lower(): query for key, query in documents.items()}, only)
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def allows(self, sha256_hash: str) -> bool:
+        """Whether the document of `sha256_hash` may run: it's in the registry, or the registry isn't an allowlist"""
+        return not self.only or sha256_hash in self.documents
+
+    def resolve(self, query: Optional[str], sha256_hash: Optional[str]) -> Optional[str]:
+        """
+        The document to run for a request with `query` and/or the `sha256_hash` of a persisted query
+        (None when it has neither). Raises a PersistedQueryError when it can't be run.
+        """
+        if sha256_hash is not None:
+            sha256_hash = sha256_hash.lower()
+            if query is not None:
+                if document_hash(query) != sha256_hash:
+                    raise PersistedQueryError(
+                        "The sha256Hash isn't the one of the query", PERSISTED_QUERY_HASH_MISMATCH
+                    )
+            elif sha256_hash in self.documents:
+                query = self.documents[sha256_hash]
+            else:
+                raise PersistedQueryError("PersistedQueryNotFound", PERSISTED_QUERY_NOT_FOUND)
+
+        if query is not None and not self.allows(sha256_hash or document_hash(query)):
+            raise PersistedQueryError(
+                "Only persisted queries are allowed", PERSISTED_QUERY_NOT_ALLOWED
+            )
+        return query
+
+
+DOCUMENTS = DocumentCache(config.DOCUMENTS_CONFIGS["cache_size"])
+PERSISTED_QUERIES = (
+    PersistedQueryRegistry.load(
+        config.PERSISTED_QUERIES_PATH, config.DOCUMENTS_CONFIGS["persisted_queries_only"]
+    )
+    if config.PERSISTED_QUERIES_PATH is not None
+    else PersistedQueryRegistry({})
+)
+
+
+class CachedDocuments(Extension):
+    """
+    Takes the parsed document, and the result of its validation, of a request from DOCUMENTS, so a document
+    the worker saw before isn't parsed and validated again. The ones it didn't see are parsed and validated
+    once, and cached.
+    With `persisted_queries_only` a document that isn't in PERSISTED_QUERIES fails validation, whatever the
+    transport it came in (a GET, a JSON or a multipart POST, or a websocket).
+    """
+
+    def on_parsing_start(self) -> None:
+        execution_context = self.execution_context
+        self._key = document_hash(execution_context.query)
+        entry = DOCUMENTS.get(self._key)
+        if entry is None:
+            try:
+                execution_context.graphql_document = parse_document(execution_context.query)
+            except GraphQLError:
+                # the parsing step parses it again, and reports the syntax error
+                return
+            DOCUMENTS.put(self._key, execution_context.graphql_document)
+        else:
+            execution_context.graphql_document, execution_context.errors = entry[0], entry[1]
+
+        if not PERSISTED_QUERIES.allows(self._key):
+            execution_context.errors = [
+                GraphQLError(
+                    "Only persisted queries are allowed",
+                    extensions={"code": PERSISTED_QUERY_NOT_ALLOWED},
+                )
+            ]
+
+    def on_validation_start(self) -> None:
+        execution_context = self.execution_context
+        if execution_context.errors is None:
+            execution_context.errors = validate_document(
+                execution_context.schema._schema,
+                execution_context.graphql_document,
+                execution_context.validation_rules,
+            )
+            DOCUMENTS.put(self._key, execution_context.graphql_document, execution_context.errors)
@@ -0,0 +1,646 @@
+import io
+import json
+import mmap
+import os
+import pathlib
+import threading
+import time
+import zlib
+from typing import NamedTuple
+
+import numpy as np
+import psycopg2
+
+import brazilian_business_partner_api
+
+logger = brazilian_business_partner_api.Logger(__name__)
+
+# Module constants
+SNAPSHOT_MAGIC = b"BBPGRAPH"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGNMENT = 64
+SNAPSHOT_ARRAYS = (
+    "company_offsets",
+    "company_operators",
+    "operator_offsets",
+    "operator_companies",
+    "company_keys",
+    "company_key_order",
+    "operator_keys",
+    "operator_key_order",
+)
+COMPANY = "company"
+OPERATOR = "operator"
+# why a search result may be incomplete
+TRUNCATED_LIMIT = "limit"
+TRUNCATED_DEGREE = "degree"
+TRUNCATED_VISITED = "visited"
+_PREAMBLE = len(SNAPSHOT_MAGIC) + 8
+_CHECKSUM_CHUNK = 1 << 24
+
+
+class SnapshotError(Exception):
+    """A graph snapshot that can't be used: not a snapshot, of another version, or corrupt."""
+
+
+class SearchTimeout(Exception):
+    """A search of the graph that ran out of its time budget."""
+
+
+class GraphQueries(NamedTuple):
+    """
+    The queries a CompanyGraph is read with.
+
+    Attributes:
+        edges (str): The edges, (company_id, operator_id).
+        company_keys (str): The company ids and their nr_cnpj, (company_id, nr_cnpj).
+        operator_keys (str): The operator ids and their operator_key, (operator_id, operator_key).
+        generation (str): The data generation, its first column is the generation.
+    """
+
+    edges: str
+    company_keys: str
+    operator_keys: str
+    generation: str
+
+
+def _csr(sources: np.ndarray, targets: np.ndarray, size: int) -> tuple[np.ndarray, np.ndarray]:
+    """The offsets and the targets of a CSR adjacency of `size` nodes, from its edges"""
+    order = np.argsort(sources, kind="stable")
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=size), out=offsets[1:])
+    return offsets, targets[order]
+
+
+def _keys(rows: list, size: int) -> tuple[np.ndarray, np.ndarray]:
+    """The keys of the ids in `rows` (id, key) indexed by id, and the order of the ids sorted by key"""
+    ids = np.array([row[0] for row in rows], dtype=np.int32)
+    encoded = [row[1].encode() for row in rows]
+    keys = np.zeros(size, dtype=f"S{max((len(key) for key in encoded), default=1)}")
+    keys[ids] = encoded
+    return keys, np.argsort(keys, kind="stable").astype(np.int32)
+
+
+def _positions(offsets: np.ndarray, nodes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """How many neighbors every node of `nodes` has, and the positions of all of them in the targets"""
+    starts = offsets[nodes]
+    lengths = offsets[nodes + 1] - starts
+    # the position of every neighbor: the start of its node plus its index within the node
+    positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(
+        int(lengths.sum())
+    )
+    return lengths, positions
+
+
+def _neighbors(offsets: np.ndarray, targets: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+    """All the neighbors of `nodes` (with repeats), without a python loop over the nodes"""
+    return targets[_positions(offsets, nodes)[1]]
+
+
+def _expand(
+    offsets: np.ndarray, targets: np.ndarray, nodes: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """All the neighbors of `nodes` (with repeats), and the node of `nodes` every one of them is a neighbor of"""
+    lengths, positions = _positions(offsets, nodes)
+    return np.repeat(nodes, lengths), targets[positions]
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+
+
+def _checksum(buffer) -> int:
+    checksum = 0
+    view = memoryview(buffer)
+    for start in range(0, len(view), _CHECKSUM_CHUNK):
+        checksum = zlib.crc32(view[start : start + _CHECKSUM_CHUNK], checksum)
+    return checksum
+
+
+def page(layers: list, after: None | tuple[int, int], count: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The ids and depths of the (at most) `count` companies of `layers` (see CompanyGraph.connected_layers) that
+    come after the company `after`, a (depth, company_id), in the order of (depth, company_id).
+    """
+    if not layers:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+    sizes = [len(layer) for layer in layers]
+    start = 0
+    if after is not None:
+        depth, company_id = after
+        start = sum(sizes[: max(0, depth - 1)])
+        if 1 <= depth <= len(layers):
+            start += int(np.searchsorted(layers[depth - 1], company_id, side="right"))
+    ids = np.concatenate(layers)[start : start + count]
+    depths = np.repeat(np.arange(1, len(layers) + 1, dtype=np.int32), sizes)[start : start + count]
+    return ids, depths
+
+
+class _SearchSide:
+    """
+    One of the two breadth first searches of a bidirectional search, from `company_id`.
+    The parents are stored +1 in zeroed arrays (0 is not visited), which only take memory for the
+    pages of the ids that are visited. The layers are the nodes found at every depth, per kind.
+    """
+
+    def __init__(self, graph: "CompanyGraph", company_id: int):
+        self.company_id = company_id
+        self.parents = {
+            COMPANY: np.zeros(graph.companies, dtype=np.int32),
+            OPERATOR: np.zeros(graph.operators, dtype=np.int32),
+        }
+        self.parents[COMPANY][company_id] = -1
+        self.frontier = np.array([company_id], dtype=np.int32)
+        self.kind = COMPANY
+        self.layers = {COMPANY: [self.frontier], OPERATOR: []}
+        self.steps = 0
+
+    def path_to(self, node: int, kind: str) -> list:
+        """The alternating company/operator ids from the start of the search to `node`"""
+        path = [node]
+        while not (kind == COMPANY and node == self.company_id):
+            node = int(self.parents[kind][node]) - 1
+            kind = OPERATOR if kind == COMPANY else COMPANY
+            path.append(node)
+        return path[::-1]
+
+
+class CompanyGraph:
+    """
+    The bipartite graph of companies and operators of `transformed.xref_operator_company_id`, in memory,
+    as two CSR adjacencies (company -> operators and operator -> companies) of the integer ids, and
+    the keys (nr_cnpj and operator_key) of the ids.
+    A traversal is a breadth first search that visits every company and operator once, so a hub operator
+    is expanded once, not once per depth like in the recursive query.
+
+    The arrays are either read from the database or mapped read-only from a snapshot file (see `save()`),
+    in which case every process that opens the snapshot shares the pages of the page cache.
+
+    Args:
+        arrays (dict): The arrays of SNAPSHOT_ARRAYS.
+        generation (int): The data generation the graph is of.
+        source (str): Where the arrays are from.
+    Attributes:
+        generation (int): The data generation the graph is of.
+        source (str): Where the arrays are from, "database" or the path of the snapshot.
+        companies (int): The size of the company id space (the highest company_id + 1).
+        operators (int): The size of the operator id space (the highest operator_id + 1).
+        edges (int): The company/operator edges.
+    """
+
+    def __init__(self, arrays: dict, generation: None | int = None, source: str = "database"):
+        self.generation = generation
+        self.source = source
+        self.arrays = arrays
+        self.company_offsets = arrays["company_offsets"]
+        self.company_operators = arrays["company_operators"]
+        self.operator_offsets = arrays["operator_offsets"]
+        self.operator_companies = arrays["operator_companies"]
+        self.company_keys = arrays["company_keys"]
+        self.company_key_order = arrays["company_key_order"]
+        self.operator_keys = arrays["operator_keys"]
+        self.operator_key_order = arrays["operator_key_order"]
+        self.companies = len(self.company_offsets) - 1
+        self.operators = len(self.operator_offsets) - 1
+        self.edges = len(self.company_operators)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays.values())
+
+    @classmethod
+    def from_edges(
+        cls,
+        company_ids: np.ndarray,
+        operator_ids: np.ndarray,
+        company_keys: list,
+        operator_keys: list,
+        generation: None | int = None,
+    ) -> "CompanyGraph":
+        """The graph of the edges (`company_ids`, `operator_ids`), with the (id, key) rows of the ids"""
+        companies = (
+            max(int(company_ids.max(initial=-1)), max((row[0] for row in company_keys), default=-1))
+            + 1
+        )
+        operators = (
+            max(
+                int(operator_ids.max(initial=-1)),
+                max((row[0] for row in operator_keys), default=-1),
+            )
+            + 1
+        )
+        arrays = {}
+        arrays["company_offsets"], arrays["company_operators"] = _csr(
+            company_ids, operator_ids, companies
+        )
+        arrays["operator_offsets"], arrays["operator_companies"] = _csr(
+            operator_ids, company_ids, operators
+        )
+        arrays["company_keys"], arrays["company_key_order"] = _keys(company_keys, companies)
+        arrays["operator_keys"], arrays["operator_key_order"] = _keys(operator_keys, operators)
+        return cls(arrays, generation)
+
+    @classmethod
+    def from_database(cls, conn, queries: GraphQueries) -> "CompanyGraph":
+        """Reads the graph with `queries` on `conn`, in the transaction `conn` is in"""
+        before = time.monotonic()
+        with conn.cursor() as cur:
+            cur.execute(queries.generation)
+            row = cur.fetchone()
+            # COPY and one parse of the text, not a python tuple per edge
+            buffer = io.StringIO()
+            cur.copy_expert(f"COPY ({queries.edges}) TO STDOUT", buffer)
+            cur.execute(queries.company_keys)
+            company_keys = cur.fetchall()
+            cur.execute(queries.operator_keys)
+            operator_keys = cur.fetchall()
+
+        edges = np.fromstring(buffer.getvalue(), dtype=np.int32, sep=" ").reshape(-1, 2)
+        graph = cls.from_edges(
+            edges[:, 0], edges[:, 1], company_keys, operator_keys, row[0] if row else None
+        )
+        logger.log.info(
+            f"Read the company graph of generation {graph.generation}: {graph.companies:,} companies, "
+            f"{graph.operators:,} operators, {graph.edges:,} edges, {graph.nbytes:,} bytes, "
+            f"in {round(time.monotonic() - before, 2)} seconds."
+        )
+        return graph
+
+    def save(self, path: pathlib.Path) -> None:
+        """
+        Writes the graph as a snapshot: the magic, the version and the length of a JSON header with the
+        generation, the checksum (CRC-32) of the arrays and where every array is, and then the arrays, aligned.
+        The file is written next to `path` and renamed to it, so a reader sees the old or the new snapshot.
+        """
+        arrays = {}
+        offset = 0
+        for name in SNAPSHOT_ARRAYS:
+            array = np.ascontiguousarray(self.arrays[name])
+            offset = _aligned(offset)
+            arrays[name] = (array, offset)
+            offset += array.nbytes
+        data = bytearray(offset)
+        for array, offset in arrays.values():
+            data[offset : offset + array.nbytes] = array.tobytes()
+
+        header = json.dumps(
+            {
+                "generation": self.generation,
+                "checksum": _checksum(data),
+                "arrays": {
+                    name: {"dtype": array.dtype.str, "shape": array.shape, "offset": offset}
+                    for name, (array, offset) in arrays.items()
+                },
+            }
+        ).encode()
+        preamble = (
+            SNAPSHOT_MAGIC
+            + SNAPSHOT_VERSION.to_bytes(4, "little")
+            + len(header).to_bytes(4, "little")
+        )
+
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.{os.getpid()}")
+        with open(temp_path, "wb") as f:
+            f.write(preamble + header)
+            f.write(b"\0" * (_aligned(_PREAMBLE + len(header)) - _PREAMBLE - len(header)))
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        logger.log.info(
+            f"Wrote the snapshot of the company graph of generation {self.generation} to {path}, {len(data):,} bytes."
+        )
+
+    @classmethod
+    def open(cls, path: pathlib.Path, verify: bool = True) -> "CompanyGraph":
+        """
+        Maps the snapshot at `path` read-only, the arrays are views of the mapping. With `verify` the
+        checksum of the arrays is checked (which reads the whole file). A SnapshotError is raised when
+        the file isn't a snapshot of this version or is corrupt.
+        """
+        before = time.monotonic()
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(buffer) < _PREAMBLE or buffer[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise SnapshotError(f"{path} is not a company graph snapshot.")
+        version = int.from_bytes(buffer[len(SNAPSHOT_MAGIC) : len(SNAPSHOT_MAGIC) + 4], "little")
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError(
+                f"{path} is a snapshot of version {version}, not {SNAPSHOT_VERSION}."
+            )
+        header_length = int.from_bytes(buffer[len(SNAPSHOT_MAGIC) + 4 : _PREAMBLE], "little")
+        try:
+            header = json.loads(buffer[_PREAMBLE : _PREAMBLE + header_length])
+        except ValueError as e:
+            raise SnapshotError(f"The header of {path} is corrupt: {e}")
+
+        data = memoryview(buffer)[_aligned(_PREAMBLE + header_length) :]
+        if verify and _checksum(data) != header["checksum"]:
+            raise SnapshotError(f"The checksum of {path} doesn't match, it is corrupt.")
+        try:
+            arrays = {
+                name: np.frombuffer(
+                    data,
+                    dtype=np.dtype(spec["dtype"]),
+                    count=int(np.prod(spec["shape"])),
+                    offset=spec["offset"],
+                ).reshape(spec["shape"])
+                for name, spec in header["arrays"].items()
+            }
+        except (KeyError, ValueError) as e:
+            raise SnapshotError(f"The arrays of {path} are corrupt: {e}")
+
+        graph = cls(arrays, header["generation"], source=str(path))
+        logger.log.info(
+            f"Mapped the snapshot of the company graph of generation {graph.generation} from {path}: "
+            f"{graph.companies:,} companies, {graph.operators:,} operators, {graph.edges:,} edges, "
+            f"in {round(time.monotonic() - before, 3)} seconds."
+        )
+        return graph
+
+    def company_id(self, nr_cnpj: str) -> None | int:
+        """The company_id of `nr_cnpj`, None when it isn't a company of the graph"""
+        key = nr_cnpj.encode()
+        index = int(np.searchsorted(self.company_keys, key, sorter=self.company_key_order))
+        # the ids without a company have an empty key
+        if key and index < len(self.company_key_order):
+            company_id = int(self.company_key_order[index])
+            if self.company_keys[company_id] == key:
+                return company_id
+        return None
+
+    def connected_companies(
+        self,
+        company_id: int,
+        max_depth: int,
+        limit: None | int = None,
+        max_degree: None | int = None,
+        max_visited: None | int = None,
+    ) -> tuple[np.ndarray, tuple]:
+        """
+        The ids of the companies that share an operator with `company_id`, directly (depth 1) or through
+        other companies (up to `max_depth`), nearest first, without `company_id` itself.
+        The search stops at the depth where `limit` companies are found, and returns the first `limit`.
+        Companies and operators with more than `max_degree` neighbors (hubs) are found, but not walked
+        through, except `company_id` itself. The search stops at the depth where it visited `max_visited`
+        companies and operators.
+        Also returns why the result may be incomplete: TRUNCATED_LIMIT, TRUNCATED_DEGREE and/or TRUNCATED_VISITED.
+        """
+        layers, truncated = self.connected_layers(
+            company_id, max_depth, limit, max_degree, max_visited
+        )
+        if not layers:
+            return np.empty(0, dtype=np.int32), truncated
+        return np.concatenate(layers)[:limit], truncated
+
+    def connected_layers(
+        self,
+        company_id: int,
+        max_depth: int,
+        limit: None | int = None,
+        max_degree: None | int = None,
+        max_visited: None | int = None,
+    ) -> tuple[list, tuple]:
+        """
+        The ids of connected_companies() per depth: the ids of the companies first found at depth i + 1, sorted,
+        are layers[i]. The search stops like the one of connected_companies(), the last layer isn't cut at `limit`.
+        """
+        if not 0 <= company_id < self.companies:
+            return [], ()
+
+        visited_companies = np.zeros(self.companies, dtype=bool)
+        visited_operators = np.zeros(self.operators, dtype=bool)
+        visited_companies[company_id] = True
+        frontier = np.array([company_id], dtype=np.int32)
+        layers = []
+        count = visited = 0
+        truncated = set()
+
+        for depth in range(1, max_depth + 1):
+            operators = np.unique(
+                _neighbors(self.company_offsets, self.company_operators, frontier)
+            )
+            operators = operators[~visited_operators[operators]]
+            visited_operators[operators] = True
+            operators = self._prune(OPERATOR, operators, max_degree, truncated)
+
+            companies = np.unique(
+                _neighbors(self.operator_offsets, self.operator_companies, operators)
+            )
+            frontier = companies[~visited_companies[companies]]
+            if len(frontier) == 0:
+                break
+            visited_companies[frontier] = True
+            layers.append(frontier)
+            count += len(frontier)
+            visited += len(operators) + len(frontier)
+            frontier = self._prune(COMPANY, frontier, max_degree, truncated)
+
+            if depth < max_depth and len(frontier) > 0:
+                # there may be more companies further away
+                if limit is not None and count >= limit:
+                    truncated.add(TRUNCATED_LIMIT)
+                    break
+                if max_visited is not None and visited >= max_visited:
+                    truncated.add(TRUNCATED_VISITED)
+                    break
+
+        if limit is not None and count > limit:
+            truncated.add(TRUNCATED_LIMIT)
+        return layers, tuple(sorted(truncated))
+
+    def _prune(
+        self, kind: str, nodes: np.ndarray, max_degree: None | int, truncated: set
+    ) -> np.ndarray:
+        """The `nodes` of `kind` with at most `max_degree` neighbors, TRUNCATED_DEGREE is added to `truncated` when hubs were left out"""
+        if max_degree is None or len(nodes) == 0:
+            return nodes
+        offsets = self._adjacency(kind)[0]
+        walked = offsets[nodes + 1] - offsets[nodes] <= max_degree
+        if not walked.all():
+            truncated.add(TRUNCATED_DEGREE)
+        return nodes[walked]
+
+    def _adjacency(self, kind: str) -> tuple[np.ndarray, np.ndarray]:
+        """The offsets and the targets of the neighbors of the nodes of `kind`"""
+        if kind == COMPANY:
+            return self.company_offsets, self.company_operators
+        return self.operator_offsets, self.operator_companies
+
+    def _step(self, side: _SearchSide, other: _SearchSide, max_degree: None | int) -> np.ndarray:
+        """Expands the frontier of `side` one step (companies to operators or back), returns where it met `other`"""
+        kind = OPERATOR if side.kind == COMPANY else COMPANY
+        sources, nodes = _expand(*self._adjacency(side.kind), side.frontier)
+
+        new = side.parents[kind][nodes] == 0
+        if max_degree is not None:
+            # hubs aren't walked through, but the start of the other search is always reached
+            offsets = self._adjacency(kind)[0]
+            new &= (offsets[nodes + 1] - offsets[nodes] <= max_degree) | (
+                other.parents[kind][nodes] != 0
+            )
+        nodes, first = np.unique(nodes[new], return_index=True)
+        side.parents[kind][nodes] = sources[new][first] + 1
+
+        side.frontier = nodes
+        side.kind = kind
+        side.layers[kind].append(nodes)
+        side.steps += 1
+        return nodes[other.parents[kind][nodes] != 0]
+
+    def shortest_paths(
+        self,
+        from_id: int,
+        to_id: int,
+        max_depth: int,
+        limit: int = 1,
+        max_degree: None | int = None,
+        deadline: None | float = None,
+    ) -> list:
+        """
+        The shortest chains of shared operators from the company `from_id` to `to_id`, at most `max_depth`
+        operators long, as lists of alternating company and operator ids (company, operator, company, ...).
+        It is a bidirectional breadth first search: the smaller frontier of the two searches is expanded,
+        so the searched space grows from both ends, and it stops at the first step where they meet.
+        Up to `limit` paths of that (shortest) length are returned, one per node where the searches met.
+        Operators and companies with more than `max_degree` neighbors aren't walked through. SearchTimeout
+        is raised when the search is still going at `deadline` (in time.monotonic()).
+        """
+        if not (0 <= from_id < self.companies and 0 <= to_id < self.companies):
+            return []
+        if from_id == to_id:
+            return [[from_id]]
+
+        forward, backward = _SearchSide(self, from_id), _SearchSide(self, to_id)
+        while forward.steps + backward.steps < 2 * max_depth:
+            if len(forward.frontier) == 0 or len(backward.frontier) == 0:
+                return []
+            if deadline is not None and time.monotonic() > deadline:
+                raise SearchTimeout(
+                    f"The search for a path from {from_id} to {to_id} ran out of time."
+                )
+
+            side, other = (
+                (forward, backward)
+                if len(forward.frontier) <= len(backward.frontier)
+                else (backward, forward)
+            )
+            met = self._step(side, other, max_degree)
+            if len(met) == 0:
+                continue
+
+            # the nodes the other search found first are the ends of the shortest paths
+            for layer in other.layers[side.kind]:
+                ends = met[np.isin(met, layer)]
+                if len(ends) > 0:
+                    break
+            paths = []
+            for node in ends[:limit].tolist():
+                path = side.path_to(node, side.kind) + other.path_to(node, side.kind)[-2::-1]
+                paths.append(path if side is forward else path[::-1])
+            return paths
+        return []
+
+
+class CompanyGraphStore:
+    """
+    The CompanyGraph that is served. A graph is only served for the data generation it was loaded for:
+    when the generation changes (after a transform) the graph of the new one is loaded in a background
+    thread, and `current()` returns None until it is there, so the callers fall back to the database.
+    The graph is mapped from the snapshot the transformer wrote when its generation is the one in the
+    database, and read from the database otherwise (no snapshot, a stale one or a corrupt one).
+
+    Args:
+        db_configs (dict): The connection parameters of the database.
+        queries (GraphQueries): The queries the graph is read with.
+        snapshot_path (Path): The snapshot of the graph, None to always read it from the database.
+        verify_snapshot (bool): Whether the checksum of the snapshot is checked when it's mapped.
+        retry_interval (float): How long (in seconds) to wait before loading again after a load failed.
+    Attributes:
+        graph (CompanyGraph): The graph that was loaded last.
+    """
+
+    def __init__(
+        self,
+        db_configs: dict,
+        queries: GraphQueries,
+        snapshot_path: None | pathlib.Path = None,
+        verify_snapshot: bool = True,
+        retry_interval: float = 30.0,
+    ):
+        self.db_configs = db_configs
+        self.queries = queries
+        self.snapshot_path = snapshot_path
+        self.verify_snapshot = verify_snapshot
+        self.retry_interval = retry_interval
+        self.graph = None
+        self._failed_at = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def current(self, generation: None | int) -> None | CompanyGraph:
+        """The graph of `generation`, or None (and a load is started) when it isn't loaded"""
+        graph = self.graph
+        if graph is not None and graph.generation == generation:
+            return graph
+        self.reload()
+        return None
+
+    def reload(self) -> None:
+        """Starts loading the graph in the background, unless it is being loaded or the last load just failed"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if (
+                self._failed_at is not None
+                and time.monotonic() - self._failed_at < self.retry_interval
+            ):
+                return
+            self._thread = threading.Thread(target=self._load, name="company-graph", daemon=True)
+            self._thread.start()
+
+    def wait(self, timeout: None | float = None) -> None:
+        """Waits until the load in progress is done"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _load(self) -> None:
+        try:
+            self.graph = self._read()
+            self._failed_at = None
+        except Exception as e:
+            logger.log.error(f"Error loading the company graph: {e}")
+            self._failed_at = time.monotonic()
+
+    def _read(self) -> CompanyGraph:
+        conn = psycopg2.connect(**self.db_configs)
+        try:
+            # one snapshot, so the generation is the one of the edges
+            conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+            with conn.cursor() as cur:
+                cur.execute(self.queries.generation)
+                row = cur.fetchone()
+            generation = row[0] if row else None
+
+            if self.snapshot_path is not None:
+                try:
+                    graph = CompanyGraph.open(self.snapshot_path, verify=self.verify_snapshot)
+                    if graph.generation == generation:
+                        return graph
+                    logger.log.warning(
+                        f"The snapshot {self.snapshot_path} is of generation {graph.generation}, "
+                        f"the database is at {generation}, reading the graph from the database."
+                    )
+                except (OSError, SnapshotError) as e:
+                    logger.log.warning(
+                        f"Can't use the snapshot of the company graph, reading it from the database: {e}"
+                    )
+
+            return CompanyGraph.from_database(conn, self.queries)
+        finally:
+            conn.rollback()
+            conn.close()
@@ -1,32 +1,431 @@
+import base64
+import binascii
+import collections
 import datetime
 import logging
 import pathlib
+import time
 import tomllib as toml
-from typing import Optional
+from typing import Annotated, Generic, Optional, TypeVar
 
 import strawberry
+from starlette.concurrency import run_in_threadpool
+from strawberry.types import Info
 
 import brazilian_business_partner_api
 from brazilian_business_partner_api.config import config
 from brazilian_business_partner_api.connect import connect
+from brazilian_business_partner_api.service import cache, graph
 
-DB = connect.PostgresSingletonDB(config.DB_CONFIGS)
 logger = brazilian_business_partner_api.Logger(__name__)
 
 # Module constants
 DEFAULT_MAX_DEPTH = 3
+DEFAULT_CONNECTED_MAX_DEPTH = 2
+DEFAULT_PATH_MAX_DEPTH = 4
 
 _TOML = toml.load(
     open(str(pathlib.Path(__file__).parent.resolve() / "queries.toml"), "rb")
 )
 
-COMPANY_QUERY = _TOML["companies"]
-OPERATOR_QUERY = _TOML["operators"]
-COMPANY_BASE_QUERY = _TOML["company_base"]
-OPERATOR_BASE_QUERY = _TOML["operator_base"]
-COMPANY_OPERATORS_QUERY = _TOML["company_operators"]
-OPERATOR_COMPANIES_QUERY = _TOML["operator_companies"]
-CONNECTED_COMPANIES_QUERY = _TOML["connected_companies"]
+STATEMENTS = connect.StatementRegistry(_TOML)
+
+COMPANY_BASE_BATCH_QUERY = STATEMENTS["company_base_batch"]
+OPERATOR_BASE_BATCH_QUERY = STATEMENTS["operator_base_batch"]
+COMPANY_OPERATORS_BATCH_QUERY = STATEMENTS["company_operators_batch"]
+OPERATOR_COMPANIES_BATCH_QUERY = STATEMENTS["operator_companies_batch"]
+COMPANY_COMPONENTS_BATCH_QUERY = STATEMENTS["company_components_batch"]
+COMPANY_DEGREES_BATCH_QUERY = STATEMENTS["company_degrees_batch"]
+OPERATOR_DEGREES_BATCH_QUERY = STATEMENTS["operator_degrees_batch"]
+COMPANY_OPERATORS_PAGE_QUERY = STATEMENTS["company_operators_page"]
+OPERATOR_COMPANIES_PAGE_QUERY = STATEMENTS["operator_companies_page"]
+CONNECTED_COMPANIES_QUERY = STATEMENTS["connected_companies"]
+COMPANY_GRAPH_EDGES_QUERY = STATEMENTS["company_graph_edges"]
+COMPANY_GRAPH_COMPANY_KEYS_QUERY = STATEMENTS["company_graph_company_keys"]
+COMPANY_GRAPH_OPERATOR_KEYS_QUERY = STATEMENTS["company_graph_operator_keys"]
+COMPANIES_BY_ID_QUERY = STATEMENTS["companies_by_id"]
+PATH_COMPANIES_QUERY = STATEMENTS["path_companies"]
+PATH_OPERATORS_QUERY = STATEMENTS["path_operators"]
+DATA_GENERATION_QUERY = STATEMENTS["data_generation"]
+DEGREE_STATISTICS_QUERY = STATEMENTS["degree_statistics"]
+NESTED_FIELDS = ("operators", "companies", "operatorsConnection", "companiesConnection")
+CACHED_FIELDS = frozenset(config.CACHE_CONFIGS["fields"])
+MAX_FAN_OUT = config.GRAPH_CONFIGS["max_fan_out"]
+MAX_NESTED_DEPTH = config.COST_CONFIGS["max_depth"]
+MAX_CONNECTED_DEPTH = config.COST_CONFIGS["max_connected_depth"]
+PAGE_SIZE = config.GRAPH_CONFIGS["page_size"]
+MAX_BULK_KEYS = config.API_CONFIGS["max_bulk_keys"]
+BULK_BATCH_SIZE = config.API_CONFIGS["bulk_batch_size"]
+TRUNCATED_FAN_OUT = "fan_out"
+CURSOR_PREFIX = "cursor:"
+
+CACHE = cache.ResultCache(
+    max_bytes=config.CACHE_CONFIGS["max_bytes"],
+    ttl_seconds=config.CACHE_CONFIGS["ttl_seconds"],
+    generation_check_interval=config.CACHE_CONFIGS["generation_check_interval"],
+)
+
+GRAPH = graph.CompanyGraphStore(
+    config.DB_CONFIGS,
+    graph.GraphQueries(
+        edges=COMPANY_GRAPH_EDGES_QUERY.query,
+        company_keys=COMPANY_GRAPH_COMPANY_KEYS_QUERY.query,
+        operator_keys=COMPANY_GRAPH_OPERATOR_KEYS_QUERY.query,
+        generation=DATA_GENERATION_QUERY.query,
+    ),
+    snapshot_path=config.GRAPH_SNAPSHOT_PATH,
+    verify_snapshot=config.GRAPH_CONFIGS["verify_snapshot"],
+    retry_interval=config.GRAPH_CONFIGS["retry_interval"],
+)
+
+
+def nesting(typename: Optional[str]) -> int:
+    """
+    The levels a field of the type `typename` nests the fields under it in: one for a field of a company or an
+    operator (only their operators/companies fields have fields under them), none for the others. It goes by the
+    type and not by the name of the field, the key of a field in the path is its alias.
+    """
+    return int(typename in ("Company", "Operator"))
+
+
+def _query_depth(info: Info) -> int:
+    """How many operators/companies fields (of a company or an operator) the field of `info` is nested in"""
+    depth = 0
+    path = info.path.prev
+    while path is not None:
+        depth += nesting(path.typename)
+        path = path.prev
+    return depth
+
+
+def nested_max_depth(max_depth: Optional[int]) -> int:
+    """The `maxDepth` of an operators/companies field, at most MAX_NESTED_DEPTH whatever the client asked for"""
+    return min(max_depth or DEFAULT_MAX_DEPTH, MAX_NESTED_DEPTH)
+
+
+def connected_max_depth(max_depth: Optional[int]) -> int:
+    """The `maxDepth` of connectedCompanies, at most MAX_CONNECTED_DEPTH whatever the client asked for"""
+    return min(max_depth or DEFAULT_CONNECTED_MAX_DEPTH, MAX_CONNECTED_DEPTH)
+
+
+async def _generation(context) -> None | int:
+    """The data generation that is served, checked at most every `generation_check_interval` seconds"""
+    if CACHE.generation_expired():
+        result = await context.fetchone(DATA_GENERATION_QUERY)
+        CACHE.set_generation(result[0] if result else None)
+    return CACHE.generation
+
+
+async def _fetch_cached(context, field: str, statement: connect.PreparedStatement, key: str) -> Optional[tuple]:
+    """The row of `key` (None when there is none), a lookup of _fetch_all_cached so it shares its cache entries"""
+    rows = (await _fetch_all_cached(context, field, statement, [key]))[key]
+    return (key, *rows[0]) if rows else None
+
+
+async def _fetch_all_cached(context, field: str, statement: connect.PreparedStatement, keys: list, *params) -> dict:
+    """
+    The rows of every key in `keys` (the first column of the rows of `statement` is the key), from the
+    cache when `field` is cached. The keys that aren't cached are loaded BULK_BATCH_SIZE at a time, one
+    query per batch, `params` are the other parameters of `statement`, they have to be the same for every
+    call with `field`.
+    """
+    rows = {}
+    missing = list(dict.fromkeys(keys))
+    if field in CACHED_FIELDS:
+        generation = await _generation(context)
+        missing = []
+        for key in dict.fromkeys(keys):
+            found, cached = CACHE.get(field, generation, key)
+            if found:
+                rows[key] = cached
+            else:
+                missing.append(key)
+
+    for start in range(0, len(missing), BULK_BATCH_SIZE):
+        batch = missing[start:start + BULK_BATCH_SIZE]
+        loaded = {key: [] for key in batch}
+        for row in await context.fetchall(statement, batch, *params):
+            loaded[row[0]].append(tuple(row[1:]))
+        for key, found in loaded.items():
+            rows[key] = tuple(found)
+            if field in CACHED_FIELDS:
+                CACHE.put(field, generation, key, rows[key])
+    return rows
+
+
+def _check_bulk_keys(keys: list) -> None:
+    if len(keys) > MAX_BULK_KEYS:
+        raise Exception(f"At most {MAX_BULK_KEYS:,} keys can be looked up at once, {len(keys):,} were given")
+
+
+async def degree_statistics(context) -> dict:
+    """The (nodes, mean, 99th percentile and highest degree) of the companies and of the operators, by kind"""
+    rows = await _fetch_all_cached(context, "degree_statistics", DEGREE_STATISTICS_QUERY, [graph.COMPANY, graph.OPERATOR])
+    return {kind: rows[kind][0] for kind in rows if rows[kind]}
+
+
+async def _company_graph(context) -> Optional[graph.CompanyGraph]:
+    """The company graph of the served data generation, None when it is disabled or still loading"""
+    if not config.GRAPH_CONFIGS["enabled"]:
+        return None
+    return GRAPH.current(await _generation(context))
+
+
+async def _connected_company_rows(
+    context, nr_cnpj: str, max_depth: int, limit: int, max_degree: Optional[int]
+) -> tuple[list, tuple]:
+    """
+    The companies connected to `nr_cnpj`, from the in-memory graph when the one of the served data generation
+    is loaded: the id of `nr_cnpj` and the ids it is connected to are found in memory, and only the attributes
+    of the companies that were found are read. The walk stops when it visited what is left of the visited
+    budget of the request.
+    Otherwise (the graph is disabled or still loading) the recursive query walks them in the database, and keeps
+    the nearest `limit` in the same order, (depth, company_id).
+    Hubs (more than `max_degree` neighbors) aren't walked through. Also returns why the result may be incomplete.
+    """
+    company_graph = await _company_graph(context)
+    if company_graph is None:
+        rows = await context.fetchall(CONNECTED_COMPANIES_QUERY, nr_cnpj, max_depth, max_degree, limit)
+        return rows, (graph.TRUNCATED_LIMIT,) if rows and rows[0][3] > limit else ()
+
+    company_id = company_graph.company_id(nr_cnpj)
+    if company_id is None:
+        return [], ()
+    company_ids, truncated = await run_in_threadpool(
+        company_graph.connected_companies,
+        company_id,
+        max_depth,
+        limit,
+        max_degree,
+        context.max_visited - context.visited,
+    )
+    if len(company_ids) == 0:
+        return [], truncated
+    return await context.fetchall(COMPANIES_BY_ID_QUERY, company_ids.tolist()), truncated
+
+
+async def _connected_companies_page(
+    info: Info,
+    nr_cnpj: str,
+    max_depth: Optional[int],
+    max_degree: Optional[int],
+    first: int,
+    after: Optional[str],
+    position: Optional[tuple],
+) -> Optional["Connection[Company]"]:
+    """
+    A page of the companies connected to `nr_cnpj`, in the order of (depth, company_id), the cursors are that
+    position. The companies are walked in the company graph on every page, only the ids of the page are read.
+    The walk stops when it visited what is left of the visited budget of the request, like the list field.
+    """
+    context = info.context
+    company_graph = await _company_graph(context)
+    if company_graph is None:
+        raise Exception("The company graph isn't loaded, try again in a moment")
+
+    company_id = company_graph.company_id(nr_cnpj)
+    if company_id is None:
+        return None
+    layers, truncated = await run_in_threadpool(
+        company_graph.connected_layers,
+        company_id,
+        connected_max_depth(max_depth),
+        None,
+        max_degree,
+        context.max_visited - context.visited,
+    )
+    total_count = sum(len(layer) for layer in layers)
+    for reason in truncated:
+        context.truncated(info.path.as_list(), reason, None, total_count)
+
+    company_ids, depths = graph.page(layers, position, first + 1)
+    companies = {}
+    if len(company_ids):
+        companies = {
+            row[0]: Company(nr_cnpj=row[1], nm_fantasia=row[2], sg_uf=row[3])
+            for row in await context.fetchall(PATH_COMPANIES_QUERY, company_ids.tolist())
+        }
+    edges = [
+        Edge(cursor=_cursor(depth, company_id), node=companies[company_id])
+        for company_id, depth in zip(company_ids.tolist(), depths.tolist())
+        if company_id in companies
+    ]
+    return _connection(info, total_count, edges, first, after)
+
+
+async def _connection_paths(context, from_nr_cnpj: str, to_nr_cnpj: str, max_depth: int, limit: int) -> list:
+    """
+    The shortest chains of shared operators from `from_nr_cnpj` to `to_nr_cnpj`, searched in the company graph
+    within the depth, hub degree and time budget of the [graph] config. The attributes of the companies and
+    operators on the paths are read in one query each.
+    """
+    company_graph = await _company_graph(context)
+    if company_graph is None:
+        raise Exception("The company graph isn't loaded, try again in a moment")
+
+    from_id, to_id = company_graph.company_id(from_nr_cnpj), company_graph.company_id(to_nr_cnpj)
+    if from_id is None or to_id is None:
+        return []
+    paths = await run_in_threadpool(
+        company_graph.shortest_paths,
+        from_id,
+        to_id,
+        min(max_depth, config.GRAPH_CONFIGS["max_path_depth"]),
+        min(limit, config.GRAPH_CONFIGS["max_paths"]),
+        config.GRAPH_CONFIGS["max_path_degree"],
+        time.monotonic() + config.GRAPH_CONFIGS["path_time_budget_seconds"],
+    )
+    if not paths:
+        return []
+
+    company_ids = sorted({company_id for path in paths for company_id in path[0::2]})
+    operator_ids = sorted({operator_id for path in paths for operator_id in path[1::2]})
+    companies = {
+        row[0]: Company(nr_cnpj=row[1], nm_fantasia=row[2], sg_uf=row[3])
+        for row in await context.fetchall(PATH_COMPANIES_QUERY, company_ids)
+    }
+    operators = {}
+    if operator_ids:
+        operators = {
+            row[0]: Operator(operator_key=row[1], in_cpf_cnpj=row[2], nm_socio=row[3])
+            for row in await context.fetchall(PATH_OPERATORS_QUERY, operator_ids)
+        }
+    return [
+        ConnectionPath(
+            length=len(path) // 2,
+            companies=[companies[company_id] for company_id in path[0::2]],
+            operators=[operators[operator_id] for operator_id in path[1::2]],
+        )
+        for path in paths
+    ]
+
+
+def _fan_out(info: Info, nodes: list, degree: int, limit: Optional[int], max_degree: Optional[int]) -> list:
+    """
+    The first `limit` (at most MAX_FAN_OUT) of the `degree` neighbors `nodes` of a company or operator, none
+    when it has more than `max_degree` (it's a hub), and no more than what is left of the visited budget of the
+    request. A list that is cut short is reported to the client.
+    """
+    path = info.path.as_list()
+    if max_degree is not None and degree > max_degree:
+        info.context.truncated(path, graph.TRUNCATED_DEGREE, degree, 0)
+        return []
+
+    fan_out = min(limit or MAX_FAN_OUT, MAX_FAN_OUT)
+    if degree > fan_out or len(nodes) > fan_out:
+        nodes = nodes[:fan_out]
+        info.context.truncated(path, TRUNCATED_FAN_OUT, degree, len(nodes))
+    visited = info.context.visit(len(nodes))
+    if visited < len(nodes):
+        nodes = nodes[:visited]
+        info.context.truncated(path, graph.TRUNCATED_VISITED, degree, len(nodes))
+    return nodes
+
+
+async def _load_company_operators(context, nr_cnpjs: list) -> list:
+    """The degree and the first MAX_FAN_OUT operators of every company in `nr_cnpjs`, in one query"""
+    rows = await _fetch_all_cached(context, "operators", COMPANY_OPERATORS_BATCH_QUERY, nr_cnpjs, MAX_FAN_OUT)
+    return [
+        (
+            rows[nr_cnpj][0][0] if rows[nr_cnpj] else 0,
+            [
+                Operator(operator_key=row[1], in_cpf_cnpj=row[2], nm_socio=row[3])
+                for row in rows[nr_cnpj]
+                if row[1] is not None
+            ],
+        )
+        for nr_cnpj in nr_cnpjs
+    ]
+
+
+def _cursor(*values: int) -> str:
+    """An opaque cursor of the position `values` (the ids the pages are ordered by) of a node in a connection"""
+    return base64.urlsafe_b64encode((CURSOR_PREFIX + ":".join(map(str, values))).encode()).decode()
+
+
+def _after(cursor: Optional[str], size: int) -> Optional[tuple]:
+    """The position of the `after` cursor of a connection, `size` ids, None when there is no cursor"""
+    if not cursor:
+        return None
+    try:
+        values = base64.urlsafe_b64decode(cursor.encode()).decode()
+        if values.startswith(CURSOR_PREFIX):
+            position = tuple(int(value) for value in values.removeprefix(CURSOR_PREFIX).split(":"))
+            if len(position) == size:
+                return position
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        pass
+    raise Exception(f"Invalid cursor: {cursor}")
+
+
+def page_size(first: Optional[int]) -> int:
+    """The number of nodes of a page, `first` (PAGE_SIZE when it's not given) and at most MAX_FAN_OUT"""
+    return max(0, min(PAGE_SIZE if first is None else first, MAX_FAN_OUT))
+
+
+async def _load_pages(context, statement: connect.PreparedStatement, keys: list) -> list:
+    """
+    The (degree, rows) of a page of every (key, after, first) in `keys`: the degree of the key and at most
+    first + 1 of its rows after the id `after`. The keys with the same `after` and `first` (like the ones of
+    the parents of a nested field) are loaded with one keyset query.
+    """
+    requested = collections.defaultdict(list)
+    for key, after, first in keys:
+        requested[(after, first)].append(key)
+
+    pages = {}
+    for (after, first), page_keys in requested.items():
+        degrees = {key: 0 for key in page_keys}
+        rows = {key: [] for key in page_keys}
+        for row in await context.fetchall(statement, page_keys, after, first + 1):
+            degrees[row[0]] = row[1]
+            if row[2] is not None:
+                rows[row[0]].append(tuple(row[2:]))
+        pages.update({(key, after, first): (degrees[key], rows[key]) for key in page_keys})
+    return [pages[key] for key in keys]
+
+
+async def _load_company_operator_pages(context, keys: list) -> list:
+    return await _load_pages(context, COMPANY_OPERATORS_PAGE_QUERY, keys)
+
+
+async def _load_operator_company_pages(context, keys: list) -> list:
+    return await _load_pages(context, OPERATOR_COMPANIES_PAGE_QUERY, keys)
+
+
+async def _load_company_degrees(context, nr_cnpjs: list) -> list:
+    """The number of operators of every company in `nr_cnpjs` (None when it's unknown), in one query"""
+    rows = await _fetch_all_cached(context, "company_degrees", COMPANY_DEGREES_BATCH_QUERY, nr_cnpjs)
+    return [rows[nr_cnpj][0][0] if rows[nr_cnpj] else None for nr_cnpj in nr_cnpjs]
+
+
+async def _load_operator_degrees(context, operator_keys: list) -> list:
+    """The number of companies of every operator in `operator_keys` (None when it's unknown), in one query"""
+    rows = await _fetch_all_cached(context, "operator_degrees", OPERATOR_DEGREES_BATCH_QUERY, operator_keys)
+    return [rows[operator_key][0][0] if rows[operator_key] else None for operator_key in operator_keys]
+
+
+async def _load_company_components(context, nr_cnpjs: list) -> list:
+    """The (component_id, component_size) of every company in `nr_cnpjs` (None when it's unknown), in one query"""
+    rows = await _fetch_all_cached(context, "components", COMPANY_COMPONENTS_BATCH_QUERY, nr_cnpjs)
+    return [rows[nr_cnpj][0] if rows[nr_cnpj] else None for nr_cnpj in nr_cnpjs]
+
+
+async def _load_operator_companies(context, operator_keys: list) -> list:
+    """The degree and the first MAX_FAN_OUT companies of every operator in `operator_keys`, in one query"""
+    rows = await _fetch_all_cached(context, "companies", OPERATOR_COMPANIES_BATCH_QUERY, operator_keys, MAX_FAN_OUT)
+    return [
+        (
+            rows[operator_key][0][0] if rows[operator_key] else 0,
+            [
+                Company(nr_cnpj=row[1], nm_fantasia=row[2], sg_uf=row[3])
+                for row in rows[operator_key]
+                if row[1] is not None
+            ],
+        )
+        for operator_key in operator_keys
+    ]
+
 
 @strawberry.input
 class CompanyID:
@@ -42,6 +441,59 @@ class QualificacaoSocio:
     cd_qualificacao_socio: Optional[str]
     ds_qualificacao_socio: Optional[str] = strawberry.UNSET
 
+@strawberry.type
+class DataGeneration:
+    """The build of the transformed data that is served, it changes with every transform"""
+    generation: int
+    built_at: str
+    activated_at: Optional[str]
+
+T = TypeVar("T")
+
+@strawberry.type
+class PageInfo:
+    """Where a page of a connection is: `endCursor` is the `after` of the next page"""
+    has_next_page: bool
+    has_previous_page: bool
+    start_cursor: Optional[str]
+    end_cursor: Optional[str]
+
+@strawberry.type
+class Edge(Generic[T]):
+    cursor: str
+    node: T
+
+@strawberry.type
+class Connection(Generic[T]):
+    """A page of a list, in the Relay connection shape. `totalCount` is the length of the whole list"""
+    edges: list[Edge[T]]
+    page_info: PageInfo
+    total_count: int
+
+
+def _connection(info: Info, total_count: int, edges: list, first: int, after: Optional[str]) -> Connection:
+    """
+    The page of the (at most first + 1) `edges` that were read after `after`, the extra one only tells
+    there is a next page. The page is cut at what is left of the visited budget of the request.
+    """
+    has_next_page = len(edges) > first
+    edges = edges[:first]
+    visited = info.context.visit(len(edges))
+    if visited < len(edges):
+        edges = edges[:visited]
+        has_next_page = True
+        info.context.truncated(info.path.as_list(), graph.TRUNCATED_VISITED, total_count, visited)
+    return Connection(
+        edges=edges,
+        page_info=PageInfo(
+            has_next_page=has_next_page,
+            has_previous_page=after is not None,
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+        ),
+        total_count=total_count,
+    )
+
 @strawberry.type
 class Company:
     nr_cnpj: str
@@ -49,36 +501,78 @@ class Company:
     sg_uf: str
 
     @strawberry.field
-    def operators(
+    async def operators(
         self, 
-        info: strawberry.Info,
-        max_depth: Optional[int] = DEFAULT_MAX_DEPTH
+        info: Info,
+        max_depth: Optional[int] = DEFAULT_MAX_DEPTH,
+        limit: Optional[int] = MAX_FAN_OUT,
+        max_degree: Optional[int] = None
     ) -> Optional[list["Operator"]]:
-        """Get operators for this company with depth control"""
-        current_depth = getattr(info.context, 'query_depth', 0)
-        if current_depth >= (max_depth or DEFAULT_MAX_DEPTH):
+        """Get operators for this company with depth control, the first `limit`, none when it has more than `max_degree`"""
+        if _query_depth(info) >= nested_max_depth(max_depth):
             return []
-            
-        # Set context for nested queries
-        info.context.query_depth = current_depth + 1
-        
-        operators = []
+
         try:
-            result = DB.execute(logger, COMPANY_OPERATORS_QUERY.format(nr_cnpj=self.nr_cnpj)).fetchall()
-            for row in result:
-                operators.append(Operator(
-                    operator_key=row[0],
-                    in_cpf_cnpj=row[1],
-                    nm_socio=row[2]
-                ))
+            degree, operators = await info.context.loader(_load_company_operators).load(self.nr_cnpj)
         except Exception as e:
-            logger.error(f"Error fetching operators for company {self.nr_cnpj}: {e}")
+            logger.log.error(f"Error fetching operators for company {self.nr_cnpj}: {e}")
             return []
-        finally:
-            # Reset context depth
-            info.context.query_depth = current_depth
-            
-        return operators
+        return _fan_out(info, operators, degree, limit, max_degree)
+
+    @strawberry.field
+    async def operators_connection(
+        self,
+        info: Info,
+        first: Optional[int] = PAGE_SIZE,
+        after: Optional[str] = None,
+        max_depth: Optional[int] = DEFAULT_MAX_DEPTH
+    ) -> Optional[Connection["Operator"]]:
+        """Get a page of the operators of this company: the `first` after the cursor `after`"""
+        if _query_depth(info) >= nested_max_depth(max_depth):
+            return None
+
+        first, position = page_size(first), _after(after, 1)
+        try:
+            degree, rows = await info.context.loader(_load_company_operator_pages).load(
+                (self.nr_cnpj, position[0] if position else -1, first)
+            )
+        except Exception as e:
+            logger.log.error(f"Error fetching the operators page of company {self.nr_cnpj}: {e}")
+            raise Exception(f"Failed to fetch the operators page: {str(e)}")
+        edges = [
+            Edge(cursor=_cursor(row[0]), node=Operator(operator_key=row[1], in_cpf_cnpj=row[2], nm_socio=row[3]))
+            for row in rows
+        ]
+        return _connection(info, degree, edges, first, after)
+
+    @strawberry.field
+    async def degree(self, info: Info) -> Optional[int]:
+        """Get how many operators this company has"""
+        try:
+            return await info.context.loader(_load_company_degrees).load(self.nr_cnpj)
+        except Exception as e:
+            logger.log.error(f"Error fetching the degree of company {self.nr_cnpj}: {e}")
+            return None
+
+    @strawberry.field
+    async def component_id(self, info: Info) -> Optional[int]:
+        """Get the id of the network of companies this company is connected to through shared operators"""
+        try:
+            component = await info.context.loader(_load_company_components).load(self.nr_cnpj)
+        except Exception as e:
+            logger.log.error(f"Error fetching the component of company {self.nr_cnpj}: {e}")
+            return None
+        return component[0] if component else None
+
+    @strawberry.field
+    async def network_size(self, info: Info) -> Optional[int]:
+        """Get how many companies are in the network of this company, itself included"""
+        try:
+            component = await info.context.loader(_load_company_components).load(self.nr_cnpj)
+        except Exception as e:
+            logger.log.error(f"Error fetching the component of company {self.nr_cnpj}: {e}")
+            return None
+        return component[1] if component else None
 
 @strawberry.type
 class Operator:
@@ -87,56 +581,101 @@ class Operator:
     nm_socio: str
 
     @strawberry.field
-    def companies(
+    async def companies(
         self, 
-        info: strawberry.Info,
-        max_depth: Optional[int] = DEFAULT_MAX_DEPTH
+        info: Info,
+        max_depth: Optional[int] = DEFAULT_MAX_DEPTH,
+        limit: Optional[int] = MAX_FAN_OUT,
+        max_degree: Optional[int] = None
     ) -> Optional[list[Company]]:
-        """Get companies for this operator with depth control"""
-        current_depth = getattr(info.context, 'query_depth', 0)
-        if current_depth >= (max_depth or DEFAULT_MAX_DEPTH):
+        """Get companies for this operator with depth control, the first `limit`, none when it has more than `max_degree`"""
+        if _query_depth(info) >= nested_max_depth(max_depth):
             return []
-            
-        # Set context for nested queries
-        info.context.query_depth = current_depth + 1
-        
-        companies = []
+
         try:
-            result = DB.execute(logger, OPERATOR_COMPANIES_QUERY.format(operator_key=self.operator_key)).fetchall()
-            for row in result:
-                companies.append(Company(
-                    nr_cnpj=row[0],
-                    nm_fantasia=row[1],
-                    sg_uf=row[2]
-                ))
+            degree, companies = await info.context.loader(_load_operator_companies).load(self.operator_key)
         except Exception as e:
-            logger.error(f"Error fetching companies for operator {self.operator_key}: {e}")
+            logger.log.error(f"Error fetching companies for operator {self.operator_key}: {e}")
             return []
-        finally:
-            # Reset context depth
-            info.context.query_depth = current_depth
-            
-        return companies
+        return _fan_out(info, companies, degree, limit, max_degree)
+
+    @strawberry.field
+    async def companies_connection(
+        self,
+        info: Info,
+        first: Optional[int] = PAGE_SIZE,
+        after: Optional[str] = None,
+        max_depth: Optional[int] = DEFAULT_MAX_DEPTH
+    ) -> Optional[Connection[Company]]:
+        """Get a page of the companies of this operator: the `first` after the cursor `after`"""
+        if _query_depth(info) >= nested_max_depth(max_depth):
+            return None
+
+        first, position = page_size(first), _after(after, 1)
+        try:
+            degree, rows = await info.context.loader(_load_operator_company_pages).load(
+                (self.operator_key, position[0] if position else -1, first)
+            )
+        except Exception as e:
+            logger.log.error(f"Error fetching the companies page of operator {self.operator_key}: {e}")
+            raise Exception(f"Failed to fetch the companies page: {str(e)}")
+        edges = [
+            Edge(cursor=_cursor(row[0]), node=Company(nr_cnpj=row[1], nm_fantasia=row[2], sg_uf=row[3]))
+            for row in rows
+        ]
+        return _connection(info, degree, edges, first, after)
+
+    @strawberry.field
+    async def degree(self, info: Info) -> Optional[int]:
+        """Get how many companies this operator has"""
+        try:
+            return await info.context.loader(_load_operator_degrees).load(self.operator_key)
+        except Exception as e:
+            logger.log.error(f"Error fetching the degree of operator {self.operator_key}: {e}")
+            return None
+
+
+@strawberry.type
+class ConnectionPath:
+    """A chain of companies linked by shared operators: companies[i] and companies[i + 1] share operators[i]"""
+    length: int
+    companies: list[Company]
+    operators: list[Operator]
+
+
+async def _resolve_connection_paths(
+    info: Info, from_: CompanyID, to: CompanyID, max_depth: Optional[int], limit: Optional[int]
+) -> list[ConnectionPath]:
+    if from_ is strawberry.UNSET or to is strawberry.UNSET:
+        raise Exception("You need to provide the nr_cnpj of both companies")
+
+    try:
+        return await _connection_paths(
+            info.context,
+            from_.nr_cnpj,
+            to.nr_cnpj,
+            max_depth or DEFAULT_PATH_MAX_DEPTH,
+            limit or 1
+        )
+    except Exception as e:
+        logger.log.error(f"Error fetching the connection path from {from_.nr_cnpj} to {to.nr_cnpj}: {e}")
+        raise Exception(f"Failed to fetch the connection path: {str(e)}")
 
 
 @strawberry.type
 class Query:
     @strawberry.field
-    def company(
+    async def company(
         self, 
         companyId: CompanyID = strawberry.UNSET,
-        info: strawberry.Info = strawberry.UNSET
+        info: Info = strawberry.UNSET
     ) -> Optional[Company]:
         """Get a company by CNPJ number"""
         if companyId is strawberry.UNSET:
             raise Exception("You need to provide nr_cnpj")
 
-        # Initialize query depth context
-        if not hasattr(info.context, 'query_depth'):
-            info.context.query_depth = 0
-
         try:
-            result = DB.execute(logger, COMPANY_BASE_QUERY.format(nr_cnpj=companyId.nr_cnpj)).fetchone()
+            result = await _fetch_cached(info.context, "company", COMPANY_BASE_BATCH_QUERY, companyId.nr_cnpj)
             if not result:
                 return None
                 
@@ -146,25 +685,21 @@ class Query:
                 sg_uf=result[2]
             )
         except Exception as e:
-            logger.error(f"Error fetching company {companyId.nr_cnpj}: {e}")
+            logger.log.error(f"Error fetching company {companyId.nr_cnpj}: {e}")
             raise Exception(f"Failed to fetch company: {str(e)}")
 
     @strawberry.field
-    def operator(
+    async def operator(
         self, 
         operatorKey: OperatorKey = strawberry.UNSET,
-        info: strawberry.Info = strawberry.UNSET
+        info: Info = strawberry.UNSET
     ) -> Optional[Operator]:
         """Get an operator by operator key"""
         if operatorKey is strawberry.UNSET:
             raise Exception("You need to provide operator key")
 
-        # Initialize query depth context
-        if not hasattr(info.context, 'query_depth'):
-            info.context.query_depth = 0
-
         try:
-            result = DB.execute(logger, OPERATOR_BASE_QUERY.format(operator_key=operatorKey.key)).fetchone()
+            result = await _fetch_cached(info.context, "operator", OPERATOR_BASE_BATCH_QUERY, operatorKey.key)
             if not result:
                 return None
                 
@@ -174,27 +709,70 @@ class Query:
                 nm_socio=result[2]
             )
         except Exception as e:
-            logger.error(f"Error fetching operator {operatorKey.key}: {e}")
+            logger.log.error(f"Error fetching operator {operatorKey.key}: {e}")
             raise Exception(f"Failed to fetch operator: {str(e)}")
             
+    @strawberry.field
+    async def companies(self, ids: list[CompanyID], info: Info) -> list[Optional[Company]]:
+        """Get many companies by CNPJ number, in the order of `ids`, null for the ones that don't exist"""
+        _check_bulk_keys(ids)
+        try:
+            rows = await _fetch_all_cached(
+                info.context, "company", COMPANY_BASE_BATCH_QUERY, [company_id.nr_cnpj for company_id in ids]
+            )
+        except Exception as e:
+            logger.log.error(f"Error fetching {len(ids):,} companies: {e}")
+            raise Exception(f"Failed to fetch companies: {str(e)}")
+
+        companies = []
+        for company_id in ids:
+            found = rows[company_id.nr_cnpj]
+            companies.append(
+                Company(nr_cnpj=company_id.nr_cnpj, nm_fantasia=found[0][0], sg_uf=found[0][1]) if found else None
+            )
+        return companies
+
+    @strawberry.field
+    async def operators(self, keys: list[OperatorKey], info: Info) -> list[Optional[Operator]]:
+        """Get many operators by operator key, in the order of `keys`, null for the ones that don't exist"""
+        _check_bulk_keys(keys)
+        try:
+            rows = await _fetch_all_cached(
+                info.context, "operator", OPERATOR_BASE_BATCH_QUERY, [operator_key.key for operator_key in keys]
+            )
+        except Exception as e:
+            logger.log.error(f"Error fetching {len(keys):,} operators: {e}")
+            raise Exception(f"Failed to fetch operators: {str(e)}")
+
+        operators = []
+        for operator_key in keys:
+            found = rows[operator_key.key]
+            operators.append(
+                Operator(operator_key=operator_key.key, in_cpf_cnpj=found[0][0], nm_socio=found[0][1]) if found else None
+            )
+        return operators
+
     @strawberry.field 
-    def connected_companies(
+    async def connected_companies(
         self,
         companyId: CompanyID = strawberry.UNSET,
-        max_depth: Optional[int] = 2
+        max_depth: Optional[int] = DEFAULT_CONNECTED_MAX_DEPTH,
+        limit: Optional[int] = config.GRAPH_CONFIGS["max_results"],
+        max_degree: Optional[int] = None,
+        info: Info = strawberry.UNSET
     ) -> Optional[list[Company]]:
-        """Get all companies connected through shared operators"""
+        """Get all companies connected through shared operators, the nearest `limit` of them, not through hubs of more than `max_degree`"""
         if companyId is strawberry.UNSET:
             raise Exception("You need to provide nr_cnpj")
             
         try:
-            result = DB.execute(
-                logger, 
-                CONNECTED_COMPANIES_QUERY.format(
-                    nr_cnpj=companyId.nr_cnpj, 
-                    max_depth=max_depth or 2
-                )
-            ).fetchall()
+            result, truncated = await _connected_company_rows(
+                info.context,
+                companyId.nr_cnpj,
+                connected_max_depth(max_depth),
+                min(limit or config.GRAPH_CONFIGS["max_results"], config.GRAPH_CONFIGS["max_results"]),
+                max_degree
+            )
             companies = []
             for row in result:
                 companies.append(Company(
@@ -202,7 +780,99 @@ class Query:
                     nm_fantasia=row[1], 
                     sg_uf=row[2]
                 ))
-            return companies
         except Exception as e:
-            logger.error(f"Error fetching connected companies for {companyId.nr_cnpj}: {e}")
-            return []
\ No newline at end of file
+            logger.log.error(f"Error fetching connected companies for {companyId.nr_cnpj}: {e}")
+            return []
+
+        path = info.path.as_list()
+        for reason in truncated:
+            info.context.truncated(path, reason, None, len(companies))
+        visited = info.context.visit(len(companies))
+        if visited < len(companies):
+            companies = companies[:visited]
+            info.context.truncated(path, graph.TRUNCATED_VISITED, None, visited)
+        return companies
+
+    @strawberry.field
+    async def connected_companies_connection(
+        self,
+        companyId: CompanyID = strawberry.UNSET,
+        max_depth: Optional[int] = DEFAULT_CONNECTED_MAX_DEPTH,
+        max_degree: Optional[int] = None,
+        first: Optional[int] = PAGE_SIZE,
+        after: Optional[str] = None,
+        info: Info = strawberry.UNSET
+    ) -> Optional[Connection[Company]]:
+        """Get a page of the companies connected through shared operators, nearest first: the `first` after the cursor `after`"""
+        if companyId is strawberry.UNSET:
+            raise Exception("You need to provide nr_cnpj")
+
+        first, position = page_size(first), _after(after, 2)
+        try:
+            return await _connected_companies_page(info, companyId.nr_cnpj, max_depth, max_degree, first, after, position)
+        except Exception as e:
+            logger.log.error(f"Error fetching the connected companies page of {companyId.nr_cnpj}: {e}")
+            raise Exception(f"Failed to fetch the connected companies page: {str(e)}")
+
+    @strawberry.field
+    async def are_connected(
+        self,
+        a: CompanyID = strawberry.UNSET,
+        b: CompanyID = strawberry.UNSET,
+        info: Info = strawberry.UNSET
+    ) -> Optional[bool]:
+        """Get whether two companies are connected through shared operators at all, null when one is unknown"""
+        if a is strawberry.UNSET or b is strawberry.UNSET:
+            raise Exception("You need to provide the nr_cnpj of both companies")
+
+        try:
+            component_a, component_b = await info.context.loader(_load_company_components).load_many(
+                [a.nr_cnpj, b.nr_cnpj]
+            )
+        except Exception as e:
+            logger.log.error(f"Error fetching the components of {a.nr_cnpj} and {b.nr_cnpj}: {e}")
+            raise Exception(f"Failed to fetch the components: {str(e)}")
+        if component_a is None or component_b is None:
+            return None
+        return component_a[0] == component_b[0]
+
+    @strawberry.field
+    async def connection_path(
+        self,
+        from_: Annotated[CompanyID, strawberry.argument(name="from")] = strawberry.UNSET,
+        to: CompanyID = strawberry.UNSET,
+        max_depth: Optional[int] = DEFAULT_PATH_MAX_DEPTH,
+        info: Info = strawberry.UNSET
+    ) -> Optional[ConnectionPath]:
+        """Get the shortest chain of shared operators from one company to another, null when there is none"""
+        paths = await _resolve_connection_paths(info, from_, to, max_depth, 1)
+        return paths[0] if paths else None
+
+    @strawberry.field
+    async def connection_paths(
+        self,
+        from_: Annotated[CompanyID, strawberry.argument(name="from")] = strawberry.UNSET,
+        to: CompanyID = strawberry.UNSET,
+        max_depth: Optional[int] = DEFAULT_PATH_MAX_DEPTH,
+        limit: Optional[int] = 3,
+        info: Info = strawberry.UNSET
+    ) -> list[ConnectionPath]:
+        """Get up to `limit` of the shortest chains of shared operators from one company to another"""
+        return await _resolve_connection_paths(info, from_, to, max_depth, limit)
+
+    @strawberry.field
+    async def data_generation(self, info: Info) -> Optional[DataGeneration]:
+        """Get the generation of the transformed data that is served"""
+        try:
+            result = await info.context.fetchone(DATA_GENERATION_QUERY)
+        except Exception as e:
+            logger.log.error(f"Error fetching the data generation: {e}")
+            return None
+        if not result:
+            return None
+
+        return DataGeneration(
+            generation=result[0],
+            built_at=result[1].isoformat(),
+            activated_at=result[2].isoformat() if result[2] else None
+        )
@@ -1 +1,901 @@
+import asyncio
+import contextlib
+import threading
+import time
+import types
+from typing import Optional
+
+import numpy as np
+import psycopg2
 import pytest
+import strawberry
+from graphql import parse
+from graphql.pyutils import Path
+from strawberry.types import Info
+
+import brazilian_business_partner_api
+from brazilian_business_partner_api.config import config
+from brazilian_business_partner_api.connect import connect
+from brazilian_business_partner_api.dataloader import components, dag, importer, reconcile, stream
+from brazilian_business_partner_api.service import apprunner, cache, cost, documents, graph
+from brazilian_business_partner_api.service.model import company as model
+
+logger = brazilian_business_partner_api.Logger(__name__)
+
+
+def _info(*keys) -> types.SimpleNamespace:
+    """The `info` of the field at the end of `keys`, the (key, typename) of every field and list index in its path"""
+    path = None
+    for key, typename in keys:
+        path = Path(path, key, typename)
+    return types.SimpleNamespace(path=path)
+
+
+@pytest.mark.parametrize(
+    "keys",
+    [
+        ("company", "operators", "companies", "operators"),
+        ("company", "first", "second", "third"),
+        ("company", "companies", "operators", "companies"),
+    ],
+)
+def test_query_depth_counts_aliased_nested_fields(keys):
+    root, company_field, operator_field, field = keys
+    info = _info(
+        (root, "Query"),
+        (company_field, "Company"),
+        (0, None),
+        (operator_field, "Operator"),
+        (0, None),
+        (field, "Company"),
+    )
+    assert model._query_depth(info) == 2
+    assert model._query_depth(info) >= model.nested_max_depth(2)
+
+
+def test_query_depth_counts_connections():
+    info = _info(
+        ("companyConnection", "Query"),
+        ("page", "Company"),
+        ("edges", "OperatorConnection"),
+        (0, None),
+        ("node", "OperatorEdge"),
+        ("companies", "Operator"),
+    )
+    assert model._query_depth(info) == 1
+
+
+def test_nested_max_depth_is_capped():
+    assert model.nested_max_depth(10**6) == model.MAX_NESTED_DEPTH
+    assert model.nested_max_depth(None) == min(model.DEFAULT_MAX_DEPTH, model.MAX_NESTED_DEPTH)
+
+
+FAN_OUT = 3
+
+
+@strawberry.type(name="Company")
+class _Company:
+    nr_cnpj: str
+
+    @strawberry.field
+    def operators(
+        self,
+        info: Info,
+        max_depth: Optional[int] = model.DEFAULT_MAX_DEPTH,
+        limit: Optional[int] = None,
+    ) -> list["_Operator"]:
+        if model._query_depth(info) >= model.nested_max_depth(max_depth):
+            return []
+        return [
+            _Operator(operator_key=f"{self.nr_cnpj}/{i}")
+            for i in range(min(limit or FAN_OUT, FAN_OUT))
+        ]
+
+
+@strawberry.type(name="Operator")
+class _Operator:
+    operator_key: str
+
+    @strawberry.field
+    def companies(
+        self,
+        info: Info,
+        max_depth: Optional[int] = model.DEFAULT_MAX_DEPTH,
+        limit: Optional[int] = None,
+    ) -> list[_Company]:
+        if model._query_depth(info) >= model.nested_max_depth(max_depth):
+            return []
+        return [
+            _Company(nr_cnpj=f"{self.operator_key}/{i}")
+            for i in range(min(limit or FAN_OUT, FAN_OUT))
+        ]
+
+
+@strawberry.type(name="Query")
+class _Query:
+    @strawberry.field
+    def company(self, nr_cnpj: str) -> _Company:
+        return _Company(nr_cnpj=nr_cnpj)
+
+
+COST_SCHEMA = strawberry.Schema(query=_Query, extensions=[cost.QueryCost])
+
+
+def _nested_query(levels: int, aliased: bool) -> str:
+    selection = "operatorKey" if levels % 2 else "nrCnpj"
+    for level in reversed(range(levels)):
+        field, key = ("operators", "nrCnpj") if level % 2 == 0 else ("companies", "operatorKey")
+        alias = f"level{level}: " if aliased else ""
+        selection = f"{key} {alias}{field}(maxDepth: 2, limit: {FAN_OUT}) {{ {selection} }}"
+    return f'{{ company(nrCnpj: "1") {{ {selection} }} }}'
+
+
+@pytest.mark.parametrize("aliased", [False, True])
+def test_estimated_cost_covers_the_actual_cost_of_aliased_fields(aliased):
+    result = asyncio.run(COST_SCHEMA.execute(_nested_query(5, aliased)))
+    assert result.errors is None
+    query_cost = result.extensions["cost"]
+    # the company, its operators and their companies, nothing below maxDepth
+    assert query_cost["actual"] == 1 + FAN_OUT + FAN_OUT**2
+    assert query_cost["estimated"] >= query_cost["actual"]
+
+
+def _estimate(query: str, degree_statistics: Optional[dict] = None) -> float:
+    return cost.CostEstimator(
+        COST_SCHEMA._schema, parse(query), {}, degree_statistics or {}
+    ).estimate()
+
+
+def test_estimated_cost_follows_fragments():
+    inline = '{ company(nrCnpj: "1") { operators(limit: 5) { companies(limit: 4) { nrCnpj } } } }'
+    fragments = """
+        { company(nrCnpj: "1") { ...operators } }
+        fragment operators on Company { operators(limit: 5) { ... on Operator { companies(limit: 4) { nrCnpj } } } }
+    """
+    assert _estimate(inline) == _estimate(fragments) == 1 + 5 + 5 * 4
+
+
+def test_estimated_cost_uses_the_99th_percentile_degree():
+    degree_statistics = {graph.COMPANY: (100, 1.5, 2, 50), graph.OPERATOR: (100, 1.5, 3, 50)}
+    query = '{ company(nrCnpj: "1") { operators { companies { nrCnpj } } } }'
+    assert _estimate(query, degree_statistics) == 1 + 2 + 2 * 3
+    assert _estimate(query) == 1 + model.MAX_FAN_OUT + model.MAX_FAN_OUT**2
+
+
+def _random_graph(seed: int, companies: int = 60, operators: int = 40, edges: int = 110) -> tuple:
+    """A random CompanyGraph, and its adjacency as dicts of sets"""
+    rng = np.random.default_rng(seed)
+    pairs = np.unique(
+        np.column_stack((rng.integers(0, companies, edges), rng.integers(0, operators, edges))),
+        axis=0,
+    ).astype(np.int32)
+    company_graph = graph.CompanyGraph.from_edges(
+        pairs[:, 0],
+        pairs[:, 1],
+        [(company_id, f"{company_id:014d}") for company_id in range(companies)],
+        [(operator_id, f"operator {operator_id}") for operator_id in range(operators)],
+    )
+    company_operators, operator_companies = {}, {}
+    for company_id, operator_id in pairs.tolist():
+        company_operators.setdefault(company_id, set()).add(operator_id)
+        operator_companies.setdefault(operator_id, set()).add(company_id)
+    return company_graph, company_operators, operator_companies
+
+
+def _walk(
+    company_operators: dict, operator_companies: dict, start: int, max_depth: int, max_degree=None
+) -> list:
+    """The (depth, company_id) of the companies connected to `start`, one at a time, nearest first"""
+    depths = {start: 0}
+    walked_operators = set()
+    frontier = [start]
+    for depth in range(1, max_depth + 1):
+        operators = {
+            o for c in frontier for o in company_operators.get(c, ()) if o not in walked_operators
+        }
+        walked_operators |= operators
+        operators = [
+            o for o in operators if max_degree is None or len(operator_companies[o]) <= max_degree
+        ]
+        found = sorted({c for o in operators for c in operator_companies[o] if c not in depths})
+        depths.update((company_id, depth) for company_id in found)
+        frontier = [
+            c for c in found if max_degree is None or len(company_operators[c]) <= max_degree
+        ]
+    return sorted((depth, company_id) for company_id, depth in depths.items() if depth > 0)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("max_degree", [None, 3])
+def test_connected_companies_are_in_breadth_first_order(seed, max_degree):
+    company_graph, company_operators, operator_companies = _random_graph(seed)
+    for start in range(0, 60, 7):
+        for max_depth in (1, 2, 4):
+            expected = _walk(company_operators, operator_companies, start, max_depth, max_degree)
+            company_ids, truncated = company_graph.connected_companies(
+                start, max_depth, None, max_degree
+            )
+            assert company_ids.tolist() == [company_id for _, company_id in expected]
+            assert graph.TRUNCATED_LIMIT not in truncated
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_connected_companies_keep_the_nearest_limit(seed):
+    company_graph, company_operators, operator_companies = _random_graph(seed)
+    for start in range(0, 60, 7):
+        expected = [
+            company_id for _, company_id in _walk(company_operators, operator_companies, start, 4)
+        ]
+        for limit in (1, 3, 10):
+            company_ids, truncated = company_graph.connected_companies(start, 4, limit)
+            assert company_ids.tolist() == expected[:limit]
+            if len(expected) > limit:
+                assert graph.TRUNCATED_LIMIT in truncated
+
+
+def test_connected_companies_stop_at_max_visited():
+    company_graph, company_operators, operator_companies = _random_graph(0, edges=200)
+    expected = [company_id for _, company_id in _walk(company_operators, operator_companies, 0, 4)]
+    company_ids, truncated = company_graph.connected_companies(0, 4, max_visited=1)
+    assert graph.TRUNCATED_VISITED in truncated
+    assert company_ids.tolist() == expected[: len(company_ids)]
+    assert len(company_ids) < len(expected)
+
+
+def test_company_id_of_a_key():
+    company_graph, _, _ = _random_graph(0)
+    assert company_graph.company_id("00000000000042") == 42
+    assert company_graph.company_id("99999999999999") is None
+    assert company_graph.company_id("") is None
+
+
+def test_snapshot_round_trip(tmp_path):
+    company_graph, _, _ = _random_graph(0)
+    company_graph.generation = 7
+    company_graph.save(tmp_path / "company_graph.snapshot")
+    snapshot = graph.CompanyGraph.open(tmp_path / "company_graph.snapshot")
+    assert snapshot.generation == 7
+    for name in graph.SNAPSHOT_ARRAYS:
+        np.testing.assert_array_equal(snapshot.arrays[name], company_graph.arrays[name])
+    assert (
+        snapshot.connected_companies(0, 3)[0].tolist()
+        == company_graph.connected_companies(0, 3)[0].tolist()
+    )
+
+
+def test_snapshot_checksum_mismatch(tmp_path):
+    path = tmp_path / "company_graph.snapshot"
+    _random_graph(0)[0].save(path)
+    data = bytearray(path.read_bytes())
+    data[-1] ^= 0xFF
+    path.write_bytes(data)
+    with pytest.raises(graph.SnapshotError, match="checksum"):
+        graph.CompanyGraph.open(path)
+    # without verifying, the corrupt snapshot is mapped
+    assert graph.CompanyGraph.open(path, verify=False).companies == 60
+
+
+def test_snapshot_of_another_version(tmp_path):
+    path = tmp_path / "company_graph.snapshot"
+    path.write_bytes(b"not a snapshot")
+    with pytest.raises(graph.SnapshotError, match="not a company graph snapshot"):
+        graph.CompanyGraph.open(path)
+    path.write_bytes(
+        graph.SNAPSHOT_MAGIC + (graph.SNAPSHOT_VERSION + 1).to_bytes(4, "little") + bytes(4)
+    )
+    with pytest.raises(graph.SnapshotError, match="version"):
+        graph.CompanyGraph.open(path)
+
+
+def _distance(
+    company_operators: dict, operator_companies: dict, from_id: int, to_id: int, max_degree=None
+):
+    """The fewest operators between two companies, by a breadth first search of the whole graph, None if none"""
+    adjacency = {
+        ("company", c): [("operator", o) for o in operators]
+        for c, operators in company_operators.items()
+    }
+    adjacency.update(
+        {
+            ("operator", o): [("company", c) for c in companies]
+            for o, companies in operator_companies.items()
+        }
+    )
+    start, end = ("company", from_id), ("company", to_id)
+    steps = {start: 0}
+    frontier = [start]
+    while frontier:
+        following = []
+        for node in frontier:
+            if node != start and max_degree is not None and len(adjacency[node]) > max_degree:
+                continue
+            for neighbor in adjacency.get(node, ()):
+                if neighbor not in steps:
+                    steps[neighbor] = steps[node] + 1
+                    following.append(neighbor)
+        frontier = following
+    return steps[end] // 2 if end in steps else None
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("max_degree", [None, 3])
+def test_shortest_paths_match_a_brute_force_search(seed, max_degree):
+    company_graph, company_operators, operator_companies = _random_graph(seed, edges=80)
+    degrees = {("company", c): len(o) for c, o in company_operators.items()}
+    degrees.update({("operator", o): len(c) for o, c in operator_companies.items()})
+    for from_id in range(0, 60, 6):
+        for to_id in range(1, 60, 5):
+            distance = _distance(company_operators, operator_companies, from_id, to_id, max_degree)
+            for max_depth in (1, 3, 6):
+                paths = company_graph.shortest_paths(from_id, to_id, max_depth, 3, max_degree)
+                if distance is None or distance > max_depth:
+                    assert paths == []
+                    continue
+                assert 1 <= len(paths) <= 3
+                assert len({tuple(path) for path in paths}) == len(paths)
+                for path in paths:
+                    assert len(path) == 2 * distance + 1
+                    assert path[0] == from_id and path[-1] == to_id
+                    for i in range(1, len(path), 2):
+                        assert (
+                            path[i] in company_operators[path[i - 1]]
+                            and path[i + 1] in operator_companies[path[i]]
+                        )
+                        if max_degree is not None:
+                            assert degrees[("operator", path[i])] <= max_degree
+                            assert i == 1 or degrees[("company", path[i - 1])] <= max_degree
+
+
+def _company_components(
+    pairs: np.ndarray, companies: int, operators: int, company_ids=None
+) -> dict:
+    """The (component_id, component_size) of the companies, from the edges of `company_ids` (all by default)"""
+    company_ids = (
+        np.arange(companies)
+        if company_ids is None
+        else np.array(sorted(company_ids), dtype=np.int64)
+    )
+    union_find = components.UnionFind(companies + operators)
+    # streamed in chunks, like the edges of the xref id table
+    for chunk in np.array_split(pairs[np.isin(pairs[:, 0], company_ids)], 3):
+        union_find.union(chunk[:, 0], chunk[:, 1] + companies)
+    roots, sizes = components.components(union_find, company_ids)
+    return dict(zip(company_ids.tolist(), zip(roots.tolist(), sizes.tolist())))
+
+
+def _connected_sets(pairs: np.ndarray, companies: int) -> dict:
+    """The (smallest company_id, size) of the set of companies of every company, by a search of every set"""
+    company_operators, operator_companies = {}, {}
+    for company_id, operator_id in pairs.tolist():
+        company_operators.setdefault(company_id, set()).add(operator_id)
+        operator_companies.setdefault(operator_id, set()).add(company_id)
+    result = {}
+    for start in range(companies):
+        if start in result:
+            continue
+        found, frontier = {start}, {start}
+        while frontier:
+            frontier = {
+                c
+                for company_id in frontier
+                for o in company_operators.get(company_id, ())
+                for c in operator_companies[o]
+            } - found
+            found |= frontier
+        result.update((company_id, (min(found), len(found))) for company_id in found)
+    return result
+
+
+def _pairs(rng, companies: int, operators: int, edges: int) -> np.ndarray:
+    return np.unique(
+        np.column_stack((rng.integers(0, companies, edges), rng.integers(0, operators, edges))),
+        axis=0,
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_union_find_components(seed):
+    rng = np.random.default_rng(seed)
+    pairs = rng.permutation(_pairs(rng, 200, 150, 220))
+    assert _company_components(pairs, 200, 150) == _connected_sets(pairs, 200)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_incremental_components_match_a_full_recompute(seed):
+    rng = np.random.default_rng(seed)
+    companies, operators = 120, 90
+    old_pairs = _pairs(rng, companies, operators, 130)
+    old = _company_components(old_pairs, companies, operators)
+
+    # a delta: the touched companies lose some of their operators and get new ones
+    touched = set(rng.choice(companies, 6, replace=False).tolist())
+    kept = old_pairs[
+        ~(np.isin(old_pairs[:, 0], list(touched)) & (rng.random(len(old_pairs)) < 0.5))
+    ]
+    added = np.column_stack((rng.choice(list(touched), 8), rng.integers(0, operators, 8)))
+    new_pairs = np.unique(np.concatenate((kept, added)), axis=0)
+
+    # the companies the components step computes again (see affected_component_companies)
+    touched_operators = set(new_pairs[np.isin(new_pairs[:, 0], list(touched)), 1].tolist())
+    neighbors = touched | set(
+        new_pairs[np.isin(new_pairs[:, 1], list(touched_operators)), 0].tolist()
+    )
+    old_components = {old[company_id][0] for company_id in neighbors}
+    affected = neighbors | {
+        company_id for company_id, (root, _) in old.items() if root in old_components
+    }
+
+    incremental = dict(old)
+    incremental.update(_company_components(new_pairs, companies, operators, affected))
+    assert incremental == _company_components(new_pairs, companies, operators)
+    assert incremental == _connected_sets(new_pairs, companies)
+
+
+@pytest.mark.parametrize("position", [(0,), (42,), (3, 12345), (2**31 - 1, 0)])
+def test_cursor_round_trip(position):
+    assert model._after(model._cursor(*position), len(position)) == position
+    assert model._after(None, len(position)) is None
+
+
+@pytest.mark.parametrize("cursor", ["not a cursor", model._cursor(1, 2), "Y3Vyc29yOng=", "%%%"])
+def test_invalid_cursor(cursor):
+    with pytest.raises(Exception, match="Invalid cursor"):
+        model._after(cursor, 1)
+
+
+def test_page_size():
+    assert model.page_size(None) == min(model.PAGE_SIZE, model.MAX_FAN_OUT)
+    assert model.page_size(-1) == 0
+    assert model.page_size(10**9) == model.MAX_FAN_OUT
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("count", [1, 2, 7])
+def test_pages_of_connected_companies(seed, count):
+    company_graph, company_operators, operator_companies = _random_graph(seed)
+    for start in range(0, 60, 11):
+        layers, _ = company_graph.connected_layers(start, 4)
+        expected = _walk(company_operators, operator_companies, start, 4)
+        walked, cursor = [], None
+        while True:
+            company_ids, depths = graph.page(layers, model._after(cursor, 2), count + 1)
+            page = list(zip(depths.tolist(), company_ids.tolist()))
+            walked.extend(page[:count])
+            if len(page) <= count:
+                break
+            cursor = model._cursor(*page[count - 1])
+        assert walked == expected
+
+
+def _csv(tmp_path, rows: int) -> tuple:
+    """A tab separated file of `rows` rows of different lengths, and its header and data"""
+    header = b"NR_CNPJ\tNM_FANTASIA\tSG_UF\n"
+    data = b"".join(b"%014d\t%s\tSP\n" % (i, b"x" * (i % 17)) for i in range(rows))
+    path = tmp_path / "company.csv"
+    path.write_bytes(header + data)
+    return str(path), header, data
+
+
+@pytest.mark.parametrize("rows", [0, 1, 5, 1000])
+@pytest.mark.parametrize("count", [1, 2, 3, 8, 2000])
+def test_shards_cover_the_data_on_line_boundaries(tmp_path, rows, count):
+    path, header, data = _csv(tmp_path, rows)
+    shards = stream.plan_shards(path, count)
+    assert len(shards) <= count
+    assert [shard.number for shard in shards] == list(range(1, len(shards) + 1))
+    assert b"".join(stream.read_shard(path, shard) for shard in shards) == data
+    for shard in shards:
+        assert shard.end > shard.start
+        assert stream.read_shard(path, shard).endswith(b"\n")
+
+
+def test_line_streams_of_the_shards_read_every_row_once(tmp_path):
+    path, header, data = _csv(tmp_path, 1000)
+    assert stream.read_header(path) == (["nr_cnpj", "nm_fantasia", "sg_uf"], len(header))
+    lines, rows_read = [], 0
+    for shard in stream.plan_shards(path, 7):
+        with stream.LineStream(path, shard.start, shard.end) as reader:
+            while chunk := reader.read(100):
+                lines.append(chunk)
+            rows_read += reader.rows_read
+    assert b"".join(lines) == data
+    assert rows_read == 1000
+
+
+def _load_report(*chunks: reconcile.ChunkResult) -> reconcile.LoadReport:
+    report = reconcile.LoadReport("stage.company")
+    for chunk in chunks:
+        report.add(chunk)
+    return report
+
+
+def test_load_report_reconciles():
+    report = _load_report(
+        reconcile.ChunkResult(1, rows_read=10, rows_committed=10, attempts=1),
+        reconcile.ChunkResult(
+            2, rows_read=5, rows_committed=5, attempts=2, status=reconcile.RETRIED
+        ),
+        reconcile.ChunkResult(3, rows_read=7, rows_committed=7, status=reconcile.RESUMED),
+    )
+    assert (report.rows_read, report.rows_committed) == (22, 22)
+    assert [c.number for c in report.retried] == [2]
+    assert [c.number for c in report.resumed] == [3]
+    assert report.reconcile(logger, 22)
+    assert not report.reconcile(logger, 21)
+
+
+def test_load_report_with_quarantined_chunks_doesnt_reconcile():
+    report = _load_report(
+        reconcile.ChunkResult(1, rows_read=10, rows_committed=10, attempts=1),
+        reconcile.ChunkResult(
+            2, rows_read=5, attempts=3, status=reconcile.QUARANTINED, error="bad row"
+        ),
+    )
+    assert [c.number for c in report.quarantined] == [2]
+    # the rows that were loaded are accounted for, but the quarantined ones aren't in the table
+    assert not report.reconcile(logger, 10)
+
+
+TEST_STAGE_SCHEMA = "stage_test"
+
+
+@pytest.fixture
+def stage_schema(monkeypatch) -> connect.PostgresSingletonDB:
+    """The stage tables of the importer in a schema of their own, the test is skipped without a database"""
+    try:
+        db = connect.PostgresSingletonDB(config.DB_CONFIGS)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"No database: {e}")
+    db.execute(logger, f"DROP SCHEMA IF EXISTS {TEST_STAGE_SCHEMA} CASCADE", raise_errors=True)
+    db.execute(logger, f"CREATE SCHEMA {TEST_STAGE_SCHEMA}", raise_errors=True)
+    for name in (
+        "FQ_STG_TABLE",
+        "FQ_LOAD_MANIFEST_TABLE",
+        "FQ_TRANSFORM_MANIFEST_TABLE",
+        "FQ_LOAD_STATUS_TABLE",
+        "FQ_STG_INCOMING_TABLE",
+        "FQ_STG_DELTA_TABLE",
+    ):
+        table = getattr(importer, name).split(".")[1]
+        monkeypatch.setattr(importer, name, f"{TEST_STAGE_SCHEMA}.{table}")
+    db.execute(
+        logger,
+        importer.CREATE_STG_TABLE_DDL.format(schematable=importer.FQ_STG_TABLE),
+        raise_errors=True,
+    )
+    yield db
+    db.execute(logger, f"DROP SCHEMA IF EXISTS {TEST_STAGE_SCHEMA} CASCADE", raise_errors=True)
+
+
+def _export(tmp_path, name: str, companies: range) -> str:
+    """A tab separated export with one operator for every company of `companies`"""
+    header = "nr_cnpj\tnm_fantasia\tsg_uf\tnm_socio\n"
+    path = tmp_path / name
+    path.write_text(header + "".join(f"{i:014d}\tEMPRESA {i}\tSP\tSOCIO {i}\n" for i in companies))
+    return str(path)
+
+
+def test_resuming_an_incremental_load_that_finished(tmp_path, stage_schema):
+    importer.Importer(_export(tmp_path, "first.tsv", range(0, 300)), None, config.DB_CONFIGS).load(
+        True
+    )
+    second = importer.Importer(
+        _export(tmp_path, "second.tsv", range(100, 400)), None, config.DB_CONFIGS
+    )
+    second.load(False, incremental=True)
+    # the delta was applied, so there is nothing left to load
+    second.load(False, resume=True, incremental=True)
+
+    def companies(table: str) -> list:
+        return [
+            row[0]
+            for row in stage_schema.execute(
+                logger, f"SELECT nr_cnpj FROM {table} ORDER BY nr_cnpj", raise_errors=True
+            ).fetchall()
+        ]
+
+    assert companies(importer.FQ_STG_TABLE) == [f"{i:014d}" for i in range(100, 400)]
+    assert companies(importer.FQ_STG_INCOMING_TABLE) == []
+    assert len(companies(importer.FQ_STG_DELTA_TABLE)) == 200
+
+
+class _Pool:
+    """A connection pool of no connections, for nodes that don't use one"""
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield None
+
+
+def _tracked_nodes(deps: dict, fail: str = None, completed: tuple = ()) -> tuple:
+    """Nodes that check that their deps finished before them (or were `completed`), and the names that finished"""
+    finished, lock = [], threading.Lock()
+    running = {"now": 0, "most": 0}
+
+    def run(name, db):
+        with lock:
+            assert set(deps[name]) <= set(finished) | set(completed)
+            running["now"] += 1
+            running["most"] = max(running["most"], running["now"])
+        time.sleep(0.01)
+        with lock:
+            running["now"] -= 1
+            if name == fail:
+                raise RuntimeError(f"{name} failed")
+            finished.append(name)
+        return len(name)
+
+    nodes = [
+        dag.Node(name, lambda db, name=name: run(name, db), tuple(node_deps))
+        for name, node_deps in deps.items()
+    ]
+    return nodes, finished, running
+
+
+DAG = {"a": (), "b": (), "c": ("a",), "d": ("a", "b"), "e": ("c", "d"), "f": ()}
+
+
+@pytest.mark.parametrize("concurrency", [1, 2, 4])
+def test_dag_runs_every_node_after_its_deps(concurrency):
+    nodes, finished, running = _tracked_nodes(DAG)
+    done = []
+    results = dag.DAGScheduler(nodes, _Pool(), concurrency, logger).run(on_done=done.append)
+    assert sorted(finished) == sorted(DAG)
+    assert [result.name for result in results] == [result.name for result in done]
+    order = [result.name for result in results]
+    assert all(order.index(dep) < order.index(name) for name in DAG for dep in DAG[name])
+    assert running["most"] <= concurrency
+    assert all(result.rows == len(result.name) for result in results)
+
+
+def test_dag_skips_completed_nodes():
+    nodes, finished, _ = _tracked_nodes(DAG, completed=("a", "b", "c"))
+    dag.DAGScheduler(nodes, _Pool(), 2, logger).run(completed={"a", "b", "c"})
+    assert sorted(finished) == ["d", "e", "f"]
+
+
+def test_dag_stops_at_a_failed_node():
+    nodes, finished, _ = _tracked_nodes(DAG, fail="c")
+    with pytest.raises(RuntimeError, match="c failed"):
+        dag.DAGScheduler(nodes, _Pool(), 1, logger).run()
+    assert "c" not in finished and "e" not in finished
+
+
+def test_dag_rejects_unknown_deps_and_cycles():
+    with pytest.raises(ValueError, match="unknown nodes"):
+        dag.DAGScheduler([dag.Node("a", lambda db: None, ("z",))], _Pool(), 1, logger)
+    cycle = [dag.Node("a", lambda db: None, ("b",)), dag.Node("b", lambda db: None, ("a",))]
+    with pytest.raises(ValueError, match="cycle"):
+        dag.DAGScheduler(cycle, _Pool(), 1, logger).run()
+
+
+def test_critical_path():
+    results = [
+        dag.NodeResult("a", (), 0, 1.0),
+        dag.NodeResult("b", (), 0, 3.0),
+        dag.NodeResult("c", ("a",), 1, 1.0),
+        dag.NodeResult("d", ("a", "b"), 3, 0.5),
+        dag.NodeResult("e", ("c", "d", "done before"), 3.5, 2.0),
+    ]
+    path, seconds = dag.critical_path(results)
+    assert path == ["b", "d", "e"]
+    assert seconds == pytest.approx(5.5)
+    assert dag.critical_path([]) == ([], 0.0)
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> _Clock:
+    clock = _Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    return clock
+
+
+def _result_cache(max_bytes: int = 10**6, ttl_seconds: float = 60) -> cache.ResultCache:
+    result_cache = cache.ResultCache(max_bytes, ttl_seconds, generation_check_interval=5)
+    result_cache.set_generation(1)
+    return result_cache
+
+
+def test_cache_hits_and_misses(clock):
+    result_cache = _result_cache()
+    assert result_cache.get("company", 1, "a") == (False, None)
+    result_cache.put("company", 1, "a", ("a", "Company A", "SP"))
+    result_cache.put("company", 1, "b", None)
+    assert result_cache.get("company", 1, "a") == (True, ("a", "Company A", "SP"))
+    # a result of None (not found) is cached too
+    assert result_cache.get("company", 1, "b") == (True, None)
+    assert result_cache.get("operator", 1, "a") == (False, None)
+    assert (result_cache.stats.hits, result_cache.stats.misses, result_cache.stats.entries) == (
+        2,
+        2,
+        2,
+    )
+
+
+def test_cache_evicts_the_least_recently_used_to_stay_under_max_bytes(clock):
+    value = ("x" * 100,)
+    result_cache = _result_cache(max_bytes=3 * cache._sizeof(value))
+    for key in "abc":
+        result_cache.put("company", 1, key, value)
+    assert result_cache.get("company", 1, "a")[0]
+    result_cache.put("company", 1, "d", value)
+    assert [result_cache.get("company", 1, key)[0] for key in "abcd"] == [True, False, True, True]
+    assert result_cache.stats.evictions == 1
+    assert result_cache.stats.bytes == 3 * cache._sizeof(value) <= result_cache.stats.max_bytes
+    # a result bigger than the whole cache isn't cached
+    result_cache.put("company", 1, "e", ("x" * 1000,))
+    assert result_cache.get("company", 1, "e") == (False, None)
+    assert result_cache.stats.entries == 3
+
+
+def test_cache_results_expire(clock):
+    result_cache = _result_cache(ttl_seconds=60)
+    result_cache.put("company", 1, "a", ("a",))
+    clock.now += 59
+    assert result_cache.get("company", 1, "a")[0]
+    clock.now += 1
+    assert result_cache.get("company", 1, "a") == (False, None)
+    assert (
+        result_cache.stats.expirations,
+        result_cache.stats.entries,
+        result_cache.stats.bytes,
+    ) == (1, 0, 0)
+
+
+def test_cache_is_invalidated_by_a_new_generation(clock):
+    result_cache = _result_cache()
+    result_cache.put("company", 1, "a", ("a",))
+    result_cache.put("company", 1, "b", ("b",))
+    assert not result_cache.generation_expired()
+    clock.now += 5
+    assert result_cache.generation_expired()
+
+    result_cache.set_generation(1)
+    assert result_cache.get("company", 1, "a")[0]
+    result_cache.set_generation(2)
+    assert result_cache.get("company", 2, "a") == (False, None)
+    assert (
+        result_cache.stats.invalidations,
+        result_cache.stats.entries,
+        result_cache.stats.bytes,
+    ) == (2, 0, 0)
+    # a result loaded for the old generation isn't cached anymore
+    result_cache.put("company", 1, "a", ("a",))
+    assert result_cache.stats.entries == 0
+
+
+DOCUMENTS_SCHEMA = strawberry.Schema(query=_Query, extensions=[documents.CachedDocuments])
+ALLOWED_QUERY = '{ company(nrCnpj: "1") { nrCnpj } }'
+
+
+@pytest.mark.parametrize("only", [False, True])
+def test_persisted_queries_only(monkeypatch, only):
+    registry = documents.PersistedQueryRegistry(
+        {documents.document_hash(ALLOWED_QUERY): ALLOWED_QUERY}, only
+    )
+    monkeypatch.setattr(documents, "PERSISTED_QUERIES", registry)
+    monkeypatch.setattr(documents, "DOCUMENTS", documents.DocumentCache(10))
+
+    # twice, the second time the document is cached
+    for _ in range(2):
+        assert asyncio.run(DOCUMENTS_SCHEMA.execute(ALLOWED_QUERY)).data == {
+            "company": {"nrCnpj": "1"}
+        }
+        result = asyncio.run(DOCUMENTS_SCHEMA.execute('{ company(nrCnpj: "2") { nrCnpj } }'))
+        if only:
+            assert result.data is None
+            assert result.errors[0].extensions == {"code": documents.PERSISTED_QUERY_NOT_ALLOWED}
+        else:
+            assert result.data == {"company": {"nrCnpj": "2"}}
+    assert documents.DOCUMENTS.stats.hits == 2
+
+
+def test_persisted_query_registry_resolves_hashes():
+    query_hash = documents.document_hash(ALLOWED_QUERY)
+    registry = documents.PersistedQueryRegistry({query_hash: ALLOWED_QUERY}, only=True)
+    assert registry.resolve(None, query_hash.upper()) == ALLOWED_QUERY
+    assert registry.resolve(ALLOWED_QUERY, None) == ALLOWED_QUERY
+    assert registry.resolve(None, None) is None
+    for query, sha256_hash, code in (
+        (None, "0" * 64, documents.PERSISTED_QUERY_NOT_FOUND),
+        ("{ __typename }", query_hash, documents.PERSISTED_QUERY_HASH_MISMATCH),
+        ("{ __typename }", None, documents.PERSISTED_QUERY_NOT_ALLOWED),
+    ):
+        with pytest.raises(documents.PersistedQueryError) as error:
+            registry.resolve(query, sha256_hash)
+        assert error.value.code == code
+
+
+class _Rows:
+    """A context whose fetchall returns the rows of `rows` of the keys it's given, recording the batches"""
+
+    def __init__(self, rows: dict):
+        self.rows = rows
+        self.batches = []
+
+    async def fetchone(self, statement, *params):
+        return (1,)
+
+    async def fetchall(self, statement, keys, *params):
+        self.batches.append(list(keys))
+        return [(key, *row) for key in keys for row in self.rows.get(key, ())]
+
+
+def test_bulk_lookups_are_batched_and_share_the_cache_with_single_lookups(monkeypatch, clock):
+    monkeypatch.setattr(model, "CACHE", _result_cache())
+    monkeypatch.setattr(model, "CACHED_FIELDS", frozenset(["company"]))
+    monkeypatch.setattr(model, "BULK_BATCH_SIZE", 2)
+    context = _Rows(
+        {"a": [("Company A", "SP")], "b": [("Company B", "RJ")], "c": [("Company C", "MG")]}
+    )
+
+    assert asyncio.run(model._fetch_cached(context, "company", None, "a")) == (
+        "a",
+        "Company A",
+        "SP",
+    )
+    rows = asyncio.run(model._fetch_all_cached(context, "company", None, ["a", "b", "x", "b", "c"]))
+    assert rows == {
+        "a": (("Company A", "SP"),),
+        "b": (("Company B", "RJ"),),
+        "x": (),
+        "c": (("Company C", "MG"),),
+    }
+    # "a" was cached by the single lookup, the other keys are loaded once, 2 at a time
+    assert context.batches == [["a"], ["b", "x"], ["c"]]
+    assert asyncio.run(model._fetch_cached(context, "company", None, "x")) is None
+    assert asyncio.run(model._fetch_cached(context, "company", None, "c")) == (
+        "c",
+        "Company C",
+        "MG",
+    )
+    assert len(context.batches) == 3
+
+
+def test_workers_that_exit_at_startup_are_started_again_later_and_then_not_at_all(
+    monkeypatch, clock
+):
+    runner = apprunner.AppRunner(None, workers=3)
+    monkeypatch.setattr(apprunner.time, "monotonic", clock)
+    exited = []
+
+    def waitpid(pid, options):
+        if not exited:
+            raise ChildProcessError
+        return exited.pop(), 1 << 8
+
+    monkeypatch.setattr(apprunner.os, "waitpid", waitpid)
+
+    def start_and_exit(after: float, pids: list) -> None:
+        runner._workers.update(dict.fromkeys(pids, clock.now))
+        clock.now += after
+        exited.extend(pids)
+        runner._reap()
+
+    # the workers that were started together count once, the delay doubles
+    start_and_exit(1, [1, 2, 3])
+    assert (runner._fast_exits, runner._respawn_at) == (
+        1,
+        clock.now + 2 * apprunner.SUPERVISE_INTERVAL,
+    )
+    start_and_exit(1, [4, 5, 6])
+    assert (runner._fast_exits, runner._respawn_at) == (
+        2,
+        clock.now + 4 * apprunner.SUPERVISE_INTERVAL,
+    )
+    # a worker that ran for a while starts the count again
+    start_and_exit(apprunner.FAST_EXIT_SECONDS, [7])
+    assert runner._fast_exits == 0 and not runner._stopping
+
+    for pid in range(apprunner.MAX_FAST_EXITS):
+        start_and_exit(1, [100 + pid])
+        assert runner._respawn_at - clock.now <= apprunner.MAX_RESPAWN_DELAY
+    assert runner._stopping and runner._workers == {}